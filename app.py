@@ -6,11 +6,37 @@ import tempfile
 import os
 import warnings
 import datetime
-import base64
-from io import BytesIO
+import math
 import json
-import re
 import sys
+import shutil
+import uuid
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import nullcontext
+
+from r_worker import RWorkerPool, RWorkerError, RSessionManager, build_r_script, run_script_once, CANCELLED_MESSAGE, R_LIBRARIES
+from dataset_store import dataset_fingerprint, r_has_package, StagingArea, HAS_PYARROW
+from code_blocks import extract_r_code_blocks, RCodeBlockStream
+from llm_cache import LLMCache
+from r_repair import RepairEngine, RepairContext, PatchStore
+from ingest import ingest_csv, file_content_hash, format_bytes, CHUNKED_PARSE_BYTES
+from jobs import JobManager, JobCancelled, CancelScope
+from profiling import get_profile, render_context
+from prompts import PromptBuilder
+from report import ImageEncoder, write_report_html, write_report_zip
+from artifacts import ArtifactStore
+from tables import TABLE_HELPERS_R, extract_tables, is_table_data, read_table_data
+from scheduler import RScheduler, AdmissionError
+from projection import referenced_columns, is_missing_column_error
+from tracing import Trace, NULL_TRACE, Telemetry, serve_metrics, stage_totals
+from prewarm import Prewarmer
+from r_libraries import read_r_exports, required_libraries, is_missing_function_error, BASE_PACKAGES
+from preflight import RParser, check_code, code_warnings
+from result_cache import ResultCache, is_cacheable, read_r_versions
+from plots import plot_helpers_r, optimize_plots
+from session_store import SessionStore
 
 st.set_page_config(
     page_title="Ask Your CSV (R Edition)",
@@ -20,20 +46,31 @@ st.set_page_config(
 
 # Initialize OpenAI client
 client = openai.OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
+OPENAI_MODEL = "gpt-4.1"
 
-# Helper function to fix common R path issues
-def fix_r_code(code, error_msg):
-    """Attempt to fix common R code errors"""
-    fixed_code = code
-    
-    # Fix Windows path issues (backslashes)
-    if "\\U" in error_msg or "\\u" in error_msg or "used without hex digits" in error_msg:
-        # Replace single backslashes with forward slashes or double backslashes
-        import re
-        # This shouldn't happen in our generated code, but just in case
-        fixed_code = fixed_code.replace("\\", "/")
-    
-    return fixed_code
+# Token budgets for the dataset description and for each whole prompt
+DATA_CONTEXT_TOKENS = int(os.environ.get("DATA_CONTEXT_TOKENS", "1200"))
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", "6000"))
+prompt_builder = PromptBuilder(OPENAI_MODEL, budget=PROMPT_TOKEN_BUDGET)
+
+# Response cache (memory LRU + SQLite on disk)
+LLM_CACHE_TTL_HOURS = float(os.environ.get("LLM_CACHE_TTL_HOURS", "168"))
+LLM_CACHE_MAX_MB = int(os.environ.get("LLM_CACHE_MAX_MB", "200"))
+
+# Outputs of successful R runs, reused for identical code, data and R version
+R_RESULT_CACHE = os.environ.get("R_RESULT_CACHE", "1") != "0"
+RESULT_CACHE_TTL_HOURS = float(os.environ.get("RESULT_CACHE_TTL_HOURS", "168"))
+RESULT_CACHE_MAX_MB = int(os.environ.get("RESULT_CACHE_MAX_MB", "500"))
+
+# Sessions' datasets: memory budget shared by all sessions, idle minutes
+# before a dataset is spilled to disk, hours before an idle session is
+# dropped, and the largest R output kept inline in a chat message
+SESSION_MEMORY_MB = int(os.environ.get("SESSION_MEMORY_MB", "2048"))
+SESSION_IDLE_MINUTES = float(os.environ.get("SESSION_IDLE_MINUTES", "10"))
+SESSION_TTL_HOURS = float(os.environ.get("SESSION_TTL_HOURS", "24"))
+MESSAGE_INLINE_MAX_KB = int(os.environ.get("MESSAGE_INLINE_MAX_KB", "16"))
+# Past this, older answers' R output moves out of the conversation's messages
+MESSAGE_SESSION_MAX_KB = int(os.environ.get("MESSAGE_SESSION_MAX_KB", "1024"))
 
 # Helper function to run R code
 
@@ -83,79 +120,547 @@ def check_r_environment():
     except Exception as e:
         return False, str(e)
 
-# --- UPDATE THIS FUNCTION TO FIX PANDOC ERROR ---
-def run_r_code(code, df, output_dir):
-    """Execute R code and return results"""
-    # 1. Prepare data
-    csv_path = os.path.join(output_dir, "temp_data.csv")
-    df.to_csv(csv_path, index=False)
-    
-    csv_path_r = csv_path.replace("\\", "/")
-    output_dir_r = output_dir.replace("\\", "/")
+# On-disk cache shared by all sessions (staged datasets, worker scripts)
+CACHE_DIR = os.environ.get(
+    "ASK_CSV_CACHE_DIR", os.path.join(tempfile.gettempdir(), "ask_your_csv")
+)
+
+# Persistent R worker pool (set R_POOL_SIZE=0 to always spawn a fresh Rscript)
+R_POOL_SIZE = int(os.environ.get("R_POOL_SIZE", "2"))
+R_POOL_MAX_JOBS = int(os.environ.get("R_POOL_MAX_JOBS", "50"))
+R_TIMEOUT = 120
+
+# Copies of uploaded datasets staged for R: total size cap and hours unused
+# before one is removed (datasets of running questions are always kept)
+STAGED_MAX_MB = int(os.environ.get("STAGED_MAX_MB", "5120"))
+STAGED_TTL_HOURS = float(os.environ.get("STAGED_TTL_HOURS", "24"))
+
+# Opt-in persistent R sessions (objects survive across code blocks and questions)
+R_SESSION_MAX_MB = int(os.environ.get("R_SESSION_MAX_MB", "1024"))
+R_SESSION_MAX_LIVE = int(os.environ.get("R_SESSION_MAX_LIVE", "4"))
+
+# Admission control shared by all sessions: concurrent R executions, how long
+# one may wait for a slot, and per-process memory / per-job CPU limits (0 = off).
+# The memory limit is on resident memory, checked while R runs (Linux only)
+R_MAX_CONCURRENT = int(os.environ.get("R_MAX_CONCURRENT", str(max(R_POOL_SIZE, 1))))
+R_QUEUE_TIMEOUT = int(os.environ.get("R_QUEUE_TIMEOUT", "300"))
+R_MEMORY_LIMIT_MB = int(os.environ.get("R_MEMORY_LIMIT_MB", "4096"))
+R_CPU_LIMIT_SECONDS = int(os.environ.get("R_CPU_LIMIT_SECONDS", "300"))
+
+# Plots and tables kept for the chat history and reports
+ARTIFACT_MAX_MB = int(os.environ.get("ARTIFACT_MAX_MB", "1024"))
+ARTIFACT_SESSION_MAX_MB = int(os.environ.get("ARTIFACT_SESSION_MAX_MB", "256"))
+ARTIFACT_SESSION_TTL_HOURS = float(os.environ.get("ARTIFACT_SESSION_TTL_HOURS", "24"))
+
+@st.cache_resource(show_spinner=False)
+def get_artifact_store():
+    """Content-addressed store for R outputs (shared by all sessions)."""
+    return ArtifactStore(
+        os.path.join(CACHE_DIR, "artifacts"),
+        max_bytes=ARTIFACT_MAX_MB * 1024 ** 2,
+        max_session_bytes=ARTIFACT_SESSION_MAX_MB * 1024 ** 2,
+        session_ttl=ARTIFACT_SESSION_TTL_HOURS * 3600,
+    )
+
+@st.cache_resource(show_spinner=False)
+def get_session_store():
+    """Datasets of all sessions, shared by content hash and spilled when idle."""
+    store = SessionStore(
+        os.path.join(CACHE_DIR, "sessions"),
+        max_bytes=SESSION_MEMORY_MB * 1024 ** 2,
+        idle_spill=SESSION_IDLE_MINUTES * 60,
+        session_ttl=SESSION_TTL_HOURS * 3600,
+        # A session's plots and tables go with it, as do staged copies of datasets no session uses
+        on_release=get_artifact_store().release_session,
+        on_drop=get_staging_area().discard,
+    )
+    store.start_sweeper()
+    return store
+
+def session_df():
+    """This session's dataset (reloaded from disk if it was spilled), or None."""
+    return get_session_store().frame(st.session_state.conversation_id)
+
+# Plots: resolution ggsave renders at (at most), width above which R's PNGs
+# are scaled down, and the width a new answer's plots are shown at
+PLOT_DPI = int(os.environ.get("PLOT_DPI", "150"))
+PLOT_MAX_WIDTH = int(os.environ.get("PLOT_MAX_WIDTH", "2400"))
+PLOT_DISPLAY_WIDTH = int(os.environ.get("PLOT_DISPLAY_WIDTH", "1000"))
+
+# R code run before every script: table data emitters and plot defaults
+R_PRELUDE = TABLE_HELPERS_R + plot_helpers_r(PLOT_DPI)
+
+# Plots wider than this are shrunk in exported reports (when enabled)
+REPORT_IMAGE_MAX_WIDTH = int(os.environ.get("REPORT_IMAGE_MAX_WIDTH", "1600"))
+
+# Chat history: turns shown in full, collapsed turns per page, thumbnail width
+HISTORY_RECENT_TURNS = int(os.environ.get("HISTORY_RECENT_TURNS", "3"))
+HISTORY_PAGE_TURNS = int(os.environ.get("HISTORY_PAGE_TURNS", "10"))
+HISTORY_THUMBNAIL_WIDTH = int(os.environ.get("HISTORY_THUMBNAIL_WIDTH", "480"))
+
+# Load only the dataset columns generated code refers to (stateless runs only)
+R_COLUMN_PROJECTION = os.environ.get("R_COLUMN_PROJECTION", "1") != "0"
+
+# Table HTML above this is shown as an interactive dataframe instead
+TABLE_HTML_MAX_KB = int(os.environ.get("TABLE_HTML_MAX_KB", "256"))
+
+# Questions answered in the background, across all sessions of this server
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "8"))
+
+# Stage the dataset, start R and load the data into it right after an upload
+PREWARM_ON_UPLOAD = os.environ.get("PREWARM_ON_UPLOAD", "1") != "0"
+
+# Scripts run with a fresh Rscript attach only the libraries their code calls
+R_LAZY_LIBRARIES = os.environ.get("R_LAZY_LIBRARIES", "1") != "0"
+
+# Check generated code (R's parser in a warm process, columns, functions,
+# saved outputs) before running it
+R_PREFLIGHT = os.environ.get("R_PREFLIGHT", "1") != "0"
+
+# Parallel auto-fix: candidate fixes requested in one completion, and how many
+# candidates may run in R at the same time
+FIX_FANOUT = int(os.environ.get("FIX_FANOUT", "3"))
+FIX_MAX_PARALLEL_RUNS = int(os.environ.get("FIX_MAX_PARALLEL_RUNS", "2"))
+
+# Per-question traces (JSONL) and Prometheus metrics, written to a file and
+# served on http://<host>:METRICS_PORT/metrics when the port is set (0 = off)
+TRACE_LOG = os.environ.get("TRACE_LOG", os.path.join(CACHE_DIR, "traces.jsonl"))
+METRICS_FILE = os.environ.get("METRICS_FILE", os.path.join(CACHE_DIR, "metrics.prom"))
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+
+@st.cache_resource(show_spinner=False)
+def get_telemetry():
+    """Trace log and metrics shared by all sessions (starts the endpoint once)."""
+    telemetry = Telemetry(TRACE_LOG, METRICS_FILE)
+    if METRICS_PORT:
+        try:
+            serve_metrics(telemetry.metrics, METRICS_PORT)
+        except OSError as e:
+            warnings.warn(f"Metrics endpoint not started on port {METRICS_PORT}: {e}")
+    return telemetry
+
+@st.cache_resource(show_spinner=False)
+def get_r_worker_pool(r_exec):
+    """Create the process-wide pool of warm R workers (shared by all sessions)."""
+    pool = RWorkerPool(
+        r_exec,
+        os.path.dirname(sys.executable),
+        size=R_POOL_SIZE,
+        max_jobs=R_POOL_MAX_JOBS,
+        work_dir=os.path.join(CACHE_DIR, "r_pool"),
+        memory_limit=R_MEMORY_LIMIT_MB * 1024 ** 2,
+        cpu_limit=R_CPU_LIMIT_SECONDS,
+        prelude=R_PRELUDE,
+    )
+    pool.warm()
+    return pool
+
+@st.cache_resource(show_spinner=False)
+def get_r_scheduler():
+    """Fair queue that every R execution goes through (shared by all sessions)."""
+    return RScheduler(max_concurrent=R_MAX_CONCURRENT)
+
+@st.cache_resource(show_spinner=False)
+def get_r_session_manager(r_exec):
+    """Registry of per-conversation R sessions (shared by all sessions)."""
+    return RSessionManager(
+        get_r_worker_pool(r_exec),
+        os.path.join(CACHE_DIR, "r_sessions"),
+        max_bytes=R_SESSION_MAX_MB * 1024 ** 2,
+        max_live=R_SESSION_MAX_LIVE,
+    )
+
+def r_session_key():
+    """Identify this conversation's R session; a new upload gets a new one."""
+    return f"{st.session_state.conversation_id}_{st.session_state.get('data_hash', 'nodata')}"
+
+def current_data_hash(df):
+    """Content hash of the dataset, set on upload (computed from ``df`` otherwise)."""
+    if st.session_state.get("data_hash") is None:
+        st.session_state.data_hash = dataset_fingerprint(df)
+    return st.session_state.data_hash
+
+@st.cache_resource(show_spinner=False)
+def get_prewarmer():
+    """Background work started on upload, deduplicated with the question path."""
+    return Prewarmer()
+
+@st.cache_resource(show_spinner=False)
+def get_staging_area():
+    """Datasets staged for R (shared by all sessions), evicted by size and age."""
+    return StagingArea(
+        os.path.join(CACHE_DIR, "datasets"),
+        max_bytes=STAGED_MAX_MB * 1024 ** 2,
+        ttl=STAGED_TTL_HOURS * 3600,
+    )
+
+def get_staged_dataset(df, r_exec):
+    """Stage the dataset for R once per content hash and reuse it afterwards."""
+    data_hash = current_data_hash(df)
+    staging = get_staging_area()
+    prewarmer = get_prewarmer()
+    # Waits for the upload's prewarm if it is already staging this dataset
+    staged = prewarmer.run(("stage", data_hash), stage_r_dataset, staging, df, data_hash, r_exec)
+    if not os.path.exists(staged.loader_path):
+        # Evicted since it was staged: write it again
+        prewarmer.forget(("stage", data_hash))
+        staged = prewarmer.run(("stage", data_hash), stage_r_dataset, staging, df, data_hash, r_exec)
+    return staged
+
+def get_r_exports(r_exec):
+    """Names each analysis and base library exports, or None until they have been read.
+
+    Reading them takes one Rscript run per installation (then a cache file),
+    done in the background; scripts attach every library meanwhile.
+    """
+    if not (R_LAZY_LIBRARIES or R_PREFLIGHT):
+        return None
+    future = get_prewarmer().submit(
+        ("r_exports", r_exec), read_r_exports, r_exec, R_LIBRARIES + BASE_PACKAGES,
+        cache_path=os.path.join(CACHE_DIR, "r_exports.json")
+    )
+    if future.done() and future.exception() is None:
+        return future.result()
+    return None
+
+def get_r_versions(r_exec):
+    """R and package versions, or None until they have been read (in the background)."""
+    if not R_RESULT_CACHE:
+        return None
+    future = get_prewarmer().submit(("r_versions", r_exec), read_r_versions, r_exec, R_LIBRARIES)
+    if future.done() and future.exception() is None:
+        return future.result()
+    return None
+
+@st.cache_resource(show_spinner=False)
+def get_result_cache():
+    """Outputs of earlier successful R runs (shared by all sessions)."""
+    return ResultCache(
+        os.path.join(CACHE_DIR, "results"),
+        max_bytes=RESULT_CACHE_MAX_MB * 1024 ** 2,
+        ttl=RESULT_CACHE_TTL_HOURS * 3600,
+    )
+
+@st.cache_resource(show_spinner=False)
+def get_r_parser(r_exec):
+    """R's parser in a warm, library-free process (shared by all sessions)."""
+    parser = RParser(r_exec, os.path.dirname(sys.executable), os.path.join(CACHE_DIR, "r_parser"))
+    parser.warm()
+    return parser
+
+def stage_r_dataset(staging, df, data_hash, r_exec):
+    """Write the staged files R loads the dataset from (safe from any thread)."""
+    # Only keep a CSV copy when R cannot read Feather
+    r_reads_feather = HAS_PYARROW and r_has_package(r_exec, "arrow")
+    return staging.stage(
+        df,
+        data_hash,
+        feather=r_reads_feather,
+        csv=not r_reads_feather,
+    )
+
+def start_prewarm(df):
+    """Do the first question's setup while the user is still typing it.
+
+    Profiles the dataset, starts the R workers, stages the dataset and loads
+    it into the workers' memory (or the conversation's R session) on
+    background threads. Questions asked meanwhile wait for whatever part is
+    still running instead of repeating it.
+    """
+    if not PREWARM_ON_UPLOAD:
+        return
+    data_hash = current_data_hash(df)
+    prewarmer = get_prewarmer()
+    prewarmer.submit(("profile", data_hash), get_profile, df, data_hash)
     
-    # 2. Automatically find the Conda 'bin' directory (Where Pandoc is located)
-    # Since Python, R, and Pandoc are all located in the same Conda 'bin' directory
-    conda_bin_dir = os.path.dirname(sys.executable)
-    
-    # 3. Create R Script with forced Pandoc configuration
-    r_script = f"""
-# --- PANDOC CONFIG (MANDATORY) ---
-# Force R to find Pandoc in the same directory as Python/R
-conda_dir <- "{conda_bin_dir}"
-Sys.setenv(RSTUDIO_PANDOC = conda_dir)
-Sys.setenv(PATH = paste(conda_dir, Sys.getenv("PATH"), sep=":"))
-
-# Setup working dir
-setwd("{output_dir_r}")
-df <- read.csv("{csv_path_r}")
-
-# Load Libraries
-suppressPackageStartupMessages({{
-    library(ggplot2)
-    library(dplyr)
-    library(gtsummary)
-    library(survival)
-    library(survminer)
-    library(flextable)
-    library(broom.helpers) 
-}})
-
-# User Code
-{code}
-"""
+    r_exec = st.session_state.get('r_path') or get_r_path()
+    if not r_exec:
+        return
+    get_r_exports(r_exec)
+    get_r_versions(r_exec)
+    if R_PREFLIGHT:
+        get_r_parser(r_exec)
+    # Resources are resolved here; the task itself never touches st
+    pool = session = None
+    if R_POOL_SIZE > 0:
+        pool = get_r_worker_pool(r_exec)
+        if st.session_state.get("r_session_mode"):
+            session = get_r_session_manager(r_exec).get(r_session_key())
+    staging = get_staging_area()
     
-    script_path = os.path.join(output_dir, "script.R")
-    with open(script_path, 'w', encoding='utf-8') as f:
-        f.write(r_script)
+    def warm_r():
+        with staging.lease(data_hash):
+            staged = prewarmer.run(("stage", data_hash), stage_r_dataset, staging, df, data_hash, r_exec)
+            if session is not None:
+                return session.preload(staged.loader_path_r, timeout=R_TIMEOUT)
+            if pool is not None:
+                return pool.preload(staged.loader_path_r, timeout=R_TIMEOUT)
     
-    # 4. Find R executable 
+    prewarmer.submit(("r", data_hash, session.session_id if session else None), warm_r)
+
+def prepare_r_runtime(df, cancel=None):
+    """Resolve Rscript, the worker pool and the staged dataset for a question.
+
+    Must be called from the Streamlit script thread; the returned dict can be
+    handed to execute_r_code() in background threads. Setting the ``cancel``
+    event kills any R execution started with it.
+    """
     r_exec = st.session_state.get('r_path')
     if not r_exec: 
         r_exec = get_r_path()
-    
     if not r_exec:
+        return None
+    
+    session = None
+    if R_POOL_SIZE > 0 and st.session_state.get("r_session_mode"):
+        session = get_r_session_manager(r_exec).get(r_session_key())
+    
+    return {
+        'r_exec': r_exec,
+        'df': df,
+        'columns': [str(c) for c in df.columns],
+        'pool': get_r_worker_pool(r_exec) if R_POOL_SIZE > 0 else None,
+        'session': session,
+        # Written once per dataset, shared by every execution
+        'data_loader_r': get_staged_dataset(df, r_exec).loader_path_r,
+        'r_exports': get_r_exports(r_exec),
+        'parser': get_r_parser(r_exec) if R_PREFLIGHT else None,
+        'data_hash': current_data_hash(df),
+        'staging': get_staging_area(),
+        'r_versions': get_r_versions(r_exec),
+        'result_cache': get_result_cache() if R_RESULT_CACHE else None,
+        'cancel': cancel,
+        'scheduler': get_r_scheduler(),
+        # Executions are queued fairly per conversation
+        'owner': st.session_state.conversation_id,
+        'on_wait': None,
+    }
+
+def execute_r_code(code, runtime, output_dir, attempt=0):
+    """Execute R code with a prepared runtime (safe to call from any thread)"""
+    if not runtime:
         return {
             'success': False, 
             'stderr': 'CRITICAL: Rscript not found.',
             'code': code
         }
+    
+    trace = runtime.get('trace', NULL_TRACE)
+    with trace.span("r_run", attempt=attempt) as span:
+        # Identical code on identical data: reuse the earlier run's output
+        cache_key = result_cache_key(code, runtime, output_dir)
+        if cache_key is not None:
+            cached = runtime['result_cache'].get(cache_key, output_dir)
+            if cached is not None:
+                span.set(exit="ok", backend="cache")
+                trace.count("result_cache_hits")
+                return {
+                    'success': True,
+                    'stdout': cached[0],
+                    'stderr': cached[1],
+                    'output_dir': output_dir,
+                    'code': code,
+                    'backend': 'cache'
+                }
+        
+        # Obvious mistakes go to the repair path without waiting for R
+        problem = preflight(code, runtime, attempt) if R_PREFLIGHT else None
+        if problem:
+            span.set(exit="preflight")
+            return {
+                'success': False,
+                'stdout': '',
+                'stderr': problem,
+                'output_dir': output_dir,
+                'code': code,
+                'backend': 'preflight'
+            }
+        
+        # Wait for a free execution slot shared with every other session
+        queued = time.perf_counter()
+        try:
+            with runtime['scheduler'].slot(
+                runtime['owner'],
+                cancel=runtime.get('cancel'),
+                on_wait=runtime.get('on_wait'),
+                timeout=R_QUEUE_TIMEOUT
+            ):
+                span.set(queue_seconds=round(time.perf_counter() - queued, 3))
+                result = _execute_r_code(code, runtime, output_dir)
+        except AdmissionError as e:
+            span.set(exit="rejected")
+            return {
+                'success': False,
+                'stdout': '',
+                'stderr': str(e),
+                'output_dir': output_dir,
+                'code': code
+            }
+        span.set(
+            exit=r_exit_status(result),
+            backend=result.get('backend'),
+            columns=result.get('columns'),
+            libraries=result.get('libraries'),
+        )
+        if result['success']:
+            # Smaller PNGs for the artifact store, the result cache and the browser
+            with trace.span("plots") as plot_span:
+                plots, saved = optimize_plots(output_dir, PLOT_MAX_WIDTH)
+                plot_span.set(plots=plots, bytes_saved=saved)
+        if cache_key is not None and result['success']:
+            runtime['result_cache'].put(
+                cache_key, result['stdout'], result['stderr'], output_dir, exclude=("script.R",)
+            )
+        return result
+
+def result_cache_key(code, runtime, output_dir):
+    """Result cache key for running ``code``, or None if the run must not be cached."""
+    if runtime.get('result_cache') is None or runtime.get('r_versions') is None:
+        return None
+    # Session state, leftovers of an earlier attempt or volatile calls would leak into the entry
+    if runtime.get('session') is not None or os.listdir(output_dir) or not is_cacheable(code):
+        return None
+    return ResultCache.make_key(code, runtime['data_hash'], [runtime['r_versions'], R_PRELUDE])
+
+def preflight(code, runtime, attempt=0):
+    """Problems ``code`` would fail on, as R-style error text, or None."""
+    # A persistent session may hold columns and functions from earlier blocks
+    stateless = runtime.get('session') is None
+    with runtime.get('trace', NULL_TRACE).span("preflight"):
+        return check_code(
+            code,
+            parser=runtime.get('parser'),
+            columns=runtime['columns'] if stateless else None,
+            exports=runtime.get('r_exports') if stateless else None,
+            prelude=R_PRELUDE,
+            # Heuristics only gate a block's first run: a fix that still trips them runs anyway
+            heuristics=attempt == 0,
+        )
+
+def r_exit_status(result):
+    """Outcome label of an R execution: ok, error, timeout or cancelled."""
+    if result['success']:
+        return "ok"
+    stderr = result.get('stderr') or ""
+    if CANCELLED_MESSAGE in stderr:
+        return "cancelled"
+    if "timed out after" in stderr:
+        return "timeout"
+    return "error"
+
+def _execute_r_code(code, runtime, output_dir):
+    output_dir_r = output_dir.replace("\\", "/")
+    script_path = os.path.join(output_dir, "script.R")
+    
+    # Persistent session: objects from earlier blocks and questions are kept
+    if runtime.get('session') is not None:
+        with open(script_path, 'w', encoding='utf-8') as f:
+            f.write(build_r_script(code, runtime['data_loader_r'], output_dir_r, preamble=False, session=True))
+        try:
+            success, stdout, stderr, note = runtime['session'].run(
+                script_path, output_dir, timeout=R_TIMEOUT, cancel=runtime.get('cancel')
+            )
+            return {
+                'success': success,
+                'stdout': stdout,
+                'stderr': stderr,
+                'output_dir': output_dir,
+                'code': code,
+                'session_note': note,
+                'backend': 'session'
+            }
+        except RWorkerError:
+            # Could not start the session's worker: run statelessly instead
+            pass
+    
+    # Load only the columns the code uses; retry with all of them if that was wrong
+    columns = projected_columns(code, runtime)
+    result = _run_r_script(code, runtime, output_dir, columns)
+    if columns is not None and not result['success'] and is_missing_column_error(result['stderr']):
+        runtime.get('trace', NULL_TRACE).count("projection_retries")
+        columns = None
+        result = _run_r_script(code, runtime, output_dir, None)
+    result['columns'] = len(columns) if columns is not None else len(runtime['columns'])
+    return result
+
+def projected_columns(code, runtime):
+    """Dataset columns to load for ``code``, or None for all of them."""
+    if not R_COLUMN_PROJECTION:
+        return None
+    return referenced_columns(code, runtime['columns'])
+
+def _run_r_script(code, runtime, output_dir, columns):
+    output_dir_r = output_dir.replace("\\", "/")
+    script_path = os.path.join(output_dir, "script.R")
+    
+    # Prefer a warm worker: libraries and Pandoc config are already loaded
+    if runtime['pool'] is not None:
+        with open(script_path, 'w', encoding='utf-8') as f:
+            f.write(build_r_script(code, runtime['data_loader_r'], output_dir_r, preamble=False, columns=columns))
+        try:
+            success, stdout, stderr = runtime['pool'].run(
+                script_path, output_dir, timeout=R_TIMEOUT, cancel=runtime.get('cancel'),
+                dataset=runtime['data_loader_r']
+            )
+            return {
+                'success': success,
+                'stdout': stdout,
+                'stderr': stderr,
+                'output_dir': output_dir,
+                'code': code,
+                'backend': 'pool'
+            }
+        except RWorkerError:
+            # Pool unavailable (e.g. workers cannot start): fall back to Rscript
+            pass
+    
+    # A fresh Rscript attaches only the libraries the code calls; all of them if that was wrong
+    libraries = needed_libraries(code, runtime)
+    result = _run_rscript(code, runtime, output_dir, columns, libraries)
+    if libraries is not None and not result['success'] and is_missing_function_error(result['stderr']):
+        runtime.get('trace', NULL_TRACE).count("library_retries")
+        libraries = None
+        result = _run_rscript(code, runtime, output_dir, columns, None)
+    result['libraries'] = "all" if libraries is None else ",".join(libraries) or "none"
+    return result
+
+def needed_libraries(code, runtime):
+    """Libraries a fresh Rscript must attach for ``code``, or None for all of them."""
+    if not R_LAZY_LIBRARIES:
+        return None
+    return required_libraries(code, runtime.get('r_exports'), prelude=R_PRELUDE)
+
+def _run_rscript(code, runtime, output_dir, columns, libraries):
+    output_dir_r = output_dir.replace("\\", "/")
+    script_path = os.path.join(output_dir, "script.R")
+    
+    # Create R Script with forced Pandoc configuration
+    with open(script_path, 'w', encoding='utf-8') as f:
+        f.write(build_r_script(
+            code, runtime['data_loader_r'], output_dir_r, columns=columns,
+            conda_bin_dir=os.path.dirname(sys.executable), prelude=R_PRELUDE,
+            libraries=libraries
+        ))
 
     try:
-        # Run R script
-        result = subprocess.run(
-            [r_exec, script_path],
-            capture_output=True,
-            text=True,
-            timeout=120, # Increase timeout to 2 minutes
-            cwd=output_dir
+        # Run R script (the whole process tree is killed on timeout or cancel)
+        success, stdout, stderr = run_script_once(
+            runtime['r_exec'],
+            script_path,
+            output_dir,
+            timeout=R_TIMEOUT, # Increase timeout to 2 minutes
+            cancel=runtime.get('cancel'),
+            memory_limit=R_MEMORY_LIMIT_MB * 1024 ** 2,
+            cpu_limit=R_CPU_LIMIT_SECONDS
         )
         
         return {
-            'success': result.returncode == 0,
-            'stdout': result.stdout,
-            'stderr': result.stderr,
+            'success': success,
+            'stdout': stdout,
+            'stderr': stderr,
             'output_dir': output_dir,
-            'code': code
+            'code': code,
+            'backend': 'rscript'
         }
     except Exception as e:
         return {
@@ -163,296 +668,922 @@ suppressPackageStartupMessages({{
             'stdout': '',
             'stderr': str(e),
             'output_dir': output_dir,
-            'code': code
+            'code': code,
+            'backend': 'rscript'
         }
 
-# Helper function to extract HTML tables from R output
-def extract_html_from_output(output_dir):
-    """Extract HTML content from files in output directory"""
-    html_files = []
-    
-    # Look for HTML files
-    for file in os.listdir(output_dir):
-        if file.endswith('.html'):
-            file_path = os.path.join(output_dir, file)
-            with open(file_path, 'r', encoding='utf-8') as f:
-                html_content = f.read()
-                
-                # Extract style and table content from the full HTML
-                # gtsave creates a complete HTML document, we need just the table part
-                style_match = re.search(r'<style>(.*?)</style>', html_content, re.DOTALL)
-                table_match = re.search(r'<div id="[^"]*"[^>]*>.*?<table.*?</table>.*?</div>', html_content, re.DOTALL)
-                
-                if style_match and table_match:
-                    # Combine style and table
-                    clean_html = f"<style>{style_match.group(1)}</style>\n{table_match.group(0)}"
-                    html_files.append(clean_html)
-                else:
-                    # Fallback: use the full HTML content
-                    html_files.append(html_content)
+@st.cache_resource(show_spinner=False)
+def get_llm_cache():
+    """Response cache shared by all sessions of this server."""
+    return LLMCache(
+        os.path.join(CACHE_DIR, "llm_cache.sqlite"),
+        max_disk_bytes=LLM_CACHE_MAX_MB * 1024 ** 2,
+        ttl=LLM_CACHE_TTL_HOURS * 3600,
+    )
+
+def llm_cache_key(messages, data_hash, **params):
+    """Cache key for a completion request against a dataset."""
+    return LLMCache.make_key(OPENAI_MODEL, messages, data_hash, **params)
+
+def cached_completion(turn, messages, temperature, max_tokens, lookup=True, purpose="answer"):
+    """Non-streaming chat completion that reads and fills the response cache.
+
+    Returns ``(reply, from_cache)``. Turning off "Reuse cached answers" (or
+    passing ``lookup=False`` when the caller already looked) skips the lookup
+    but still stores the fresh reply.
+    """
+    cache = turn['llm_cache']
+    trace = turn.get('trace', NULL_TRACE)
+    key = llm_cache_key(messages, turn['data_hash'], temperature=temperature, max_tokens=max_tokens)
+    if lookup and turn['use_cache']:
+        cached = cache.get(key)
+        if cached is not None:
+            trace.add_span("llm", time.perf_counter(), time.perf_counter(), purpose=purpose, cached=True)
+            return cached, True
+    
+    with trace.span("llm", purpose=purpose, cached=False) as span:
+        response = client.chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens
+        )
+        record_usage(trace, span, response.usage)
+        span.set(finish_reason=response.choices[0].finish_reason)
+    reply = response.choices[0].message.content
+    # Truncated replies are not worth replaying
+    if reply and response.choices[0].finish_reason != "length":
+        cache.put(key, reply)
+    return reply, False
+
+def cached_completions(turn, messages, temperature, max_tokens, n, purpose="fix"):
+    """Like cached_completion(), for ``n`` alternative replies from one request."""
+    cache = turn['llm_cache']
+    trace = turn.get('trace', NULL_TRACE)
+    key = llm_cache_key(messages, turn['data_hash'], temperature=temperature, max_tokens=max_tokens, n=n)
+    if turn['use_cache']:
+        cached = cache.get(key)
+        if cached is not None:
+            trace.add_span("llm", time.perf_counter(), time.perf_counter(), purpose=purpose, cached=True)
+            return json.loads(cached), True
     
-    return html_files
+    with trace.span("llm", purpose=purpose, cached=False, n=n) as span:
+        response = client.chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            n=n
+        )
+        record_usage(trace, span, response.usage)
+    replies = [
+        choice.message.content for choice in response.choices
+        if choice.message.content and choice.finish_reason != "length"
+    ]
+    if replies:
+        cache.put(key, json.dumps(replies))
+    return replies, False
+
+def stream_completion(messages, temperature, max_tokens, finish, trace=NULL_TRACE):
+    """Yield reply deltas from a streaming chat completion.
+
+    ``finish["reason"]`` is set to the final finish_reason once the stream ends.
+    """
+    started = time.perf_counter()
+    first_token = None
+    usage = None
+    stream = client.chat.completions.create(
+        model=OPENAI_MODEL,
+        messages=messages,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        stream=True,
+        # The last chunk reports token usage
+        stream_options={"include_usage": True}
+    )
+    try:
+        for chunk in stream:
+            if getattr(chunk, "usage", None) is not None:
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            if choice.finish_reason:
+                finish["reason"] = choice.finish_reason
+            if choice.delta.content:
+                if first_token is None:
+                    first_token = time.perf_counter()
+                yield choice.delta.content
+    finally:
+        # Closing the generator early (cancel) also drops the HTTP stream
+        stream.close()
+        attrs = {"purpose": "answer", "cached": False, "finish_reason": finish.get("reason")}
+        if first_token is not None:
+            attrs["ttft_ms"] = round((first_token - started) * 1000, 1)
+        attrs.update(record_usage(trace, None, usage))
+        trace.add_span("llm", started, time.perf_counter(), **attrs)
+
+def record_usage(trace, span, usage):
+    """Add a completion's token usage to the trace counters (and ``span``)."""
+    if usage is None:
+        return {}
+    tokens = {
+        "prompt_tokens": usage.prompt_tokens,
+        "completion_tokens": usage.completion_tokens,
+    }
+    trace.count("llm_prompt_tokens", usage.prompt_tokens)
+    trace.count("llm_completion_tokens", usage.completion_tokens)
+    if span is not None:
+        span.set(**tokens)
+    return tokens
+
+@st.cache_resource(show_spinner=False)
+def get_repair_engine():
+    """Local rule-based repairs plus patches learned from past LLM fixes."""
+    return RepairEngine(store=PatchStore(os.path.join(CACHE_DIR, "repair_patches.sqlite")))
 
 # Helper function to ask AI to fix R code
-def get_fixed_r_code(original_code, error_msg, data_context):
+def get_fixed_r_code(original_code, error_msg, turn, ui):
     """Ask GPT to fix the R code based on error message"""
-    fix_prompt = f"""The following R code produced an error. Please fix it and return ONLY the corrected R code without explanation.
-
-Original code:
-```r
-{original_code}
-```
-
-Error message:
-{error_msg}
-
-Data context:
-{data_context}
-
-Requirements:
-- Return ONLY valid R code in a ```r code block
-- Fix the error but keep the same intent
-- Use forward slashes (/) for any file paths
-- Ensure all column names are correctly referenced
-- The dataframe is called 'df'
-- Libraries available: ggplot2, dplyr, gtsummary, survival, survminer, flextable
-- For Kaplan-Meier plots, MUST load library(survminer) before using ggsurvplot()
-- For ggsurvplot objects, save using: ggsave("plot.png", p$plot, width=10, height=6)
-- For gtsummary tables, use correct syntax: as_flex_table(table) %>% save_as_html(path = "table.html")
-- IMPORTANT: Always use pipe operator (%>%) and path parameter in save_as_html()
-"""
+    prompt = prompt_builder.fix(
+        original_code, error_msg, turn['data_context'], warnings=code_warnings(original_code)
+    )
+    ui.caption(f"📏 Fix prompt: {prompt.describe()}")
     
     try:
-        response = client.chat.completions.create(
-            model="gpt-4.1",
-            messages=[
-                {"role": "system", "content": "You are an R debugging expert. Fix the code and return ONLY the corrected R code."},
-                {"role": "user", "content": fix_prompt}
-            ],
+        fixed_reply, _ = cached_completion(
+            turn,
+            prompt.messages,
             temperature=0.1,
-            max_tokens=1000
+            max_tokens=1000,
+            purpose="fix"
         )
         
-        fixed_reply = response.choices[0].message.content
-        
-        # Extract code from response
-        if "```r" in fixed_reply or "```R" in fixed_reply:
-            code_blocks = fixed_reply.replace("```R", "```r").split("```r")
-            if len(code_blocks) > 1:
-                fixed_code = code_blocks[1].split("```")[0].strip()
-                return fixed_code
-        
-        return None
+        return extract_fixed_code(fixed_reply)
     except Exception as e:
-        st.warning(f"Could not auto-fix code: {str(e)}")
+        ui.warning(f"Could not auto-fix code: {str(e)}")
         return None
 
-# Helper function to convert image to base64
-def image_to_base64(image_path):
-    """Convert image file to base64 string"""
+def extract_fixed_code(reply):
+    """The R code block of a fix reply, or None."""
+    if reply and ("```r" in reply or "```R" in reply):
+        code_blocks = reply.replace("```R", "```r").split("```r")
+        if len(code_blocks) > 1:
+            return code_blocks[1].split("```")[0].strip()
+    return None
+
+def get_fix_candidates(prompt, turn, n):
+    """Up to ``n`` distinct fixed versions of the code, from one completion request."""
+    # A higher temperature keeps the candidates from all being the same fix
+    replies, _ = cached_completions(turn, prompt.messages, temperature=0.7, max_tokens=1000, n=n, purpose="fix")
+    return list(dict.fromkeys(code for code in map(extract_fixed_code, replies) if code))
+
+def run_fix_round(failed, turn, ui, attempt, local_code=None):
+    """Try several fixes of a failed run side by side; the first to succeed wins.
+
+    The local repair (if any) starts right away and the LLM's candidates join
+    as soon as their single completion arrives. Each candidate runs in its own
+    working directory, at most FIX_MAX_PARALLEL_RUNS at a time; once one
+    succeeds the others are cancelled. Returns ``(result, output_dir, source)``
+    for the winner, else for the first failure, or None if there was nothing
+    to run.
+    """
+    runtime = turn['runtime']
+    scope = CancelScope(turn['cancel'])
+    candidate_runtime = dict(runtime, cancel=scope)
+    r_executor = ThreadPoolExecutor(max_workers=max(FIX_MAX_PARALLEL_RUNS, 1))
+    llm_executor = ThreadPoolExecutor(max_workers=1)
+    runs = {}  # future -> (source, output_dir)
+    tried = set()
+    
+    def launch(code, source):
+        if code in tried:
+            return
+        tried.add(code)
+        output_dir = tempfile.mkdtemp()
+        future = r_executor.submit(execute_r_code, code, candidate_runtime, output_dir, attempt)
+        runs[future] = (source, output_dir)
+    
+    if local_code:
+        launch(local_code, "local")
+    prompt = prompt_builder.fix(
+        failed['code'], failed['stderr'], turn['data_context'], warnings=code_warnings(failed['code'])
+    )
+    ui.caption(f"📏 Fix prompt: {prompt.describe()} · {FIX_FANOUT} candidates")
+    llm = llm_executor.submit(get_fix_candidates, prompt, turn, FIX_FANOUT)
+    
+    pending = set(runs) | {llm}
+    winner = failure = None
     try:
-        with open(image_path, 'rb') as img_file:
-            return base64.b64encode(img_file.read()).decode('utf-8')
-    except:
-        return None
+        while pending and winner is None and not turn['cancel'].is_set():
+            done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future is llm:
+                    try:
+                        codes = future.result()
+                    except Exception as e:
+                        ui.warning(f"Could not auto-fix code: {str(e)}")
+                        codes = []
+                    before = set(runs)
+                    for code in codes:
+                        launch(code, "llm")
+                    pending |= set(runs) - before
+                    continue
+                result = future.result()
+                source, output_dir = runs[future]
+                if result['success'] and winner is None:
+                    winner = (result, output_dir, source)
+                elif failure is None and r_exit_status(result) == "error":
+                    failure = (result, output_dir, source)
+    finally:
+        # Stop the losers (queued ones never start); a late LLM reply is dropped
+        scope.set()
+        for future in runs:
+            future.cancel()
+        r_executor.shutdown(wait=True)
+        llm_executor.shutdown(wait=False)
+    
+    chosen = winner or failure
+    if chosen is None:
+        for future, (source, output_dir) in runs.items():
+            if future.done() and not future.cancelled():
+                chosen = (future.result(), output_dir, source)
+                break
+    for source, output_dir in runs.values():
+        if chosen is None or output_dir != chosen[1]:
+            shutil.rmtree(output_dir, ignore_errors=True)
+    return chosen
+
+@st.cache_resource(show_spinner=False)
+def get_report_image_encoder(max_width):
+    """Encoded report images, cached by content hash across exports."""
+    return ImageEncoder(max_width=max_width)
 
 # Helper function for export
-def export_conversation():
-    """Export conversation history as HTML with images and tables"""
+def export_conversation(as_zip=False, downsize_images=True):
+    """Write the conversation report (HTML, or zip with image files) and return its path"""
     if not st.session_state.messages:
         return None
     
-    html_content = f"""
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <meta charset="UTF-8">
-        <style>
-            body {{ 
-                font-family: Arial, sans-serif; 
-                margin: 40px; 
-                background-color: #f9f9f9;
-            }}
-            h1 {{ 
-                color: #333; 
-                border-bottom: 3px solid #4CAF50;
-                padding-bottom: 10px;
-            }}
-            h2 {{ 
-                color: #666; 
-                margin-top: 30px; 
-                border-bottom: 1px solid #ddd;
-                padding-bottom: 5px;
-            }}
-            .question {{ 
-                background-color: #e3f2fd; 
-                padding: 15px; 
-                border-radius: 8px; 
-                margin: 15px 0;
-                border-left: 4px solid #2196F3;
-            }}
-            .answer {{ 
-                background-color: #fff;
-                padding: 15px; 
-                margin: 15px 0;
-                border-radius: 8px;
-                border-left: 4px solid #4CAF50;
-                box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-            }}
-            .metadata {{ 
-                color: #999; 
-                font-size: 14px; 
-            }}
-            .output-section {{
-                background-color: #f5f5f5;
-                padding: 10px;
-                border-radius: 5px;
-                margin: 10px 0;
-            }}
-            .output-label {{
-                font-weight: bold;
-                color: #555;
-                margin-bottom: 5px;
-            }}
-            code {{ 
-                background-color: #f5f5f5; 
-                padding: 2px 4px; 
-                border-radius: 3px;
-                font-family: 'Courier New', monospace;
-            }}
-            pre {{ 
-                background-color: #2d2d2d; 
-                color: #f8f8f2;
-                padding: 15px; 
-                border-radius: 5px; 
-                overflow-x: auto;
-                font-family: 'Courier New', monospace;
-            }}
-            pre code {{
-                background-color: transparent;
-                color: #f8f8f2;
-            }}
-            .plot-image {{
-                max-width: 100%;
-                height: auto;
-                margin: 15px 0;
-                border-radius: 5px;
-                box-shadow: 0 2px 8px rgba(0,0,0,0.1);
-            }}
-            .table-container {{
-                margin: 15px 0;
-                overflow-x: auto;
-            }}
-            table {{
-                border-collapse: collapse;
-                width: 100%;
-                margin: 10px 0;
-            }}
-            .auto-fix-badge {{
-                background-color: #ff9800;
-                color: white;
-                padding: 3px 8px;
-                border-radius: 12px;
-                font-size: 12px;
-                margin-left: 10px;
-            }}
-        </style>
-    </head>
-    <body>
-        <h1>📊 Data Analysis Report (R Edition)</h1>
-        <p class="metadata">Generated on: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</p>
-    """
+    reports_dir = os.path.join(CACHE_DIR, "reports")
+    os.makedirs(reports_dir, exist_ok=True)
+    encoder = get_report_image_encoder(REPORT_IMAGE_MAX_WIDTH if downsize_images else None)
+    path = os.path.join(
+        reports_dir, f"{st.session_state.conversation_id}.{'zip' if as_zip else 'html'}"
+    )
+    writer = write_report_zip if as_zip else write_report_html
+    return writer(path, st.session_state.messages, get_artifact_store(), session_df(), encoder)
+
+# Output sinks for the question pipeline: LiveUI draws into the page directly,
+# jobs.JobUI records the same calls for a background job to replay
+class LiveUI:
+    """Draw pipeline output straight into the current chat message."""
     
-    if st.session_state.df is not None:
-        html_content += f"""
-        <h2>📋 Dataset Information</h2>
-        <ul>
-            <li><strong>Total Rows:</strong> {st.session_state.df.shape[0]:,}</li>
-            <li><strong>Total Columns:</strong> {st.session_state.df.shape[1]}</li>
-            <li><strong>Column Names:</strong> {', '.join(st.session_state.df.columns)}</li>
-        </ul>
-        """
-    
-    html_content += "<h2>💬 Analysis Conversation</h2>"
-    
-    for idx, msg in enumerate(st.session_state.messages, 1):
-        if msg["role"] == "user":
-            html_content += f'<div class="question"><strong>❓ Question {idx//2 + 1}:</strong> {msg["content"]}</div>'
+    def __init__(self, placeholder):
+        self._placeholder = placeholder
+    
+    def reply(self, text, done=True):
+        self._placeholder.markdown(text if done else text + "▌")
+    
+    def stage(self, text):
+        pass
+    
+    def __getattr__(self, name):
+        return getattr(st, name)
+
+def raise_if_cancelled(turn):
+    if turn['cancel'].is_set():
+        raise JobCancelled()
+
+# Helper function to run the auto-fix loop and display the result of one code block
+def finish_code_block(block, turn, ui):
+    """Finish a dispatched R code block: retry with fixes, render, record message fields"""
+    runtime = turn['runtime']
+    trace = turn.get('trace', NULL_TRACE)
+    output_dir = block["output_dir"]
+    try:
+        # First attempt (may already have run in the background)
+        if block["future"] is not None:
+            result = block["future"].result()
         else:
-            # Add auto-fix badge if applicable
-            fix_badge = ""
-            if "fixed" in msg and msg["fixed"]:
-                fix_badge = f'<span class="auto-fix-badge">✨ Auto-fixed after {msg["retries"]} attempt(s)</span>'
+            result = execute_r_code(block["code"], runtime, output_dir)
+        
+        # If failed, try to auto-fix (max 3 retries, or as many rounds of
+        # parallel candidates; a persistent session runs one thing at a time)
+        parallel = (
+            turn.get('parallel_fixes') and FIX_FANOUT > 1
+            and runtime is not None and runtime.get('session') is None
+        )
+        max_retries = -(-3 // FIX_FANOUT) if parallel else 3
+        retry_count = 0
+        
+        if result.get('session_note'):
+            ui.info(f"🧠 {result['session_note']}")
+        
+        repair_engine = turn['repair_engine']
+        repair_context = RepairContext(runtime['df']) if runtime else None
+        tried_patches = set()  # learned patches are tried once per block
+        llm_fix = None
+        
+        while not result['success'] and retry_count < max_retries:
+            raise_if_cancelled(turn)
+            retry_count += 1
+            ui.stage(f"Auto-fixing code (attempt {retry_count}/{max_retries})")
+            ui.warning(f"⚠️ Execution failed. Auto-fixing code (Attempt {retry_count}/{max_retries})...")
             
-            content = msg["content"].replace("```r", "<pre><code class='language-r'>").replace("```", "</code></pre>")
-            html_content += f'<div class="answer"><strong>💡 Analysis:</strong>{fix_badge}<br><br>{content}'
+            trace.count("retries")
+            if parallel:
+                with trace.span("fix", attempt=retry_count, parallel=True) as fix_span:
+                    local_code, fix_source = None, None
+                    if repair_context is not None:
+                        local_code, fix_source = repair_engine.repair(
+                            result['code'], result['stderr'], repair_context, tried=tried_patches
+                        )
+                    ui.info(
+                        f"🔧 Trying {'a local fix (' + fix_source + ') and ' if local_code else ''}"
+                        f"up to {FIX_FANOUT} suggested fixes in parallel..."
+                    )
+                    failed = result
+                    outcome = run_fix_round(failed, turn, ui, retry_count, local_code)
+                    raise_if_cancelled(turn)
+                    if outcome is None:
+                        fix_span.set(source="failed")
+                        trace.count("fix_failed")
+                        ui.warning("Could not generate fixed code. Stopping retries.")
+                        break
+                    result, candidate_dir, source = outcome
+                    fix_span.set(source=source, success=result['success'])
+                    trace.count(f"fix_{source}")
+                # The chosen candidate's outputs become this block's
+                shutil.rmtree(output_dir, ignore_errors=True)
+                shutil.move(candidate_dir, output_dir)
+                result['output_dir'] = output_dir
+                if result['success']:
+                    ui.info(f"🔧 The {'local' if source == 'local' else 'suggested'} fix worked")
+                    llm_fix = (failed['stderr'], failed['code'], result['code']) if source == "llm" else None
+                continue
             
-            # Add text output if exists
-            if "output" in msg and msg["output"]:
-                html_content += f'''
-                <div class="output-section">
-                    <div class="output-label">📄 R Console Output:</div>
-                    <pre><code>{msg["output"]}</code></pre>
-                </div>
-                '''
+            with trace.span("fix", attempt=retry_count) as fix_span:
+                # Known error signatures are repaired locally, without a GPT round trip
+                fixed_code, fix_source = None, None
+                if repair_context is not None:
+                    fixed_code, fix_source = repair_engine.repair(
+                        result['code'], result['stderr'], repair_context, tried=tried_patches
+                    )
+                
+                if fixed_code:
+                    ui.info(f"🔧 Running locally fixed code ({fix_source})...")
+                    llm_fix = None
+                    fix_span.set(source="local", rule=fix_source)
+                    trace.count("fix_local")
+                else:
+                    # Get fixed code from AI
+                    fixed_code = get_fixed_r_code(
+                        result['code'], 
+                        result['stderr'], 
+                        turn,
+                        ui
+                    )
+                    if fixed_code:
+                        ui.info(f"🔧 Running fixed code...")
+                        llm_fix = (result['stderr'], result['code'], fixed_code)
+                        fix_span.set(source="llm")
+                        trace.count("fix_llm")
+                    else:
+                        fix_span.set(source="failed")
+                        trace.count("fix_failed")
             
-            # Add executed R code if exists
-            if "code" in msg:
-                code_label = "📝 Executed R Code" if "error" not in msg else "⚠️ Failed R Code"
-                code_class = "success" if "error" not in msg else "error"
-                html_content += f'''
-                <div class="output-section">
-                    <div class="output-label">{code_label}:</div>
-                    <pre><code class="language-r">{msg["code"]}</code></pre>
-                </div>
-                '''
+            if fixed_code:
+                raise_if_cancelled(turn)
+                result = execute_r_code(fixed_code, runtime, output_dir, attempt=retry_count)
+                if result.get('session_note'):
+                    ui.info(f"🧠 {result['session_note']}")
+            else:
+                ui.warning("Could not generate fixed code. Stopping retries.")
+                break
+        
+        raise_if_cancelled(turn)
+        
+        # Remember what the LLM changed so the same error is fixed locally next time
+        if result['success'] and llm_fix is not None:
+            repair_engine.learn(*llm_fix)
+        
+        if result['success']:
+            # Extract tables and plots into the artifact store (not the session)
+            artifacts = turn['artifacts']
+            with trace.span("extract_artifacts") as span:
+                tables = extract_tables(output_dir, max_table_bytes=TABLE_HTML_MAX_KB * 1024)
+                shown_tables = []
+                saved_tables = []
+                for table in tables:
+                    if table["html"] is not None:
+                        shown_tables.append(("html", table["html"]))
+                        saved_tables.append(artifacts.put_text(table["html"], turn['session_id']))
+                    elif table["data_path"] is not None:
+                        # Too large for HTML: show the table's data in a virtualized grid
+                        artifact_id = artifacts.put_file(table["data_path"], turn['session_id'])
+                        shown_tables.append(("data", artifact_id))
+                        saved_tables.append(artifact_id)
+                    else:
+                        shown_tables.append(("skipped", table["name"]))
                 
-                # Show error if exists
-                if "error" in msg:
-                    html_content += f'''
-                    <div class="output-section" style="background-color: #ffebee;">
-                        <div class="output-label" style="color: #c62828;">❌ Error Message:</div>
-                        <pre><code>{msg["error"]}</code></pre>
-                    </div>
-                    '''
+                # Look for saved plots (identical plots are stored once)
+                plot_files = [f for f in os.listdir(output_dir) if f.endswith('.png')]
+                saved_plots = [
+                    artifacts.put_file(os.path.join(output_dir, plot_file), turn['session_id'])
+                    for plot_file in plot_files
+                ]
+                span.set(tables=len(tables), plots=len(saved_plots))
             
-            # Add HTML tables if exists
-            if "html_tables" in msg and msg["html_tables"]:
-                html_content += '<div class="table-container">'
-                html_content += '<div class="output-label">📊 Table Results:</div>'
-                for table_html in msg["html_tables"]:
-                    html_content += table_html
-                html_content += '</div>'
+            with trace.span("render"):
+                # Display success message if retries were needed
+                if retry_count > 0:
+                    ui.success(f"✅ Code executed successfully after {retry_count} fix attempt(s)!")
+                if result.get('backend') == 'cache':
+                    ui.caption("⚡ Same code and data as an earlier run: its output was reused")
+                
+                # Show the executed code
+                ui.subheader("📝 Executed R Code", divider="green")
+                ui.code(result['code'], language="r")
+                
+                # Display text output
+                if result['stdout']:
+                    ui.success("R Output:")
+                    ui.text(result['stdout'])
+                
+                if shown_tables:
+                    ui.success("📊 Table Output:")
+                for kind, value in shown_tables:
+                    if kind == "html":
+                        ui.markdown(value, unsafe_allow_html=True)
+                    elif kind == "data":
+                        ui.dataframe(read_table_data(artifacts.path(value)), hide_index=True)
+                    else:
+                        ui.caption(f"📊 {value} is larger than {TABLE_HTML_MAX_KB} KB and was not displayed")
+                
+                # Full resolution is one click away in the history and in reports
+                for artifact_id in saved_plots:
+                    ui.image(artifacts.thumbnail(artifact_id, PLOT_DISPLAY_WIDTH))
             
-            # Add plot images if exists (convert to base64)
-            if "plot_images" in msg and msg["plot_images"]:
-                html_content += '<div class="output-label">📈 Visualizations:</div>'
-                for img_path in msg["plot_images"]:
-                    if os.path.exists(img_path):
-                        img_base64 = image_to_base64(img_path)
-                        if img_base64:
-                            html_content += f'<img src="data:image/png;base64,{img_base64}" class="plot-image" alt="Plot"/>'
+            # Message fields for session state (content is added by the caller)
+            msg_data = {}
+            if len((result['stdout'] or "").encode("utf-8")) > MESSAGE_INLINE_MAX_KB * 1024:
+                # Long console output stays on disk instead of in session state
+                msg_data["output_artifact"] = artifacts.put_text(
+                    result['stdout'], turn['session_id'], ext=".txt"
+                )
+            elif result['stdout']:
+                msg_data["output"] = result['stdout']
+            if saved_tables:
+                msg_data["table_artifacts"] = saved_tables
+            if saved_plots:
+                msg_data["plot_artifacts"] = saved_plots
+            if retry_count > 0:
+                msg_data["fixed"] = True
+                msg_data["retries"] = retry_count
+            msg_data["code"] = result['code']  # Save code to session state
+        else:
+            ui.error(f"❌ R Execution Error (failed after {retry_count} fix attempt(s)):")
+            ui.code(result['stderr'], language="text")
+            
+            # Show the code that failed with subheader
+            ui.subheader("⚠️ Failed R Code", divider="red")
+            ui.code(result['code'], language="r")
             
-            html_content += '</div>'
-    
-    html_content += """
-    <hr style="margin-top: 40px;">
-    <p class="metadata" style="text-align: center;">
-        Generated by Ask Your CSV (R Edition) | Powered by R, ggplot2, gtsummary, and flextable
-    </p>
-    </body>
-    </html>
+            ui.info("💡 Tips:\n- Try rephrasing your question\n- Check if column names are correct\n- Ensure data types are appropriate")
+            
+            msg_data = {
+                "code": result['code'],  # Save failed code too
+                "error": result['stderr']
+            }
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+    
+    # Applied to st.session_state by the script thread once the turn is over
+    if runtime and runtime.get('session') is not None:
+        turn['state_updates']['r_session_objects'] = runtime['session'].objects
+    
+    block["message"] = msg_data
+    return msg_data
+
+def prepare_turn(prompt, data_context, df, trace=NULL_TRACE):
+    """Collect everything answering one question needs from the script thread.
+
+    The pipeline below only reads this dict (never st.session_state), so it
+    can run on a background job thread.
+    """
+    cancel = threading.Event()
+    # Staging the dataset and reserving R happen on this thread
+    with trace.span("prepare_runtime"):
+        runtime = prepare_r_runtime(df, cancel=cancel)
+    if runtime:
+        runtime['trace'] = trace
+    return {
+        'prompt': prompt,
+        'messages': prompt.messages,
+        'data_context': data_context,
+        'runtime': runtime,
+        'cancel': cancel,
+        'data_hash': st.session_state.get("data_hash"),
+        'use_cache': st.session_state.get("use_llm_cache", True),
+        'stream': st.session_state.get("stream_responses", True),
+        'llm_cache': get_llm_cache(),
+        'repair_engine': get_repair_engine(),
+        'parallel_fixes': st.session_state.get("parallel_fixes", False),
+        'artifacts': get_artifact_store(),
+        'session_id': st.session_state.conversation_id,
+        'trace': trace,
+        'telemetry': get_telemetry(),
+        'state_updates': {},
+    }
+
+def answer_question(job, ui, turn):
+    """Ask the model, run its R code blocks and return the assistant messages.
+
+    ``job`` is the background job running the pipeline (None in the
+    foreground); output goes through ``ui`` rather than ``st``. The turn's
+    trace is recorded however the pipeline ends.
+    """
+    status = "failed"
+    runtime = turn['runtime']
+    try:
+        # The staged dataset must survive eviction until the question is answered
+        with runtime['staging'].lease(runtime['data_hash']) if runtime else nullcontext():
+            messages = _answer_question(job, ui, turn)
+        status = "ok"
+        return messages
+    except JobCancelled:
+        status = "cancelled"
+        raise
+    finally:
+        turn['state_updates']['last_trace'] = turn['telemetry'].record(turn['trace'], status)
+
+def _answer_question(job, ui, turn):
+    if job is not None:
+        job.state_updates = turn['state_updates']
+    runtime = turn['runtime']
+    if runtime:
+        runtime['on_wait'] = lambda position: ui.stage(
+            f"Waiting for a free R slot (position {position} in queue)" if position
+            else "Running R code"
+        )
+    messages = turn['messages']
+    code_blocks = []
+    
+    # Identical questions on the same dataset reuse an earlier reply
+    cache_key = llm_cache_key(messages, turn['data_hash'], temperature=0.1, max_tokens=1500)
+    cached_reply = None
+    if turn['use_cache']:
+        cached_reply = turn['llm_cache'].get(cache_key)
+    if cached_reply is not None:
+        turn['trace'].add_span("llm", time.perf_counter(), time.perf_counter(), purpose="answer", cached=True)
+        ui.caption("⚡ Answer served from cache")
+    else:
+        ui.caption(f"📏 Prompt: {turn['prompt'].describe()}")
+    
+    ui.stage("Writing the answer")
+    try:
+        if turn['stream']:
+            # Stream the reply and start each R block as soon as it closes
+            finish = {}
+            if cached_reply is not None:
+                deltas = iter([cached_reply])
+            else:
+                deltas = stream_completion(messages, 0.1, 1500, finish, trace=turn['trace'])
+            block_stream = RCodeBlockStream()
+            shown = 0
+            # A persistent session must see the blocks one at a time, in order
+            max_workers = 1 if runtime and runtime.get('session') else max(R_POOL_SIZE, 1)
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                def dispatch(code):
+                    output_dir = tempfile.mkdtemp()
+                    code_blocks.append({
+                        "code": code,
+                        "output_dir": output_dir,
+                        "future": executor.submit(execute_r_code, code, runtime, output_dir)
+                    })
+                
+                for delta in deltas:
+                    if turn['cancel'].is_set():
+                        if hasattr(deltas, "close"):
+                            deltas.close()
+                        raise JobCancelled()
+                    for code in block_stream.feed(delta):
+                        dispatch(code)
+                    ui.reply(block_stream.text, done=False)
+                    
+                    # Show finished blocks right away; failures wait for the auto-fix below
+                    while shown < len(code_blocks):
+                        future = code_blocks[shown]["future"]
+                        if not future.done() or not future.result()['success']:
+                            break
+                        finish_code_block(code_blocks[shown], turn, ui)
+                        shown += 1
+                
+                for code in block_stream.close():
+                    dispatch(code)
+                reply = block_stream.text
+                ui.reply(reply)
+                if cached_reply is None and reply and finish.get("reason") != "length":
+                    turn['llm_cache'].put(cache_key, reply)
+                
+                for index, block in enumerate(code_blocks[shown:], shown + 1):
+                    ui.stage(f"Running R code block {index}/{len(code_blocks)}")
+                    finish_code_block(block, turn, ui)
+        else:
+            if cached_reply is not None:
+                reply = cached_reply
+            else:
+                reply, _ = cached_completion(turn, messages, temperature=0.1, max_tokens=1500, lookup=False)
+            ui.reply(reply)
+            
+            # Execute R code blocks one by one
+            reply_blocks = extract_r_code_blocks(reply)
+            for index, code in enumerate(reply_blocks, 1):
+                raise_if_cancelled(turn)
+                ui.stage(f"Running R code block {index}/{len(reply_blocks)}")
+                block = {"code": code, "output_dir": tempfile.mkdtemp(), "future": None}
+                code_blocks.append(block)
+                finish_code_block(block, turn, ui)
+    finally:
+        # Blocks abandoned by a cancel or an error still own a temp directory
+        for block in code_blocks:
+            if "message" not in block:
+                shutil.rmtree(block["output_dir"], ignore_errors=True)
+    
+    if not code_blocks:
+        return [{"role": "assistant", "content": reply}]
+    return [{"role": "assistant", "content": reply, **block["message"]} for block in code_blocks]
+
+@st.cache_resource(show_spinner=False)
+def get_job_manager():
+    """Executor for questions answered in the background (shared by all sessions)."""
+    return JobManager(max_workers=JOB_WORKERS)
+
+def attach_job_result(job):
+    """Move a finished job's messages into the conversation, exactly once."""
+    if job.attached:
+        return
+    job.attached = True
+    
+    for key, value in job.state_updates.items():
+        st.session_state[key] = value
+    st.session_state.messages.extend(job.messages)
+    
+    if job.status == "cancelled" and not job.messages:
+        st.session_state.messages.append({
+            "role": "assistant",
+            "content": (job.reply + "\n\n" if job.reply else "") + "⏹ _Cancelled._"
+        })
+    elif job.status == "failed":
+        st.session_state.messages.append({
+            "role": "assistant",
+            "content": (job.reply + "\n\n" if job.reply else "") + f"❌ Error: {job.error}"
+        })
+
+@st.fragment(run_every=0.5)
+def render_active_job():
+    """Poll the running question and redraw its partial answer."""
+    job = get_job_manager().get(st.session_state.get("active_job"))
+    if job is None:
+        st.session_state.active_job = None
+        st.rerun()
+    
+    with st.chat_message("assistant"):
+        if job.reply:
+            st.markdown(job.reply if job.reply_done else job.reply + "▌")
+        for name, args, kwargs in job.events():
+            getattr(st, name)(*args, **kwargs)
+        
+        if not job.done:
+            col1, col2 = st.columns([4, 1])
+            with col1:
+                stage = "Cancelling" if job.cancelled else job.stage
+                st.caption(f"⏳ {stage}... ({job.elapsed:.0f}s)")
+            with col2:
+                if st.button("⏹ Cancel", key=f"cancel_{job.id}", disabled=job.cancelled):
+                    job.cancel()
+            return
+    
+    attach_job_result(job)
+    st.session_state.active_job = None
+    st.rerun()
+
+def start_new_conversation():
+    """Clear the chat and release everything the old conversation held."""
+    old_id = st.session_state.conversation_id
+    new_id = uuid.uuid4().hex
+    store = get_session_store()
+    data_hash = st.session_state.get("data_hash")
+    # Move the dataset over before releasing, so it is not dropped and re-read
+    if data_hash is not None:
+        store.attach(new_id, data_hash)
+    store.release(old_id)
+    st.session_state.conversation_id = new_id
+    st.session_state.messages = []
+    st.session_state.r_session_objects = []
+    st.session_state.pop("last_trace", None)
+
+def messages_nbytes(messages):
+    """Approximate size of the text a conversation keeps in session state."""
+    return sum(
+        len(value.encode("utf-8"))
+        for msg in messages
+        for value in msg.values()
+        if isinstance(value, str)
+    )
+
+def offload_message_outputs(messages, session_id, nbytes):
+    """Move inline R output to the artifact store, oldest first, until the
+    messages fit in MESSAGE_SESSION_MAX_KB. Returns their size afterwards.
     """
+    artifacts = get_artifact_store()
+    for msg in messages:
+        if nbytes <= MESSAGE_SESSION_MAX_KB * 1024:
+            break
+        if "output" in msg:
+            output = msg.pop("output")
+            msg["output_artifact"] = artifacts.put_text(output, session_id, ext=".txt")
+            nbytes -= len(output.encode("utf-8")) - len(msg["output_artifact"])
+    return nbytes
+
+def group_turns(messages):
+    """Split the conversation into turns: a question and the answers that follow."""
+    turns = []
+    for msg in messages:
+        if msg["role"] == "user" or not turns:
+            turns.append([])
+        turns[-1].append(msg)
+    return turns
+
+def render_message(msg, artifact_store, full_size_plots=False, show_content=True):
+    """Render one stored chat message; plots show as thumbnails unless full size."""
+    if show_content:
+        st.markdown(msg["content"])
+    if "fixed" in msg and msg["fixed"]:
+        st.caption(f"✨ Auto-fixed after {msg['retries']} attempt(s)")
+    
+    # Show executed code for successful runs
+    if "code" in msg and "error" not in msg:
+        st.subheader("📝 Executed R Code", divider="green")
+        st.code(msg["code"], language="r")
+    
+    # Show failed code
+    if "code" in msg and "error" in msg:
+        st.subheader("⚠️ Failed R Code", divider="red")
+        st.code(msg["code"], language="r")
+        st.error("Error:")
+        st.code(msg["error"], language="text")
+    
+    if "output" in msg:
+        st.text(msg["output"])
+    elif "output_artifact" in msg:
+        output = artifact_store.read_text(msg["output_artifact"])
+        if output is None:
+            st.caption("🗑️ Output removed from storage")
+        else:
+            st.text(output)
+    if "table_artifacts" in msg:
+        for artifact_id in msg["table_artifacts"]:
+            if is_table_data(artifact_id):
+                data_path = artifact_store.path(artifact_id)
+                if data_path is None:
+                    st.caption("🗑️ Table removed from storage")
+                else:
+                    st.dataframe(read_table_data(data_path), hide_index=True)
+                continue
+            html_content = artifact_store.read_text(artifact_id)
+            if html_content is None:
+                st.caption("🗑️ Table removed from storage")
+            else:
+                st.markdown(html_content, unsafe_allow_html=True)
+    if "plot_artifacts" in msg:
+        for artifact_id in msg["plot_artifacts"]:
+            if full_size_plots:
+                img_path = artifact_store.path(artifact_id)
+            else:
+                img_path = artifact_store.thumbnail(artifact_id, HISTORY_THUMBNAIL_WIDTH)
+            if img_path is None:
+                st.caption("🗑️ Plot removed from storage")
+            else:
+                st.image(img_path)
+
+def turn_summary(turn):
+    """One-line description of a collapsed turn."""
+    question = next((m["content"] for m in turn if m["role"] == "user"), "")
+    if len(question) > 120:
+        question = question[:120] + "..."
+    answers = [m for m in turn if m["role"] == "assistant"]
+    details = []
+    n_plots = sum(len(m.get("plot_artifacts", [])) for m in answers)
+    n_tables = sum(len(m.get("table_artifacts", [])) for m in answers)
+    if n_plots:
+        details.append(f"{n_plots} plot(s)")
+    if n_tables:
+        details.append(f"{n_tables} table(s)")
+    if any("error" in m for m in answers):
+        details.append("⚠️ error")
+    return question, " · ".join(details)
+
+@st.fragment
+def render_history_turn(index, turn, collapsed):
+    """Render a turn; interacting with it only reruns this fragment.
+
+    Collapsed turns show a summary and render their answers (tables, plots)
+    only when opened.
+    """
+    artifact_store = get_artifact_store()
+    if collapsed:
+        question, details = turn_summary(turn)
+        with st.container(border=True):
+            st.markdown(f"**❓ {question}**")
+            if details:
+                st.caption(details)
+            if not st.toggle("Show answer", key=f"history_open_{index}"):
+                return
     
-    return html_content
+    has_plots = any(m.get("plot_artifacts") for m in turn)
+    full_size = has_plots and st.toggle("Full-size plots", key=f"history_full_{index}")
+    previous_content = None
+    for msg in turn:
+        with st.chat_message(msg["role"]):
+            # Answers with several code blocks repeat the same reply text
+            render_message(
+                msg,
+                artifact_store,
+                full_size_plots=full_size,
+                show_content=msg["content"] != previous_content
+            )
+        previous_content = msg["content"]
+
+def render_history():
+    """Recent turns in full, older ones collapsed and paginated."""
+    turns = group_turns(st.session_state.messages)
+    first_recent = max(len(turns) - HISTORY_RECENT_TURNS, 0)
+    shown_older = st.session_state.get("history_older_shown", HISTORY_PAGE_TURNS)
+    first_shown = max(first_recent - shown_older, 0)
+    
+    if first_shown > 0:
+        if st.button(f"⬆️ Show earlier questions ({first_shown} more)"):
+            st.session_state.history_older_shown = shown_older + HISTORY_PAGE_TURNS
+            st.rerun()
+    
+    for index in range(first_shown, len(turns)):
+        render_history_turn(index, turns[index], collapsed=index < first_recent)
+    
+    # Keep this conversation's outputs from being evicted as idle
+    get_artifact_store().touch(st.session_state.conversation_id, [
+        artifact_id
+        for turn in turns[first_recent:]
+        for msg in turn
+        for artifact_id in (
+            msg.get("table_artifacts", []) + msg.get("plot_artifacts", [])
+            + ([msg["output_artifact"]] if "output_artifact" in msg else [])
+        )
+    ])
+
+def render_timings(record):
+    """Stage-by-stage timings of the last answered question."""
+    if record is None:
+        st.caption("Ask a question to see where its time goes.")
+    else:
+        counters = record["counters"]
+        totals = stage_totals(record)
+        st.caption(
+            f"{record['status']} in {record['duration_ms'] / 1000:.2f}s · "
+            + " · ".join(f"{name} {ms / 1000:.2f}s" for name, ms in totals.items())
+        )
+        st.caption(
+            f"Tokens: {counters.get('llm_prompt_tokens', 0)} prompt / "
+            f"{counters.get('llm_completion_tokens', 0)} completion · "
+            f"retries: {counters.get('retries', 0)} · "
+            f"R runs: {sum(1 for span in record['spans'] if span['name'] == 'r_run')}"
+        )
+        st.dataframe(
+            pd.DataFrame([
+                {
+                    "stage": span["name"] if span["parent"] is None else f"  {span['name']}",
+                    "start (ms)": span["start_ms"],
+                    "duration (ms)": span["duration_ms"],
+                    "details": ", ".join(
+                        f"{key}={value}" for key, value in span.get("attrs", {}).items()
+                        if value is not None
+                    ) + ("" if span["status"] == "ok" else f" [{span['status']}]"),
+                }
+                for span in record["spans"]
+            ]),
+            hide_index=True,
+        )
+    endpoint = f" · http://<host>:{METRICS_PORT}/metrics" if METRICS_PORT else ""
+    st.caption(f"Traces: {TRACE_LOG} · metrics: {METRICS_FILE}{endpoint}")
 
 # Session state initialization
 if "messages" not in st.session_state:
     st.session_state.messages = []
-if "df" not in st.session_state:
-    st.session_state.df = None
 if "data_summary" not in st.session_state:
     st.session_state.data_summary = None
+if "conversation_id" not in st.session_state:
+    st.session_state.conversation_id = uuid.uuid4().hex
 
 st.title("📊 Ask Your CSV (R Edition)")
 st.markdown("Upload your data and ask questions in plain English - powered by R!")
@@ -464,17 +1595,47 @@ with st.sidebar:
     
     if uploaded_file:
         try:
-            df = pd.read_csv(uploaded_file)
-            st.session_state.df = df
+            # Parse only when a different file arrives, not on every rerun
+            upload_key = (uploaded_file.name, uploaded_file.size, getattr(uploaded_file, "file_id", None))
+            store = get_session_store()
+            df = session_df() if st.session_state.get("upload_key") == upload_key else None
+            if df is None:
+                # A new file, or one the store dropped after the session went idle
+                data = uploaded_file.getvalue()
+                file_hash = file_content_hash(data)
+                meta = store.attach(st.session_state.conversation_id, file_hash)
+                if meta is None:
+                    # No session holds this file yet
+                    progress_bar = None
+                    if len(data) > CHUNKED_PARSE_BYTES:
+                        progress_bar = st.progress(0.0, text="Reading CSV...")
+                    ingested = ingest_csv(
+                        data,
+                        file_hash=file_hash,
+                        progress=progress_bar.progress if progress_bar else None,
+                        cache=False,
+                    )
+                    if progress_bar:
+                        progress_bar.empty()
+                    meta = {
+                        "summary": ingested.summary,
+                        "memory": (ingested.memory_before, ingested.memory_after),
+                    }
+                    store.put(
+                        st.session_state.conversation_id, file_hash, ingested.df,
+                        meta=meta, nbytes=ingested.memory_after,
+                    )
+                del data
+                
+                st.session_state.data_summary = meta["summary"]
+                st.session_state.data_memory = meta["memory"]
+                st.session_state.data_hash = file_hash
+                st.session_state.upload_key = upload_key
+                df = session_df()
+                start_prewarm(df)
             
-            # Create data summary
-            st.session_state.data_summary = {
-                "shape": df.shape,
-                "columns": df.columns.tolist(),
-                "dtypes": df.dtypes.astype(str).to_dict(),
-                "sample": df.head(3).to_dict(),
-                "stats": df.describe().to_dict() if not df.empty else {}
-            }
+            summary = st.session_state.data_summary
+            memory_before, memory_after = st.session_state.data_memory
             
             st.success(f"✅ Loaded {df.shape[0]} rows × {df.shape[1]} columns")
             
@@ -489,8 +1650,18 @@ with st.sidebar:
                     st.metric("Total Rows", df.shape[0])
                     st.metric("Total Columns", df.shape[1])
                 with col2:
-                    st.metric("Memory Usage", f"{df.memory_usage().sum() / 1024:.1f} KB")
-                    st.metric("Missing Values", df.isnull().sum().sum())
+                    saved = 1 - memory_after / memory_before if memory_before else 0
+                    st.metric(
+                        "Memory Usage",
+                        format_bytes(memory_after),
+                        delta=f"-{saved:.0%} vs. raw" if saved > 0 else None,
+                        delta_color="inverse",
+                    )
+                    st.metric("Missing Values", summary["missing"])
+                st.caption(
+                    f"Memory before dtype compaction: {format_bytes(memory_before)} → "
+                    f"after: {format_bytes(memory_after)}"
+                )
                     
         except Exception as e:
             st.error(f"Error reading file: {str(e)}")
@@ -498,52 +1669,130 @@ with st.sidebar:
     else:
         st.info("👆 Upload a CSV file to start analyzing!")
     
+    # Response settings
+    st.markdown("---")
+    st.header("⚙️ Settings")
+    st.toggle(
+        "Stream responses",
+        value=True,
+        key="stream_responses",
+        help="Show the answer as it is written and start running each R code block as soon as it is complete."
+    )
+    st.toggle(
+        "Reuse cached answers",
+        value=True,
+        key="use_llm_cache",
+        help="Serve repeated questions on the same dataset from the response cache. Turn off to force a fresh answer."
+    )
+    st.toggle(
+        "Run in background",
+        value=True,
+        key="background_jobs",
+        help="Answer questions on a background job so the page stays responsive and long R runs can be cancelled."
+    )
+    if FIX_FANOUT > 1:
+        st.toggle(
+            "Try several fixes at once",
+            value=False,
+            key="parallel_fixes",
+            help=f"When R code fails, ask for {FIX_FANOUT} candidate fixes in one request and run them side by side; the first that works is kept."
+        )
+    llm_cache = get_llm_cache()
+    st.caption(f"Response cache: {llm_cache.hits} hits · {llm_cache.misses} misses")
+    if R_RESULT_CACHE:
+        result_cache = get_result_cache()
+        st.caption(f"R result cache: {result_cache.hits} hits · {result_cache.misses} misses")
+    store_usage = get_session_store().usage()
+    st.caption(
+        f"Datasets in memory: {format_bytes(store_usage['resident_bytes'])} of "
+        f"{format_bytes(store_usage['max_bytes'])} · on disk: "
+        f"{format_bytes(store_usage['spilled_bytes'])} · {store_usage['sessions']} sessions"
+    )
+    if R_POOL_SIZE > 0:
+        st.toggle(
+            "Keep R session between questions",
+            value=False,
+            key="r_session_mode",
+            help="Objects created by earlier answers (fitted models, derived data) stay available, so follow-up questions don't recompute them."
+        )
+        if st.session_state.get("r_session_mode") and st.button("🔄 Reset R session"):
+            r_exec = st.session_state.get('r_path') or get_r_path()
+            if r_exec:
+                get_r_session_manager(r_exec).reset(r_session_key())
+            st.session_state.r_session_objects = []
+            st.toast("R session reset")
+    
+    # Shared R load: how long executions wait for a slot vs. how long they run
+    load = get_r_scheduler().snapshot()
+    st.caption(
+        f"R executions: {load['running']}/{load['max_concurrent']} running · {load['queued']} queued · "
+        f"wait avg {load['wait_avg']:.1f}s (p95 {load['wait_p95']:.1f}s) · "
+        f"run avg {load['run_avg']:.1f}s (p95 {load['run_p95']:.1f}s)"
+    )
+    
+    # Where the time of the last answer went
+    if st.toggle("Show timings", value=False, key="show_timings"):
+        render_timings(st.session_state.get("last_trace"))
+    
+    # Start over on the same data; the old conversation's outputs are freed
+    if st.session_state.messages and st.button(
+        "🗑️ New conversation", disabled=bool(st.session_state.get("active_job"))
+    ):
+        start_new_conversation()
+        st.rerun()
+    
     # Export options
     if len(st.session_state.messages) >= 1:
         st.sidebar.markdown("---")
         st.sidebar.header("💾 Export Options")
+        report_format = st.sidebar.radio(
+            "Report format",
+            ["HTML (images inline)", "ZIP (HTML + image files)"],
+            key="report_format"
+        )
+        downsize_images = st.sidebar.toggle(
+            "Downsize large plots",
+            value=True,
+            key="report_downsize",
+            help=f"Shrink plots wider than {REPORT_IMAGE_MAX_WIDTH}px to keep the report small."
+        )
         if st.sidebar.button("Generate Report"):
-            export_html = export_conversation()
-            st.sidebar.download_button(
-                label="📥 Download Report (HTML)",
-                data=export_html,
-                file_name=f"data_analysis_{datetime.datetime.now().strftime('%Y%m%d_%H%M')}.html",
-                mime="text/html"
-            )
+            as_zip = report_format.startswith("ZIP")
+            report_path = export_conversation(as_zip=as_zip, downsize_images=downsize_images)
+            extension, mime = ("zip", "application/zip") if as_zip else ("html", "text/html")
+            try:
+                with open(report_path, "rb") as report_file:
+                    st.sidebar.download_button(
+                        label=f"📥 Download Report ({extension.upper()})",
+                        data=report_file,
+                        file_name=f"data_analysis_{datetime.datetime.now().strftime('%Y%m%d_%H%M')}.{extension}",
+                        mime=mime
+                    )
+            finally:
+                # The button holds its own copy of the report
+                os.remove(report_path)
 
 # Main chat interface
-if st.session_state.df is not None:
+if session_df() is not None:
+    message_bytes = messages_nbytes(st.session_state.messages)
+    if message_bytes > MESSAGE_SESSION_MAX_KB * 1024:
+        message_bytes = offload_message_outputs(
+            st.session_state.messages, st.session_state.conversation_id, message_bytes
+        )
+    get_session_store().touch(st.session_state.conversation_id, message_bytes=message_bytes)
+    
     # Display chat history
-    for msg in st.session_state.messages:
-        with st.chat_message(msg["role"]):
-            st.markdown(msg["content"])
-            if "fixed" in msg and msg["fixed"]:
-                st.caption(f"✨ Auto-fixed after {msg['retries']} attempt(s)")
-            
-            # Show executed code for successful runs
-            if "code" in msg and "error" not in msg:
-                st.subheader("📝 Executed R Code", divider="green")
-                st.code(msg["code"], language="r")
-            
-            # Show failed code
-            if "code" in msg and "error" in msg:
-                st.subheader("⚠️ Failed R Code", divider="red")
-                st.code(msg["code"], language="r")
-                st.error("Error:")
-                st.code(msg["error"], language="text")
-            
-            if "output" in msg:
-                st.text(msg["output"])
-            if "html_tables" in msg:
-                for html_content in msg["html_tables"]:
-                    st.markdown(html_content, unsafe_allow_html=True)
-            if "plot_images" in msg:
-                for img_path in msg["plot_images"]:
-                    if os.path.exists(img_path):
-                        st.image(img_path)
+    render_history()
+    
+    # A question answered in the background keeps updating below the history
+    if st.session_state.get("active_job"):
+        render_active_job()
     
     # Chat input
-    user_input = st.chat_input("Ask a question about your data")
+    user_input = st.chat_input(
+        "Ask a question about your data",
+        disabled=bool(st.session_state.get("active_job"))
+    )
     
     if user_input:
         # Add user message
@@ -552,238 +1801,62 @@ if st.session_state.df is not None:
         with st.chat_message("user"):
             st.markdown(user_input)
         
-        # Prepare data context
-        df = st.session_state.df
-        if len(df) > 100:
-            data_context = f"""
-            Dataset shape: {st.session_state.data_summary['shape']}
-            Columns: {', '.join(st.session_state.data_summary['columns'])}
-            Data types: {st.session_state.data_summary['dtypes']}
-            Sample rows: {st.session_state.data_summary['sample']}
-            Basic statistics: {st.session_state.data_summary['stats']}
-            """
-        else:
-            data_context = f"""
-            Full dataset preview:
-            {df.head(10).to_string()}
-            """
-        
-        # Enhanced system prompt for R
-        system_prompt = f"""You are a helpful data analyst assistant using R.
-        
-        The user has uploaded a CSV file with the following information:
-        {data_context}
-        
-        The data is loaded in an R dataframe called `df`.
-        
-        Guidelines:
-        - Answer the user's question clearly and concisely
-        - Write R code using base R, dplyr, ggplot2, gtsummary, and survival
-        - For regression tables, use gtsummary's tbl_regression or tbl_summary
-        - For visualizations, use ggplot2 and save plots using ggsave()
-        - Always validate data before operations
-        - Keep responses focused on the data and question
-        - Summarize findings and insights
-        
-        When writing code:
-        - The dataframe is available as 'df'
-        - Libraries available: ggplot2, dplyr, gtsummary, survival, survminer, flextable
-        - For survival plots, MUST load survminer: library(survminer) before using ggsurvplot()
-        - For plots, save them using: ggsave("plot.png", width=10, height=6)
-        - For ggsurvplot, save using: ggsave("plot.png", p$plot, width=10, height=6)
-        - You can create multiple plots: plot1.png, plot2.png, etc.
-        - For gtsummary tables, MUST save as HTML using flextable with pipe operator:
-          table <- tbl_regression(model, exponentiate = TRUE)
-          as_flex_table(table) %>% save_as_html(path = "table.html")
-        - IMPORTANT: Use pipe operator (%>%) and path parameter in save_as_html()
-        - Always add titles and labels to plots
-        - Print results using print() or cat()
-        
-        Example code structure for tables:
-        ```r
-        # Cox regression model
-        library(survival)
-        library(gtsummary)
-        library(flextable)
-        
-        
-        # Create and save table as HTML (CORRECT SYNTAX)
-        table <- tbl_regression(model, exponentiate = TRUE)
-        as_flex_table(table) %>% save_as_html(path = "table.html")
-        
-        # For summary tables
-        summary_table <- tbl_summary(df, by = group_var)
-        as_flex_table(summary_table) %>% save_as_html(path = "summary.html")
-        
-        # Alternative syntax also works:
-        # save_as_html(as_flex_table(table), path = "table.html")
-        ```
-        
-        Example for Kaplan-Meier plots:
-        ```r
-        # Create plot with ggsurvplot
-        p <- ggsurvplot(
-          km_fit,
-          data = df,
-          risk.table = TRUE,
-          pval = TRUE,
-          conf.int = TRUE,
-          xlab = "Time",
-          ylab = "Survival Probability",
-          title = "Kaplan-Meier Curves"
+        # Prepare data context (profiled once per dataset, rendered within budget)
+        df = session_df()
+        data_hash = current_data_hash(df)
+        data_context = render_context(
+            get_prewarmer().run(("profile", data_hash), get_profile, df, data_hash),
+            token_budget=DATA_CONTEXT_TOKENS,
+            model=OPENAI_MODEL
         )
         
-        # Save plot (note: use p$plot for ggsurvplot objects)
-        ggsave("km_plot.png", p$plot, width = 10, height = 6)
-        ```
+        # Tell the model what a persistent R session already holds
+        session_objects = None
+        if st.session_state.get("r_session_mode"):
+            session_objects = st.session_state.get("r_session_objects") or []
         
-        Example for plots:
-        ```r
-        # Visualization
-        p <- ggplot(df, aes(x=x, y=y)) + 
-          geom_point() +
-          labs(title="My Plot", x="X axis", y="Y axis")
+        # Static instructions first, then data, history and the question
+        trace = Trace(st.session_state.conversation_id, user_input)
+        with trace.span("prompt_build") as span:
+            prompt = prompt_builder.chat(
+                user_input,
+                data_context,
+                history=st.session_state.messages[:-1],
+                session_objects=session_objects
+            )
+            span.set(tokens=prompt.tokens, history_used=prompt.history_used, trimmed=len(prompt.trimmed))
         
-        ggsave("plot.png", p, width=10, height=6)
-        ```
-        """
+        try:
+            turn = prepare_turn(prompt, data_context, df, trace)
+        except Exception as e:
+            turn = None
+            st.error(f"Error: {str(e)}")
+            st.info("Please try again or rephrase your question.")
         
-        # Generate response
-        with st.chat_message("assistant"):
-            message_placeholder = st.empty()
-            with st.spinner("Analyzing your data with R..."):
-                try:
-                    messages = [{"role": "system", "content": system_prompt}]
-                    
-                    for msg in st.session_state.messages[-6:]:
-                        content = msg["content"]
-                        if len(content) > 500:
-                            content = content[:500] + "..."
-                        messages.append({"role": msg["role"], "content": content})
-                    
-                    messages.append({"role": "user", "content": user_input})
-                    
-                    response = client.chat.completions.create(
-                        model="gpt-4.1",
-                        messages=messages,
-                        temperature=0.1,
-                        max_tokens=1500
-                    )
-                    
-                    reply = response.choices[0].message.content
-                    message_placeholder.markdown(reply)
-                    
-                    # Execute R code if present
-                    if "```r" in reply or "```R" in reply:
-                        code_blocks = reply.replace("```R", "```r").split("```r")
+        if turn is not None and st.session_state.get("background_jobs", True):
+            # Answer on a job thread; render_active_job() polls it and attaches the result
+            job = get_job_manager().submit(
+                st.session_state.conversation_id, answer_question, turn, cancel_event=turn['cancel']
+            )
+            st.session_state.active_job = job.id
+            st.rerun()
+        elif turn is not None:
+            # Generate response
+            with st.chat_message("assistant"):
+                message_placeholder = st.empty()
+                with st.spinner("Analyzing your data with R..."):
+                    try:
+                        # Save to session state
+                        st.session_state.messages.extend(
+                            answer_question(None, LiveUI(message_placeholder), turn)
+                        )
                         
-                        for i in range(1, len(code_blocks)):
-                            code = code_blocks[i].split("```")[0]
-                            
-                            # Create temp directory for this execution
-                            with tempfile.TemporaryDirectory() as tmpdir:
-                                # First attempt
-                                result = run_r_code(code, df, tmpdir)
-                                
-                                # If failed, try to auto-fix (max 3 retries)
-                                max_retries = 3
-                                retry_count = 0
-                                
-                                while not result['success'] and retry_count < max_retries:
-                                    retry_count += 1
-                                    st.warning(f"⚠️ Execution failed. Auto-fixing code (Attempt {retry_count}/{max_retries})...")
-                                    
-                                    # Get fixed code from AI
-                                    fixed_code = get_fixed_r_code(
-                                        result['code'], 
-                                        result['stderr'], 
-                                        data_context
-                                    )
-                                    
-                                    if fixed_code:
-                                        st.info(f"🔧 Running fixed code...")
-                                        result = run_r_code(fixed_code, df, tmpdir)
-                                    else:
-                                        st.warning("Could not generate fixed code. Stopping retries.")
-                                        break
-                                
-                                if result['success']:
-                                    # Display success message if retries were needed
-                                    if retry_count > 0:
-                                        st.success(f"✅ Code executed successfully after {retry_count} fix attempt(s)!")
-                                    
-                                    # Show the executed code
-                                    st.subheader("📝 Executed R Code", divider="green")
-                                    st.code(result['code'], language="r")
-                                    
-                                    # Display text output
-                                    if result['stdout']:
-                                        st.success("R Output:")
-                                        st.text(result['stdout'])
-                                    
-                                    # Extract and display HTML tables
-                                    html_tables = extract_html_from_output(tmpdir)
-                                    if html_tables:
-                                        st.success("📊 Table Output:")
-                                    for html_content in html_tables:
-                                        # Use a container with custom styling for better display
-                                        st.markdown(html_content, unsafe_allow_html=True)
-                                    
-                                    # Look for saved plots
-                                    plot_files = [f for f in os.listdir(tmpdir) if f.endswith('.png')]
-                                    saved_plots = []
-                                    
-                                    for plot_file in plot_files:
-                                        plot_path = os.path.join(tmpdir, plot_file)
-                                        # Save to permanent location
-                                        perm_dir = tempfile.mkdtemp()
-                                        perm_path = os.path.join(perm_dir, plot_file)
-                                        
-                                        import shutil
-                                        shutil.copy2(plot_path, perm_path)
-                                        
-                                        st.image(perm_path)
-                                        saved_plots.append(perm_path)
-                                    
-                                    # Save to session state
-                                    msg_data = {"role": "assistant", "content": reply}
-                                    if result['stdout']:
-                                        msg_data["output"] = result['stdout']
-                                    if html_tables:
-                                        msg_data["html_tables"] = html_tables
-                                    if saved_plots:
-                                        msg_data["plot_images"] = saved_plots
-                                    if retry_count > 0:
-                                        msg_data["fixed"] = True
-                                        msg_data["retries"] = retry_count
-                                    msg_data["code"] = result['code']  # Save code to session state
-                                    
-                                    st.session_state.messages.append(msg_data)
-                                else:
-                                    st.error(f"❌ R Execution Error (failed after {retry_count} fix attempt(s)):")
-                                    st.code(result['stderr'], language="text")
-                                    
-                                    # Show the code that failed with subheader
-                                    st.subheader("⚠️ Failed R Code", divider="red")
-                                    st.code(result['code'], language="r")
-                                    
-                                    st.info("💡 Tips:\n- Try rephrasing your question\n- Check if column names are correct\n- Ensure data types are appropriate")
-                                    
-                                    st.session_state.messages.append({
-                                        "role": "assistant",
-                                        "content": reply,
-                                        "code": result['code'],  # Save failed code too
-                                        "error": result['stderr']
-                                    })
-                    else:
-                        st.session_state.messages.append({
-                            "role": "assistant",
-                            "content": reply
-                        })
-                    
-                except Exception as e:
-                    st.error(f"Error: {str(e)}")
-                    st.info("Please try again or rephrase your question.")
+                    except Exception as e:
+                        st.error(f"Error: {str(e)}")
+                        st.info("Please try again or rephrase your question.")
+                    finally:
+                        for key, value in turn['state_updates'].items():
+                            st.session_state[key] = value
 else:
     col1, col2, col3 = st.columns([1, 2, 1])
     with col2:
@@ -804,6 +1877,9 @@ st.markdown("---")
 st.markdown("""
 <div style='text-align: center; color: gray; font-size: 12px;'>
 💡 Powered by R, ggplot2, gtsummary, survminer, and flextable | 
-🔒 Your data stays private and is not stored
+🗄️ Uploads and results are cached on this server for up to {retention_days} days to speed up repeat questions
 </div>
-""", unsafe_allow_html=True)
+""".format(retention_days=math.ceil(max(
+    SESSION_TTL_HOURS, STAGED_TTL_HOURS, ARTIFACT_SESSION_TTL_HOURS,
+    LLM_CACHE_TTL_HOURS, RESULT_CACHE_TTL_HOURS,
+) / 24)), unsafe_allow_html=True)
@@ -0,0 +1,243 @@
+"""Content-addressed store for plots and tables produced by R.
+
+Outputs are kept once per content hash under ``<root>/objects`` and indexed
+in SQLite together with the sessions (conversations) that reference them.
+Identical plots are stored once however often they are produced. Each
+session has a size cap (its least recently used outputs are dropped first),
+the whole store has a global LRU cap, and sessions idle for longer than the
+TTL release their references. Files nobody references are deleted.
+Image thumbnails are generated on demand and live next to their artifact.
+"""
+import glob
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    from PIL import Image
+    HAS_PIL = True
+except ImportError:
+    HAS_PIL = False
+
+# Idle sessions are swept at most this often
+SWEEP_INTERVAL = 300
+
+
+class ArtifactStore:
+    """Deduplicating file store with per-session and global LRU size caps."""
+
+    def __init__(self, root, max_bytes=1024 ** 3, max_session_bytes=256 * 1024 ** 2,
+                 session_ttl=24 * 3600):
+        self.root = root
+        self.objects_dir = os.path.join(root, "objects")
+        self.db_path = os.path.join(root, "artifacts.sqlite")
+        self.max_bytes = max_bytes
+        self.max_session_bytes = max_session_bytes
+        self.session_ttl = session_ttl
+        self.stats = {"stored": 0, "deduplicated": 0, "evicted": 0}
+        self._lock = threading.Lock()
+        self._last_sweep = 0.0
+        os.makedirs(self.objects_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS artifacts ("
+                " id TEXT PRIMARY KEY, size INTEGER NOT NULL,"
+                " created REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS refs ("
+                " session_id TEXT NOT NULL, id TEXT NOT NULL, created REAL NOT NULL,"
+                " PRIMARY KEY (session_id, id))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                " session_id TEXT PRIMARY KEY, last_seen REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS refs_id ON refs(id)")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _file(self, artifact_id):
+        return os.path.join(self.objects_dir, artifact_id[:2], artifact_id)
+
+    def put_bytes(self, data, session_id, ext):
+        """Store ``data`` for a session and return its artifact id."""
+        artifact_id = hashlib.sha256(data).hexdigest()[:32] + ext
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            exists = conn.execute(
+                "SELECT 1 FROM artifacts WHERE id = ?", (artifact_id,)
+            ).fetchone()
+            path = self._file(artifact_id)
+            if exists and os.path.exists(path):
+                conn.execute(
+                    "UPDATE artifacts SET last_access = ? WHERE id = ?", (now, artifact_id)
+                )
+                self.stats["deduplicated"] += 1
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp, "wb") as f:
+                    f.write(data)
+                os.replace(tmp, path)
+                conn.execute(
+                    "INSERT OR REPLACE INTO artifacts (id, size, created, last_access)"
+                    " VALUES (?, ?, ?, ?)",
+                    (artifact_id, len(data), now, now),
+                )
+                self.stats["stored"] += 1
+            conn.execute(
+                "INSERT OR IGNORE INTO refs (session_id, id, created) VALUES (?, ?, ?)",
+                (session_id, artifact_id, now),
+            )
+            self._seen(conn, session_id, now)
+            self._enforce_session_cap(conn, session_id)
+            self._enforce_global_cap(conn)
+            if now - self._last_sweep > SWEEP_INTERVAL:
+                self._sweep(conn, now)
+        return artifact_id
+
+    def put_file(self, src, session_id):
+        with open(src, "rb") as f:
+            data = f.read()
+        return self.put_bytes(data, session_id, os.path.splitext(src)[1].lower())
+
+    def put_text(self, text, session_id, ext=".html"):
+        return self.put_bytes(text.encode("utf-8"), session_id, ext)
+
+    def path(self, artifact_id):
+        """File path of an artifact, or None once it has been evicted."""
+        path = self._file(artifact_id)
+        return path if os.path.exists(path) else None
+
+    def thumbnail(self, artifact_id, width):
+        """Path of a copy of an image at most ``width`` pixels wide.
+
+        Falls back to the original image without Pillow or if it is already
+        small enough; None once the artifact has been evicted.
+        """
+        path = self.path(artifact_id)
+        if path is None or not HAS_PIL:
+            return path
+        thumb = f"{path}.w{width}.png"
+        if os.path.exists(thumb):
+            return thumb
+        try:
+            with Image.open(path) as img:
+                if img.width <= width:
+                    return path
+                img.thumbnail((width, width * 10))
+                tmp = f"{thumb}.{threading.get_ident()}.tmp"
+                img.save(tmp, format="PNG", optimize=True)
+            os.replace(tmp, thumb)
+            return thumb
+        except Exception:
+            return path
+
+    def read_text(self, artifact_id):
+        path = self.path(artifact_id)
+        if path is None:
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def touch(self, session_id, artifact_ids=()):
+        """Mark a session active and its displayed artifacts recently used."""
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            self._seen(conn, session_id, now)
+            conn.executemany(
+                "UPDATE artifacts SET last_access = ? WHERE id = ?",
+                [(now, artifact_id) for artifact_id in artifact_ids],
+            )
+
+    def release_session(self, session_id):
+        """Drop every reference a session holds; unshared files are deleted."""
+        with self._lock, self._connect() as conn:
+            self._release(conn, session_id)
+
+    def _seen(self, conn, session_id, now):
+        conn.execute(
+            "INSERT OR REPLACE INTO sessions (session_id, last_seen) VALUES (?, ?)",
+            (session_id, now),
+        )
+
+    def _release(self, conn, session_id):
+        conn.execute("DELETE FROM refs WHERE session_id = ?", (session_id,))
+        conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+        self._collect(conn)
+
+    def _sweep(self, conn, now):
+        self._last_sweep = now
+        idle = conn.execute(
+            "SELECT session_id FROM sessions WHERE last_seen < ?", (now - self.session_ttl,)
+        ).fetchall()
+        for (session_id,) in idle:
+            self._release(conn, session_id)
+
+    def _enforce_session_cap(self, conn, session_id):
+        rows = conn.execute(
+            "SELECT a.id, a.size FROM refs r JOIN artifacts a ON a.id = r.id"
+            " WHERE r.session_id = ? ORDER BY a.last_access ASC",
+            (session_id,),
+        ).fetchall()
+        excess = sum(size for _, size in rows) - self.max_session_bytes
+        # Never drop the artifact that was just stored (it is the newest)
+        for artifact_id, size in rows[:-1]:
+            if excess <= 0:
+                break
+            conn.execute(
+                "DELETE FROM refs WHERE session_id = ? AND id = ?", (session_id, artifact_id)
+            )
+            excess -= size
+        self._collect(conn)
+
+    def _enforce_global_cap(self, conn):
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM artifacts").fetchone()[0]
+        excess = total - self.max_bytes
+        if excess <= 0:
+            return
+        for artifact_id, size in conn.execute(
+            "SELECT id, size FROM artifacts ORDER BY last_access ASC"
+        ).fetchall()[:-1]:
+            if excess <= 0:
+                break
+            self._delete(conn, artifact_id)
+            excess -= size
+
+    def _collect(self, conn):
+        for (artifact_id,) in conn.execute(
+            "SELECT id FROM artifacts WHERE id NOT IN (SELECT id FROM refs)"
+        ).fetchall():
+            self._delete(conn, artifact_id)
+
+    def _delete(self, conn, artifact_id):
+        conn.execute("DELETE FROM refs WHERE id = ?", (artifact_id,))
+        conn.execute("DELETE FROM artifacts WHERE id = ?", (artifact_id,))
+        path = self._file(artifact_id)
+        for stale in [path] + glob.glob(glob.escape(path) + ".w*.png"):
+            try:
+                os.remove(stale)
+            except OSError:
+                pass
+        self.stats["evicted"] += 1
+
+    def usage(self):
+        """``(artifact count, total bytes)`` currently stored."""
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM artifacts"
+            ).fetchone()
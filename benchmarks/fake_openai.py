@@ -0,0 +1,191 @@
+"""Local OpenAI-compatible server that replays recorded chat replies.
+
+Implements ``POST /v1/chat/completions`` (streaming and non-streaming) well
+enough for the ``openai`` client. The reply is chosen by the first recorded
+entry whose ``match`` text occurs in the last user message; ``ttft`` and
+``tokens_per_second`` simulate model latency so timings stay comparable.
+
+Run it on its own to point the app at it:
+
+    python benchmarks/fake_openai.py --port 8765
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 streamlit run app.py
+"""
+import argparse
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPLIES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "replies.json")
+
+_PIECE = re.compile(r"\S+\s*|\s+")
+
+
+def load_replies(path=REPLIES_PATH):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+class FakeOpenAIServer:
+    """Threaded HTTP server replaying ``replies`` on a local port."""
+
+    def __init__(self, replies=None, host="127.0.0.1", port=0, ttft=0.0, tokens_per_second=0.0):
+        self.replies = replies if replies is not None else load_replies()
+        self.ttft = ttft
+        self.tokens_per_second = tokens_per_second
+        self.requests = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def serve_forever(self):
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def reply_for(self, messages):
+        question = next(
+            (m.get("content") or "" for m in reversed(messages) if m.get("role") == "user"), ""
+        )
+        for entry in self.replies:
+            if entry["match"].lower() in question.lower():
+                return entry["reply"]
+        return self.replies[0]["reply"]
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                if not self.path.rstrip("/").endswith("/chat/completions"):
+                    self.send_error(404)
+                    return
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                messages = body.get("messages", [])
+                with server._lock:
+                    server.requests.append({
+                        "messages": len(messages),
+                        "chars": sum(len(m.get("content") or "") for m in messages),
+                        "stream": bool(body.get("stream")),
+                    })
+                reply = server.reply_for(messages)
+                if server.ttft:
+                    time.sleep(server.ttft)
+                if body.get("stream"):
+                    self._stream(body.get("model", "fake"), reply)
+                else:
+                    self._complete(body.get("model", "fake"), reply, messages)
+
+            def _complete(self, model, reply, messages):
+                pieces = _PIECE.findall(reply)
+                if server.tokens_per_second:
+                    time.sleep(len(pieces) / server.tokens_per_second)
+                prompt_tokens = sum(len(m.get("content") or "") for m in messages) // 4
+                payload = json.dumps({
+                    "id": f"chatcmpl-{uuid.uuid4().hex}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": reply},
+                        "finish_reason": "stop",
+                    }],
+                    "usage": {
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": len(pieces),
+                        "total_tokens": prompt_tokens + len(pieces),
+                    },
+                }).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _stream(self, model, reply):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Cache-Control", "no-cache")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+                created = int(time.time())
+
+                def chunk(delta, finish_reason=None):
+                    data = json.dumps({
+                        "id": completion_id,
+                        "object": "chat.completion.chunk",
+                        "created": created,
+                        "model": model,
+                        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+                    })
+                    self.wfile.write(f"data: {data}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+
+                delay = 1.0 / server.tokens_per_second if server.tokens_per_second else 0.0
+                chunk({"role": "assistant", "content": ""})
+                for piece in _PIECE.findall(reply):
+                    if delay:
+                        time.sleep(delay)
+                    chunk({"content": piece})
+                chunk({}, finish_reason="stop")
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.wfile.flush()
+                self.close_connection = True
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--replies", default=REPLIES_PATH)
+    parser.add_argument("--ttft", type=float, default=0.0, help="seconds before the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=0.0, help="0 = no throttling")
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(
+        load_replies(args.replies), args.host, args.port, args.ttft, args.tokens_per_second
+    )
+    print(f"Replaying {len(server.replies)} recorded replies at {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,454 @@
+"""End-to-end latency benchmarks for answering a question.
+
+Drives the modules the app is built from, stage by stage, over synthetic
+datasets of increasing size: upload parse, data profile, dataset staging,
+loading the dataset into the R worker, prompt build, LLM call (a local fake OpenAI server replaying recorded
+replies), code extraction, R execution, table extraction, plot collection
+and report export. Each stage is timed over several repetitions; one extra
+pass records peak Python memory per stage with tracemalloc.
+
+Results are written as JSON (one file per run) and can be compared against
+a baseline; the run fails when a stage got slower than the threshold.
+
+    python benchmarks/run_benchmarks.py
+    python benchmarks/run_benchmarks.py --sizes 1000x10,200000x300 --repeat 5
+    python benchmarks/run_benchmarks.py --compare benchmarks/results/baseline.json
+
+R stages are skipped (and reported as such) when Rscript cannot be found.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import openai  # noqa: E402
+
+from artifacts import ArtifactStore  # noqa: E402
+from code_blocks import extract_r_code_blocks  # noqa: E402
+from dataset_store import HAS_PYARROW, dataset_fingerprint, r_has_package, stage_dataset  # noqa: E402
+from ingest import compact_dtypes, read_csv_fast  # noqa: E402
+from profiling import profile_dataframe, render_context  # noqa: E402
+from projection import referenced_columns  # noqa: E402
+from prompts import PromptBuilder  # noqa: E402
+from r_libraries import is_missing_function_error, read_r_exports, required_libraries  # noqa: E402
+from r_worker import RWorkerError, RWorkerPool, build_r_script, run_script_once  # noqa: E402
+from report import write_report_html  # noqa: E402
+from plots import optimize_plots, plot_helpers_r  # noqa: E402
+from tables import TABLE_HELPERS_R, extract_tables  # noqa: E402
+
+from synthetic import make_csv  # noqa: E402
+from fake_openai import FakeOpenAIServer, load_replies  # noqa: E402
+
+SCHEMA_VERSION = 1
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+DEFAULT_SIZES = "1000x10,50000x50,200000x300"
+MODEL = "gpt-4.1"
+DATA_CONTEXT_TOKENS = 1200
+R_TIMEOUT = 300
+R_PRELUDE = TABLE_HELPERS_R + plot_helpers_r()
+
+QUESTIONS = [
+    "Summarise age and BMI by treatment group",
+    "Plot the BMI distribution by sex",
+    "Make a summary table of age, sex and BMI by group",
+    "Show Kaplan-Meier survival curves by group and fit a Cox model",
+]
+
+# Stages in pipeline order, for reports
+STAGES = [
+    "parse", "profile", "stage", "prewarm", "prompt", "llm_first_token", "llm", "extract",
+    "r_run", "tables", "plots", "export",
+]
+
+
+class StageTimer:
+    """Accumulates wall time (and optionally peak traced memory) per stage."""
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.seconds = {}
+        self.peak_bytes = {}
+
+    def add(self, name, seconds):
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, name):
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+            if self.trace_memory:
+                peak = tracemalloc.get_traced_memory()[1]
+                self.peak_bytes[name] = max(self.peak_bytes.get(name, 0), peak)
+
+
+def find_rscript():
+    """Rscript next to this Python (conda), on PATH, or in the usual places."""
+    candidates = [
+        os.path.join(os.path.dirname(sys.executable), "Rscript"),
+        shutil.which("Rscript"),
+        "/usr/bin/Rscript",
+        "/usr/local/bin/Rscript",
+    ]
+    return next((c for c in candidates if c and os.path.exists(c)), None)
+
+
+def r_version(r_exec):
+    if not r_exec:
+        return None
+    try:
+        result = subprocess.run(
+            [r_exec, "-e", "cat(R.version.string)"], capture_output=True, text=True, timeout=60
+        )
+        return result.stdout.strip() or None
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+
+
+def git_commit():
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True
+        )
+        return result.stdout.strip() or None
+    except OSError:
+        return None
+
+
+class RRunner:
+    """Runs generated code the way the app does: warm pool first, Rscript otherwise."""
+
+    def __init__(self, r_exec, work_dir, use_pool=True):
+        self.r_exec = r_exec
+        self.pool = None
+        self.startup_seconds = None
+        if r_exec and use_pool:
+            start = time.perf_counter()
+            self.pool = RWorkerPool(
+                r_exec, os.path.dirname(sys.executable), size=1,
+                work_dir=os.path.join(work_dir, "r_pool"), prelude=R_PRELUDE,
+            )
+            try:
+                self.pool.warm()
+            except RWorkerError:
+                self.pool = None
+            self.startup_seconds = time.perf_counter() - start
+        # One-shot scripts attach only the libraries the code calls
+        self.exports = None
+        if r_exec and self.pool is None:
+            self.exports = read_r_exports(r_exec, cache_path=os.path.join(work_dir, "r_exports.json"))
+
+    def run(self, code, data_loader_r, output_dir, columns):
+        output_dir_r = output_dir.replace("\\", "/")
+        script_path = os.path.join(output_dir, "script.R")
+        if self.pool is not None:
+            with open(script_path, "w", encoding="utf-8") as f:
+                f.write(build_r_script(code, data_loader_r, output_dir_r, preamble=False, columns=columns))
+            success, _, stderr = self.pool.run(
+                script_path, output_dir, timeout=R_TIMEOUT, dataset=data_loader_r
+            )
+        else:
+            libraries = required_libraries(code, self.exports, prelude=R_PRELUDE)
+            success, stderr = self._run_once(code, data_loader_r, output_dir, columns, libraries)
+            if libraries is not None and not success and is_missing_function_error(stderr):
+                success, stderr = self._run_once(code, data_loader_r, output_dir, columns, None)
+        return success, stderr
+
+    def _run_once(self, code, data_loader_r, output_dir, columns, libraries):
+        script_path = os.path.join(output_dir, "script.R")
+        with open(script_path, "w", encoding="utf-8") as f:
+            f.write(build_r_script(
+                code, data_loader_r, output_dir.replace("\\", "/"), columns=columns,
+                conda_bin_dir=os.path.dirname(sys.executable), prelude=R_PRELUDE,
+                libraries=libraries,
+            ))
+        success, _, stderr = run_script_once(self.r_exec, script_path, output_dir, timeout=R_TIMEOUT)
+        return success, stderr
+
+    def preload(self, data_loader_r):
+        if self.pool is not None:
+            self.pool.preload(data_loader_r, timeout=R_TIMEOUT)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+
+def run_scenario(rows, cols, client, runner, work_dir, timer):
+    """One pass over every question for a ``rows`` x ``cols`` dataset."""
+    data = make_csv(rows, cols)
+
+    with timer.stage("parse"):
+        df = compact_dtypes(read_csv_fast(data))
+    with timer.stage("profile"):
+        data_context = render_context(
+            profile_dataframe(df), token_budget=DATA_CONTEXT_TOKENS, model=MODEL
+        )
+
+    r_exec = runner.r_exec if runner else None
+    with timer.stage("stage"):
+        feather = HAS_PYARROW and bool(r_exec) and r_has_package(r_exec, "arrow")
+        staged = stage_dataset(
+            df, dataset_fingerprint(df), os.path.join(work_dir, "datasets"),
+            feather=feather, csv=not feather,
+        )
+    if runner is not None:
+        # What the app does between the upload and the first question
+        with timer.stage("prewarm"):
+            runner.preload(staged.loader_path_r)
+
+    builder = PromptBuilder(MODEL)
+    artifacts = ArtifactStore(os.path.join(work_dir, "artifacts"))
+    session_id = f"bench_{rows}x{cols}"
+    columns = [str(c) for c in df.columns]
+    messages = []
+    failures = []
+
+    for question in QUESTIONS:
+        messages.append({"role": "user", "content": question})
+        with timer.stage("prompt"):
+            prompt = builder.chat(question, data_context, history=messages[:-1])
+
+        start = time.perf_counter()
+        first_token = None
+        parts = []
+        with timer.stage("llm"):
+            stream = client.chat.completions.create(
+                model=MODEL, messages=prompt.messages, temperature=0.3, max_tokens=2000, stream=True
+            )
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    if first_token is None:
+                        first_token = time.perf_counter() - start
+                    parts.append(chunk.choices[0].delta.content)
+        timer.add("llm_first_token", first_token or 0.0)
+        reply = "".join(parts)
+
+        with timer.stage("extract"):
+            blocks = extract_r_code_blocks(reply)
+
+        for code in blocks:
+            message = {"role": "assistant", "content": reply, "code": code}
+            if runner is None:
+                messages.append(message)
+                continue
+            output_dir = tempfile.mkdtemp(dir=work_dir)
+            try:
+                with timer.stage("r_run"):
+                    success, stderr = runner.run(
+                        code, staged.loader_path_r, output_dir, referenced_columns(code, columns)
+                    )
+                if not success:
+                    failures.append({"question": question, "error": stderr[-500:]})
+                    message["error"] = stderr
+                with timer.stage("tables"):
+                    tables = extract_tables(output_dir)
+                    message["table_artifacts"] = [
+                        artifacts.put_text(t["html"], session_id) if t["html"] is not None
+                        else artifacts.put_file(t["data_path"], session_id)
+                        for t in tables if t["html"] is not None or t["data_path"]
+                    ]
+                with timer.stage("plots"):
+                    optimize_plots(output_dir, max_width=2400)
+                    message["plot_artifacts"] = [
+                        artifacts.put_file(os.path.join(output_dir, f), session_id)
+                        for f in sorted(os.listdir(output_dir)) if f.endswith(".png")
+                    ]
+            finally:
+                shutil.rmtree(output_dir, ignore_errors=True)
+            messages.append(message)
+
+    with timer.stage("export"):
+        write_report_html(os.path.join(work_dir, f"{session_id}.html"), messages, artifacts, df)
+    return failures
+
+
+def summarize(samples):
+    return {
+        "median_s": round(statistics.median(samples), 6),
+        "min_s": round(min(samples), 6),
+        "max_s": round(max(samples), 6),
+        "runs_s": [round(s, 6) for s in samples],
+    }
+
+
+def benchmark(args):
+    sizes = [tuple(int(n) for n in size.lower().split("x")) for size in args.sizes.split(",")]
+    r_exec = None if args.no_r else find_rscript()
+    work_dir = tempfile.mkdtemp(prefix="ask_csv_bench_")
+    server = FakeOpenAIServer(
+        load_replies(args.replies), ttft=args.ttft, tokens_per_second=args.tokens_per_second
+    ).start()
+    client = openai.OpenAI(base_url=server.base_url, api_key="benchmark")
+    runner = RRunner(r_exec, work_dir, use_pool=not args.no_pool) if r_exec else None
+
+    results = {
+        "schema": SCHEMA_VERSION,
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "r_version": r_version(r_exec),
+        "config": {
+            "repeat": args.repeat,
+            "ttft": args.ttft,
+            "tokens_per_second": args.tokens_per_second,
+            "r_pool": runner is not None and runner.pool is not None,
+            "questions": len(QUESTIONS),
+        },
+        "setup": {"r_pool_start_s": runner.startup_seconds if runner else None},
+        "scenarios": [],
+    }
+    try:
+        for rows, cols in sizes:
+            name = f"{rows}x{cols}"
+            print(f"[{name}] ", end="", flush=True)
+            timings = {}
+            failures = []
+            for _ in range(args.repeat):
+                # Fresh work dirs so staging and artifacts are not already cached
+                run_dir = tempfile.mkdtemp(dir=work_dir)
+                timer = StageTimer()
+                failures = run_scenario(rows, cols, client, runner, run_dir, timer)
+                for stage, seconds in timer.seconds.items():
+                    timings.setdefault(stage, []).append(seconds)
+                shutil.rmtree(run_dir, ignore_errors=True)
+                print(".", end="", flush=True)
+
+            peaks = {}
+            if args.memory:
+                run_dir = tempfile.mkdtemp(dir=work_dir)
+                timer = StageTimer(trace_memory=True)
+                tracemalloc.start()
+                try:
+                    run_scenario(rows, cols, client, runner, run_dir, timer)
+                finally:
+                    tracemalloc.stop()
+                    shutil.rmtree(run_dir, ignore_errors=True)
+                peaks = timer.peak_bytes
+                print("m", end="", flush=True)
+
+            stages = {}
+            for stage in STAGES:
+                if stage not in timings:
+                    stages[stage] = {"skipped": True}
+                    continue
+                stages[stage] = summarize(timings[stage])
+                if stage in peaks:
+                    stages[stage]["peak_mb"] = round(peaks[stage] / 1024 ** 2, 2)
+            total = [sum(run) for run in zip(*(timings[s] for s in timings if s != "llm_first_token"))]
+            results["scenarios"].append({
+                "name": name,
+                "rows": rows,
+                "cols": cols,
+                "stages": stages,
+                "total": summarize(total),
+                "r_failures": failures,
+            })
+            print(f" {statistics.median(total):.2f}s")
+    finally:
+        if runner is not None:
+            runner.close()
+        server.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def print_results(results):
+    for scenario in results["scenarios"]:
+        print(f"\n{scenario['name']}  (total median {scenario['total']['median_s']:.3f}s)")
+        for stage in STAGES:
+            entry = scenario["stages"][stage]
+            if entry.get("skipped"):
+                print(f"  {stage:<16} skipped")
+                continue
+            peak = f"  peak {entry['peak_mb']:.1f} MB" if "peak_mb" in entry else ""
+            print(f"  {stage:<16} {entry['median_s'] * 1000:10.1f} ms{peak}")
+        for failure in scenario["r_failures"]:
+            print(f"  ! R failed for {failure['question']!r}: {failure['error'].strip()[-200:]}")
+
+
+def compare(baseline, results, threshold, min_delta):
+    """Print per-stage changes against ``baseline``; return the regressions found."""
+    regressions = []
+    previous = {s["name"]: s for s in baseline.get("scenarios", [])}
+    print(f"\nCompared with {baseline.get('git_commit') or 'baseline'} ({baseline.get('created')}):")
+    for scenario in results["scenarios"]:
+        old = previous.get(scenario["name"])
+        if old is None:
+            print(f"  {scenario['name']}: not in baseline")
+            continue
+        for stage in STAGES + ["total"]:
+            new_entry = scenario["total"] if stage == "total" else scenario["stages"].get(stage, {})
+            old_entry = old["total"] if stage == "total" else old["stages"].get(stage, {})
+            if "median_s" not in new_entry or "median_s" not in old_entry:
+                continue
+            before, after = old_entry["median_s"], new_entry["median_s"]
+            change = (after - before) / before if before else 0.0
+            flag = ""
+            if change > threshold and after - before > min_delta:
+                flag = "  REGRESSION"
+                regressions.append((scenario["name"], stage, before, after))
+            print(f"  {scenario['name']:<14} {stage:<16} {before * 1000:9.1f} -> {after * 1000:9.1f} ms ({change:+.0%}){flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end latency benchmarks")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="comma-separated ROWSxCOLS")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--no-memory", dest="memory", action="store_false",
+                        help="skip the tracemalloc pass")
+    parser.add_argument("--no-r", action="store_true", help="skip R execution stages")
+    parser.add_argument("--no-pool", action="store_true", help="run R with one Rscript per block")
+    parser.add_argument("--replies", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "replies.json"))
+    parser.add_argument("--ttft", type=float, default=0.0, help="simulated time to first token (s)")
+    parser.add_argument("--tokens-per-second", type=float, default=0.0, help="simulated output speed, 0 = instant")
+    parser.add_argument("--out", help="result file (default: benchmarks/results/<timestamp>.json)")
+    parser.add_argument("--compare", help="baseline result file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.15, help="relative slowdown that fails the run")
+    parser.add_argument("--min-delta", type=float, default=0.01, help="ignore slowdowns below this many seconds")
+    args = parser.parse_args()
+
+    results = benchmark(args)
+    print_results(results)
+
+    out = args.out or os.path.join(
+        RESULTS_DIR, datetime.datetime.now().strftime("%Y%m%d-%H%M%S") + ".json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {out}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("schema") != SCHEMA_VERSION:
+            print(f"Baseline schema {baseline.get('schema')} != {SCHEMA_VERSION}; not comparing")
+            return 0
+        regressions = compare(baseline, results, args.threshold, args.min_delta)
+        if regressions:
+            print(f"\n{len(regressions)} stage(s) slower than {args.threshold:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,40 @@
+"""Synthetic clinical-style datasets for the benchmarks.
+
+Every dataset has the columns the recorded replies use (age, sex, group, bmi,
+time, status) plus filler lab values and categorical visit fields up to the
+requested width, and is generated deterministically from its size.
+"""
+import numpy as np
+import pandas as pd
+
+CORE_COLUMNS = ["patient_id", "age", "sex", "group", "bmi", "time", "status", "visit_date"]
+
+
+def make_dataframe(rows, cols, seed=0):
+    """A ``rows`` x ``max(cols, 8)`` frame with realistic dtypes and some missing values."""
+    rng = np.random.default_rng(seed + rows * 7919 + cols)
+    data = {
+        "patient_id": [f"P{i:07d}" for i in range(rows)],
+        "age": rng.integers(18, 90, rows),
+        "sex": rng.choice(["Female", "Male"], rows),
+        "group": rng.choice(["A", "B", "C"], rows),
+        "bmi": np.round(rng.normal(26, 4, rows), 1),
+        "time": np.round(rng.exponential(500, rows), 0),
+        "status": rng.integers(0, 2, rows),
+        "visit_date": (
+            pd.Timestamp("2015-01-01") + pd.to_timedelta(rng.integers(0, 3000, rows), unit="D")
+        ).strftime("%Y-%m-%d"),
+    }
+    for i in range(max(cols - len(CORE_COLUMNS), 0)):
+        if i % 4 == 3:
+            data[f"site_{i:03d}"] = rng.choice(["north", "south", "east", "west", "central"], rows)
+        else:
+            values = np.round(rng.lognormal(1.0, 0.5, rows), 3)
+            values[rng.random(rows) < 0.05] = np.nan
+            data[f"lab_{i:03d}"] = values
+    return pd.DataFrame(data)
+
+
+def make_csv(rows, cols, seed=0):
+    """CSV bytes as a user would upload them."""
+    return make_dataframe(rows, cols, seed).to_csv(index=False).encode("utf-8")
@@ -0,0 +1,55 @@
+"""Extraction of ```r code blocks from model replies, whole or streamed."""
+
+
+def _normalize(text):
+    return text.replace("```R", "```r")
+
+
+def extract_r_code_blocks(reply):
+    """Return the R code blocks in a complete reply.
+
+    An unterminated last block is returned up to the end of the reply.
+    """
+    return [block.split("```")[0] for block in _normalize(reply).split("```r")[1:]]
+
+
+class RCodeBlockStream:
+    """Incrementally detect completed ```r blocks while a reply streams in.
+
+    ``feed()`` returns the blocks whose closing fence arrived with the new
+    text; ``close()`` returns a trailing unterminated block, if any. Together
+    they yield exactly what ``extract_r_code_blocks`` returns for the full text.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self._pos = 0
+
+    def feed(self, delta):
+        self.text += delta
+        blocks = []
+        while True:
+            block = self._next_block(final=False)
+            if block is None:
+                return blocks
+            blocks.append(block)
+
+    def close(self):
+        block = self._next_block(final=True)
+        return [] if block is None else [block]
+
+    def _next_block(self, final):
+        text = _normalize(self.text)
+        start = text.find("```r", self._pos)
+        if start == -1:
+            return None
+        body_start = start + len("```r")
+        end = text.find("```", body_start)
+        if end == -1:
+            if not final:
+                return None
+            end = len(text)
+        # Resume after the opening fence: like str.split, a fence that closes
+        # this block does not also end the scan for the next opening one
+        self._pos = end
+        return text[body_start:end]
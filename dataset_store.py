@@ -0,0 +1,301 @@
+"""Write-once staging of the uploaded dataset for R.
+
+The DataFrame is materialized once per content hash as an uncompressed
+Feather (Arrow IPC) file, which R memory-maps with ``arrow::read_feather``.
+A generated ``load.R`` restores the column types pandas inferred, and falls
+back to ``read.csv`` with explicit ``colClasses`` when the R side lacks the
+arrow package. When ``.df_columns`` is set before sourcing it, only those
+columns are read.
+
+``StagingArea`` bounds the staged copies on disk: directories unused for
+longer than a TTL, and the least recently used ones past a size cap, are
+removed, except those leased by a running question.
+"""
+import functools
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+
+import pandas as pd
+
+try:
+    import pyarrow  # noqa: F401  (needed by DataFrame.to_feather)
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+LOADER_TEMPLATE = """# Generated by Ask Your CSV: loads the dataset staged for {data_hash}
+df <- local({{
+    col_types <- c({col_types})
+    feather_path <- "{feather_path}"
+    csv_path <- "{csv_path}"
+    # Callers may restrict loading to the columns their code uses
+    keep <- if (exists(".df_columns")) names(col_types) %in% .df_columns else rep(TRUE, length(col_types))
+    if (file.exists(feather_path) && requireNamespace("arrow", quietly = TRUE)) {{
+        df <- as.data.frame(arrow::read_feather(
+            feather_path, col_select = tidyselect::all_of(names(col_types)[keep])
+        ))
+    }} else if (file.exists(csv_path)) {{
+        csv_classes <- unname(ifelse(col_types == "POSIXct", "character", col_types))
+        csv_classes[!keep] <- "NULL"
+        df <- read.csv(csv_path, colClasses = csv_classes, check.names = FALSE,
+                       na.strings = c("NA", ""))
+    }} else {{
+        stop("Dataset staged without CSV fallback and the 'arrow' package is not installed")
+    }}
+    col_types <- col_types[keep]
+    for (col in names(col_types)) {{
+        df[[col]] <- switch(col_types[[col]],
+            integer = as.integer(df[[col]]),
+            numeric = as.numeric(df[[col]]),
+            logical = as.logical(df[[col]]),
+            character = as.character(df[[col]]),
+            POSIXct = as.POSIXct(df[[col]], tz = "UTC"),
+            df[[col]]
+        )
+    }}
+    df
+}})
+"""
+
+INT32_MAX = 2 ** 31 - 1
+
+
+def r_string(value):
+    """Quote a Python string as an R string literal."""
+    escaped = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return f'"{escaped}"'
+
+
+def dataset_fingerprint(df):
+    """Content hash of a DataFrame (values, column names and dtypes)."""
+    h = hashlib.sha256()
+    h.update(json.dumps(
+        [[str(c) for c in df.columns], df.dtypes.astype(str).tolist()]
+    ).encode("utf-8"))
+    h.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return h.hexdigest()[:32]
+
+
+def r_column_type(series):
+    """Map a pandas dtype to the R class the column should have."""
+    dtype = series.dtype
+    if pd.api.types.is_bool_dtype(dtype):
+        return "logical"
+    if pd.api.types.is_integer_dtype(dtype):
+        # R integers are 32-bit; anything wider stays double like read.csv does
+        if len(series) and series.notna().any():
+            if series.max() > INT32_MAX or series.min() < -INT32_MAX:
+                return "numeric"
+        return "integer"
+    if pd.api.types.is_numeric_dtype(dtype):
+        return "numeric"
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return "POSIXct"
+    # object and (string) categorical columns are plain character vectors in R
+    return "character"
+
+
+def r_column_types(df):
+    return {str(col): r_column_type(df[col]) for col in df.columns}
+
+
+@functools.lru_cache(maxsize=None)
+def r_has_package(r_exec, package):
+    """Whether the R installation can load ``package`` (checked once per process)."""
+    try:
+        result = subprocess.run(
+            [r_exec, "-e", f'cat(requireNamespace("{package}", quietly = TRUE))'],
+            capture_output=True,
+            text=True,
+            timeout=60,
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    return "TRUE" in result.stdout
+
+
+class StagedDataset:
+    """A dataset materialized on disk for R, identified by its content hash."""
+
+    def __init__(self, data_hash, directory):
+        self.data_hash = data_hash
+        self.directory = directory
+        self.loader_path = os.path.join(directory, "load.R")
+        self.feather_path = os.path.join(directory, "data.feather")
+        self.csv_path = os.path.join(directory, "data.csv")
+        # Marker left when Arrow could not convert the frame, so we don't retry
+        self.no_feather_path = os.path.join(directory, "feather.unsupported")
+
+    @property
+    def loader_path_r(self):
+        return self.loader_path.replace("\\", "/")
+
+    def has_formats(self, feather, csv):
+        return (
+            os.path.exists(self.loader_path)
+            and (
+                not feather
+                or os.path.exists(self.feather_path)
+                or os.path.exists(self.no_feather_path)
+            )
+            and (not csv or os.path.exists(self.csv_path))
+        )
+
+
+def _write_atomic(path, write):
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def stage_dataset(df, data_hash, root_dir, feather=True, csv=True):
+    """Materialize ``df`` under ``root_dir/<data_hash>`` unless already there.
+
+    ``feather`` is ignored when pyarrow is unavailable or the frame cannot be
+    converted to Arrow; in that case a CSV copy is always written.
+    """
+    staged = StagedDataset(data_hash, os.path.join(root_dir, data_hash))
+    feather = feather and HAS_PYARROW
+    if staged.has_formats(feather, csv):
+        return staged
+    os.makedirs(staged.directory, exist_ok=True)
+
+    frame = df.reset_index(drop=True)
+    if os.path.exists(staged.no_feather_path):
+        feather = False
+    if feather and not os.path.exists(staged.feather_path):
+        try:
+            _write_atomic(
+                staged.feather_path,
+                lambda p: frame.to_feather(p, compression="uncompressed"),
+            )
+        except Exception:
+            # e.g. mixed-type object columns Arrow refuses to convert
+            feather = False
+            open(staged.no_feather_path, "w").close()
+    if (csv or not feather) and not os.path.exists(staged.csv_path):
+        _write_atomic(staged.csv_path, lambda p: frame.to_csv(p, index=False))
+
+    col_types = ", ".join(
+        f"{r_string(name)} = {r_string(rtype)}"
+        for name, rtype in r_column_types(frame).items()
+    )
+    loader = LOADER_TEMPLATE.format(
+        data_hash=data_hash,
+        col_types=col_types,
+        feather_path=staged.feather_path.replace("\\", "/"),
+        csv_path=staged.csv_path.replace("\\", "/"),
+    )
+
+    def _write_loader(path):
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(loader)
+
+    _write_atomic(staged.loader_path, _write_loader)
+    return staged
+
+
+class StagingArea:
+    """Staged datasets under ``root`` with TTL and LRU size eviction (thread-safe).
+
+    A directory's modification time records its last use. Datasets leased
+    with ``lease`` (by running jobs) are never removed; ``discard`` of a
+    leased dataset takes effect when the last lease ends.
+    """
+
+    def __init__(self, root, max_bytes=5 * 1024 ** 3, ttl=24 * 3600):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.stats = {"evicted": 0}
+        self._leases = Counter()
+        self._discarded = set()
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def stage(self, df, data_hash, feather=True, csv=True):
+        with self.lease(data_hash):
+            staged = stage_dataset(df, data_hash, self.root, feather=feather, csv=csv)
+            _touch(staged.directory)
+        self.sweep()
+        return staged
+
+    @contextmanager
+    def lease(self, data_hash):
+        """Keep ``data_hash`` staged while the block runs."""
+        with self._lock:
+            self._leases[data_hash] += 1
+            self._discarded.discard(data_hash)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._leases[data_hash] -= 1
+                if self._leases[data_hash] <= 0:
+                    del self._leases[data_hash]
+                    if data_hash in self._discarded:
+                        self._discarded.discard(data_hash)
+                        self._remove(data_hash)
+            _touch(os.path.join(self.root, data_hash))
+
+    def discard(self, data_hash):
+        """Remove a dataset nobody needs any more (once its leases end)."""
+        with self._lock:
+            if self._leases[data_hash] > 0:
+                self._discarded.add(data_hash)
+            else:
+                self._remove(data_hash)
+
+    def sweep(self):
+        """Remove expired datasets, then the least recently used over the cap."""
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            try:
+                entries.append((os.path.getmtime(path), _dir_size(path), name))
+            except OSError:
+                continue
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        with self._lock:
+            for mtime, size, name in entries:
+                if now - mtime <= self.ttl and total <= self.max_bytes:
+                    break
+                if self._leases[name] > 0:
+                    continue
+                self._remove(name)
+                total -= size
+
+    def _remove(self, data_hash):
+        path = os.path.join(self.root, data_hash)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+            self.stats["evicted"] += 1
+
+
+def _touch(path):
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def _dir_size(path):
+    return sum(
+        os.path.getsize(os.path.join(dirpath, name))
+        for dirpath, _, names in os.walk(path)
+        for name in names
+    )
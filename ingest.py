@@ -0,0 +1,215 @@
+"""CSV ingestion for the sidebar uploader.
+
+Parsing, dtype compaction, the data summary and the column profile are
+computed once per file content hash and kept in a small process-wide cache (callers that
+hold the parsed dataset themselves can opt out), so Streamlit reruns
+(every chat turn) reuse them instead of re-reading the upload.
+"""
+import datetime
+import hashlib
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+
+from profiling import get_profile
+
+try:
+    import pyarrow  # noqa: F401  (enables pd.read_csv(engine="pyarrow"))
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+# Files above this size are parsed in chunks so progress can be reported
+CHUNKED_PARSE_BYTES = 50 * 1024 * 1024
+CHUNK_ROWS = 200_000
+
+# Object columns become categoricals when they repeat values this much
+CATEGORY_MAX_RATIO = 0.5
+CATEGORY_MAX_LEVELS = 1000
+
+# Text columns whose values all look like this are parsed as datetimes
+ISO_DATETIME = r"\d{4}-\d{2}-\d{2}(?:[T ]\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?(?:Z|[+-]\d{2}:?\d{2})?)?"
+DATETIME_SAMPLE = 1000
+
+_CACHE_SIZE = 4
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def file_content_hash(data):
+    """SHA-256 of the uploaded bytes, used as the dataset's identity."""
+    return hashlib.sha256(data).hexdigest()[:32]
+
+
+def read_csv_fast(data, progress=None):
+    """Parse CSV bytes with the fastest engine available.
+
+    Large files are read in chunks and ``progress(fraction)`` is called after
+    each one; smaller files use the multi-threaded pyarrow engine when present.
+    Either way the result goes through ``normalize_dtypes``, so a column's
+    type does not depend on which engine read it.
+    """
+    return normalize_dtypes(_read_csv(data, progress))
+
+
+def _read_csv(data, progress):
+    if len(data) > CHUNKED_PARSE_BYTES:
+        buffer = BytesIO(data)
+        chunks = []
+        for chunk in pd.read_csv(buffer, chunksize=CHUNK_ROWS):
+            chunks.append(chunk)
+            if progress:
+                progress(min(buffer.tell() / len(data), 1.0))
+        if not chunks:
+            return pd.read_csv(BytesIO(data))
+        return pd.concat(chunks, ignore_index=True)
+
+    if HAS_PYARROW:
+        try:
+            return pd.read_csv(BytesIO(data), engine="pyarrow")
+        except Exception:
+            # The pyarrow engine is stricter; let the C parser have a go
+            pass
+    return pd.read_csv(BytesIO(data))
+
+
+def _datetime_column(s):
+    """``s`` as datetime64 if every value is an ISO date/time (or a date object), else None."""
+    values = s.dropna()
+    if values.empty:
+        return None
+    if all(isinstance(v, datetime.date) for v in values.iloc[:DATETIME_SAMPLE]):
+        # The pyarrow engine returns date columns as datetime.date objects
+        values = values.astype(str)
+    elif not all(isinstance(v, str) for v in values.iloc[:DATETIME_SAMPLE]):
+        return None
+    # A sample rejects most text columns before the whole column is scanned
+    if not values.iloc[:DATETIME_SAMPLE].str.fullmatch(ISO_DATETIME, na=False).all():
+        return None
+    if not values.str.fullmatch(ISO_DATETIME, na=False).all():
+        return None
+    try:
+        parsed = pd.to_datetime(values, format="ISO8601", utc=True)
+    except (ValueError, TypeError, OverflowError):
+        return None
+    return parsed.dt.tz_localize(None).reindex(s.index)
+
+
+def normalize_dtypes(df):
+    """Give columns the same types whichever engine parsed them.
+
+    The pyarrow engine reads ISO dates and timestamps as datetimes (dates as
+    ``datetime.date`` objects, offsets as tz-aware columns) while the C parser
+    leaves them as text. Both end up as naive UTC datetime64[ns] here.
+    """
+    for col in df.columns:
+        s = df[col]
+        if s.dtype == object:
+            parsed = _datetime_column(s)
+            if parsed is not None:
+                df[col] = parsed
+        elif isinstance(s.dtype, pd.DatetimeTZDtype):
+            df[col] = s.dt.tz_convert("UTC").dt.tz_localize(None).astype("datetime64[ns]")
+        elif pd.api.types.is_datetime64_dtype(s.dtype):
+            df[col] = s.astype("datetime64[ns]")
+    return df
+
+
+def compact_dtypes(df):
+    """Downcast numerics and categorize repetitive strings without losing data.
+
+    Floats are only narrowed to float32 when every value survives the round
+    trip, so R sees exactly the numbers pandas parsed.
+    """
+    compacted = {}
+    n_rows = max(len(df), 1)
+    for col in df.columns:
+        s = df[col]
+        if pd.api.types.is_bool_dtype(s.dtype):
+            compacted[col] = s
+        elif pd.api.types.is_integer_dtype(s.dtype):
+            compacted[col] = pd.to_numeric(s, downcast="integer")
+        elif pd.api.types.is_float_dtype(s.dtype):
+            narrow = s.astype("float32")
+            lossless = np.array_equal(
+                narrow.to_numpy(dtype="float64"), s.to_numpy(dtype="float64"), equal_nan=True
+            )
+            compacted[col] = narrow if lossless else s
+        elif s.dtype == object:
+            n_unique = s.nunique(dropna=True)
+            if (
+                0 < n_unique <= CATEGORY_MAX_LEVELS
+                and n_unique / n_rows <= CATEGORY_MAX_RATIO
+                and pd.api.types.infer_dtype(s, skipna=True) == "string"
+            ):
+                compacted[col] = s.astype("category")
+            else:
+                compacted[col] = s
+        else:
+            compacted[col] = s
+    return pd.DataFrame(compacted, index=df.index)
+
+
+def summarize_dataframe(df):
+    """Data summary used for the sidebar (the LLM context uses the profile)."""
+    return {
+        "shape": df.shape,
+        "columns": df.columns.tolist(),
+        "dtypes": df.dtypes.astype(str).to_dict(),
+        "missing": int(df.isnull().sum().sum()),
+    }
+
+
+class IngestedDataset:
+    """Everything derived from one uploaded file."""
+
+    def __init__(self, file_hash, df, summary, profile, memory_before, memory_after):
+        self.file_hash = file_hash
+        self.df = df
+        self.summary = summary
+        self.profile = profile
+        self.memory_before = memory_before
+        self.memory_after = memory_after
+
+
+def ingest_csv(data, file_hash=None, progress=None, cache=True):
+    """Parse, compact and summarize CSV bytes, reusing cached results by hash.
+
+    With ``cache=False`` the result is neither looked up nor kept, for
+    callers that hold parsed datasets themselves.
+    """
+    file_hash = file_hash or file_content_hash(data)
+    with _cache_lock:
+        if cache and file_hash in _cache:
+            _cache.move_to_end(file_hash)
+            return _cache[file_hash]
+
+    raw = read_csv_fast(data, progress=progress)
+    memory_before = int(raw.memory_usage(deep=True).sum())
+    df = compact_dtypes(raw)
+    del raw
+    memory_after = int(df.memory_usage(deep=True).sum())
+
+    ingested = IngestedDataset(
+        file_hash, df, summarize_dataframe(df), get_profile(df, file_hash),
+        memory_before, memory_after
+    )
+    if cache:
+        with _cache_lock:
+            _cache[file_hash] = ingested
+            while len(_cache) > _CACHE_SIZE:
+                _cache.popitem(last=False)
+    return ingested
+
+
+def format_bytes(n):
+    if n < 1024:
+        return f"{int(n)} B"
+    for unit in ("KB", "MB"):
+        n /= 1024
+        if n < 1024:
+            return f"{n:.1f} {unit}"
+    return f"{n / 1024:.1f} GB"
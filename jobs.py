@@ -0,0 +1,158 @@
+"""Background jobs for answering questions without blocking the Streamlit script.
+
+A job runs the question pipeline on an executor thread. Instead of drawing
+Streamlit elements directly, the pipeline talks to a ``JobUI`` that records
+every call; the app replays the recorded calls each time it polls the job, so
+the chat shows progress while the script thread stays free for other input.
+"""
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+class JobCancelled(Exception):
+    """Raised inside a job's pipeline once the user has cancelled it."""
+
+
+class CancelScope:
+    """A cancel flag that also reads as set once its parent (e.g. the job's) is.
+
+    Setting the scope only stops what was started with it, such as the
+    losing candidates of a parallel auto-fix.
+    """
+
+    def __init__(self, parent=None):
+        self._parent = parent
+        self._event = threading.Event()
+
+    def set(self):
+        self._event.set()
+
+    def is_set(self):
+        return self._event.is_set() or (self._parent is not None and self._parent.is_set())
+
+
+class Job:
+    """State of one background question, shared between worker and UI threads."""
+
+    def __init__(self, owner, cancel_event=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.owner = owner
+        self.status = "queued"
+        self.stage = "Queued"
+        self.reply = ""
+        self.reply_done = False
+        self.messages = []
+        self.state_updates = {}
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.attached = False
+        self.cancel_event = cancel_event or threading.Event()
+        self._events = []
+        self._lock = threading.Lock()
+
+    def add_event(self, name, args, kwargs):
+        with self._lock:
+            self._events.append((name, args, kwargs))
+
+    def events(self):
+        with self._lock:
+            return list(self._events)
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    @property
+    def done(self):
+        return self.status in ("done", "failed", "cancelled")
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+
+class JobUI:
+    """Stand-in for the ``st`` module that records calls on a job.
+
+    ``ui.warning(...)``, ``ui.code(...)`` etc. are stored as events; the reply
+    text and the current stage are kept separately because they are updated in
+    place rather than appended.
+    """
+
+    def __init__(self, job):
+        self._job = job
+
+    def reply(self, text, done=True):
+        self._job.reply = text
+        self._job.reply_done = done
+
+    def stage(self, text):
+        self._job.stage = text
+
+    def __getattr__(self, name):
+        def record(*args, **kwargs):
+            self._job.add_event(name, args, kwargs)
+        return record
+
+
+class JobManager:
+    """Process-wide executor and registry for question jobs."""
+
+    def __init__(self, max_workers=8, retention=3600):
+        self.retention = retention
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="question")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, owner, fn, *args, cancel_event=None, **kwargs):
+        """Run ``fn(job, ui, *args, **kwargs)`` in the background.
+
+        ``fn`` returns the assistant messages to attach to the conversation.
+        Pass ``cancel_event`` when the work already watches an event (e.g. R
+        executions prepared before the job existed) so ``cancel()`` sets it.
+        """
+        self.cleanup()
+        job = Job(owner, cancel_event)
+        with self._lock:
+            self._jobs[job.id] = job
+
+        def run():
+            job.started = time.time()
+            job.status = "running"
+            try:
+                if job.cancelled:
+                    raise JobCancelled()
+                job.messages = fn(job, JobUI(job), *args, **kwargs) or []
+                job.status = "cancelled" if job.cancelled else "done"
+            except JobCancelled:
+                job.status = "cancelled"
+            except Exception as e:
+                job.error = str(e)
+                job.status = "failed"
+            finally:
+                job.finished = time.time()
+
+        self._executor.submit(run)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cleanup(self):
+        """Forget finished jobs older than the retention period."""
+        cutoff = time.time() - self.retention
+        with self._lock:
+            for job_id in [
+                j.id for j in self._jobs.values() if j.finished and j.finished < cutoff
+            ]:
+                del self._jobs[job_id]
@@ -0,0 +1,153 @@
+"""Two-tier cache for chat completion replies.
+
+Replies are keyed on everything that determines them: model, sampling
+parameters, the (whitespace-normalized) messages and the dataset hash. An
+in-memory LRU sits in front of a SQLite table shared by all sessions of the
+server; both tiers honour a TTL and the SQLite tier is capped in size.
+"""
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_text(text):
+    """Collapse runs of whitespace so indentation changes don't miss the cache."""
+    return _WHITESPACE.sub(" ", text or "").strip()
+
+
+class LLMCache:
+    """Memory LRU + SQLite cache with TTL, size-based eviction and counters."""
+
+    def __init__(self, path, max_memory_entries=256, max_disk_bytes=200 * 1024 ** 2,
+                 ttl=7 * 24 * 3600):
+        self.path = path
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl = ttl
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0}
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+                " created REAL NOT NULL, last_access REAL NOT NULL, size INTEGER NOT NULL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS responses_last_access ON responses(last_access)"
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def make_key(model, messages, dataset_hash=None, **params):
+        payload = {
+            "model": model,
+            "dataset": dataset_hash,
+            "params": params,
+            "messages": [
+                {"role": m["role"], "content": normalize_text(m["content"])}
+                for m in messages
+            ],
+        }
+        raw = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                value, created = entry
+                if now - created <= self.ttl:
+                    self._memory.move_to_end(key)
+                    self.stats["memory_hits"] += 1
+                    return value
+                del self._memory[key]
+
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT value, created FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and now - row[1] > self.ttl:
+                    conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    row = None
+                if row is None:
+                    self.stats["misses"] += 1
+                    return None
+                conn.execute(
+                    "UPDATE responses SET last_access = ? WHERE key = ?", (now, key)
+                )
+
+            self._remember(key, row[0], row[1])
+            self.stats["disk_hits"] += 1
+            return row[0]
+
+    def put(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._remember(key, value, now)
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, created, last_access, size)"
+                    " VALUES (?, ?, ?, ?, ?)",
+                    (key, value, now, now, len(value.encode("utf-8"))),
+                )
+                self._evict(conn, now)
+            self.stats["stores"] += 1
+
+    def _remember(self, key, value, created):
+        self._memory[key] = (value, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _evict(self, conn, now):
+        conn.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_disk_bytes:
+            return
+        # Drop least recently used rows until we're back under the cap
+        excess = total - self.max_disk_bytes
+        freed = 0
+        stale = []
+        for key, size in conn.execute(
+            "SELECT key, size FROM responses ORDER BY last_access ASC"
+        ).fetchall():
+            stale.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        conn.executemany("DELETE FROM responses WHERE key = ?", stale)
+        for (key,) in stale:
+            self._memory.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            with self._connect() as conn:
+                conn.execute("DELETE FROM responses")
+
+    @property
+    def hits(self):
+        return self.stats["memory_hits"] + self.stats["disk_hits"]
+
+    @property
+    def misses(self):
+        return self.stats["misses"]
@@ -0,0 +1,80 @@
+"""Plot output from R: render defaults and PNG recompression.
+
+Generated code saves plots with ``ggsave`` at whatever resolution it asks
+for, 300 dpi unless told otherwise, which makes a 10 x 6 inch plot a
+3000 x 1800 pixel PNG that R is slow to write and the browser slow to load.
+``plot_helpers_r`` wraps ``ggsave`` so plots are rendered at a screen
+resolution instead. ``optimize_plots`` then rewrites the PNGs R left behind
+losslessly (a palette image when the plot has few enough colors, which most
+charts do) and scales down any wider than a cap, so smaller files reach the
+artifact store, the result cache and the browser.
+"""
+import os
+
+try:
+    from PIL import Image, ImageChops
+    HAS_PIL = True
+except ImportError:
+    HAS_PIL = False
+
+# Plots whose PNG saves less than this are left as R wrote them
+MIN_SAVING = 0.05
+
+
+def plot_helpers_r(dpi=150):
+    """R code wrapping ``ggsave`` so plots are saved at no more than ``dpi``."""
+    return f"""
+ggsave <- function(filename, plot = ggplot2::last_plot(), ..., dpi = {dpi}) {{
+    if (is.character(dpi)) dpi <- switch(dpi, screen = 72, print = 300, retina = 320, {dpi})
+    ggplot2::ggsave(filename, plot, ..., dpi = min(dpi, {dpi}))
+}}
+"""
+
+
+def _palette(img):
+    """``img`` as a palette image if that loses nothing, else None."""
+    if img.mode == "RGBA" and img.getchannel("A").getextrema() == (255, 255):
+        img = img.convert("RGB")
+    if img.mode != "RGB":
+        return None
+    colors = img.getcolors(256)
+    if colors is None:
+        return None
+    paletted = img.quantize(colors=len(colors))
+    # Quantizing is exact with a slot per color, but check rather than trust it
+    if ImageChops.difference(paletted.convert("RGB"), img).getbbox() is not None:
+        return None
+    return paletted
+
+
+def optimize_png(path, max_width=None):
+    """Rewrite a PNG smaller; returns the bytes saved (0 if left unchanged)."""
+    if not HAS_PIL:
+        return 0
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        size = os.path.getsize(path)
+        with Image.open(path) as img:
+            img.load()
+        if max_width and img.width > max_width:
+            height = round(img.height * max_width / img.width)
+            img = img.resize((max_width, height), Image.LANCZOS)
+        img = _palette(img) or img
+        img.save(tmp, format="PNG", optimize=True)
+        saved = size - os.path.getsize(tmp)
+        if saved > size * MIN_SAVING:
+            os.replace(tmp, path)
+            return saved
+    except Exception:
+        # Unreadable or unwritable: keep R's file
+        pass
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    return 0
+
+
+def optimize_plots(output_dir, max_width=None):
+    """Optimize every PNG in ``output_dir``; returns ``(plots, bytes saved)``."""
+    plot_files = [f for f in os.listdir(output_dir) if f.endswith(".png")]
+    saved = sum(optimize_png(os.path.join(output_dir, f), max_width) for f in plot_files)
+    return len(plot_files), saved
@@ -0,0 +1,291 @@
+"""Pre-flight checks of generated R code, before it is run.
+
+A run pays for the preamble and the data load, then for whatever the code
+does before it reaches its mistake, sometimes a model fit. ``check_code``
+looks for the obvious problems first and reports them the way R would, so
+they go straight to the repair rules:
+
+- syntax errors, from R's own parser in a warm worker without libraries
+  (``RParser``), and string escapes R rejects,
+- Windows file paths,
+- ``df$col`` / ``df[["col"]]`` for columns the dataset does not have,
+- calls to functions nothing attached defines,
+- save calls the repair rules know to be wrong.
+
+The parser and the escapes are certain; the other checks are heuristics.
+Plots and tables that are built but never saved do not stop the code from
+running (it may print what matters); ``code_warnings`` reports them so a
+fix round after a failed run can address them too.
+"""
+import os
+import re
+import tempfile
+import threading
+
+from r_libraries import undefined_functions
+from r_repair import fix_ggsurvplot_save
+from r_worker import RWorker, RWorkerError, write_worker_bootstrap
+
+_TOKEN = re.compile(r"""
+    (?P<comment>\#[^\n]*)
+  | (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+  | (?P<name>`(?:[^`\\]|\\.)*`|(?:[A-Za-z]|\.(?!\d))[\w.]*)
+  | (?P<op>%[^%\n]*%|<<-|->>|<-|->|:::|::|==|[$@=(){}\[\],;])
+  | (?P<other>\S)
+""", re.X)
+
+# Characters R accepts after a backslash in a string literal
+_VALID_ESCAPES = set("nrtbafv\\'\"` \n01234567")
+_HEX = set("0123456789abcdefABCDEF{")
+_WINDOWS_PATH = re.compile(r"^(?:[A-Za-z]:[\\/]|\\\\)")
+
+# Builders of plots and tables, which the app only shows once saved to a file
+PLOT_FUNCTIONS = {
+    "ggplot", "ggsurvplot", "ggforest", "ggboxplot", "ggscatter", "ggbarplot",
+    "gghistogram", "ggdensity", "ggline", "ggviolin", "plot", "hist", "barplot", "pie",
+}
+PLOT_SAVERS = {"ggsave", "png", "jpeg", "pdf", "svg", "tiff", "bmp", "dev.copy", "dev.print"}
+TABLE_FUNCTIONS = {
+    "tbl_summary", "tbl_regression", "tbl_uvregression", "tbl_cross", "tbl_survfit",
+    "tbl_merge", "tbl_stack", "flextable", "as_flex_table",
+}
+TABLE_SAVERS = {
+    "save_as_html", "save_as_docx", "save_as_pptx", "save_as_image", "gtsave", "write.csv",
+}
+
+NOT_RUN_NOTE = "Pre-flight check failed; the code was not run."
+
+_ASSIGN = (("op", "<-"), ("op", "<<-"), ("op", "="))
+_NONE = (None, None)
+
+
+def _at(tokens, i):
+    return tokens[i] if 0 <= i < len(tokens) else _NONE
+
+
+def _string_value(literal):
+    return re.sub(r"\\(.)", r"\1", literal[1:-1])
+
+
+def _tokens(code):
+    return [(m.lastgroup, m.group()) for m in _TOKEN.finditer(code) if m.lastgroup != "comment"]
+
+
+def _bracket_columns(tokens, k):
+    """Columns in ``[["a"]]``, ``["a"]``, ``[, "a"]`` or ``[, c("a", "b")]`` at ``k``.
+
+    Returns ``(names, index after the brackets)``; no names for anything else.
+    """
+    double = _at(tokens, k + 1) == ("op", "[")
+    j = k + (2 if double else 1)
+    if not double and _at(tokens, j) == ("op", ","):
+        j += 1
+    if _at(tokens, j)[0] == "string":
+        names = [_string_value(tokens[j][1])]
+        j += 1
+    elif _at(tokens, j) == ("name", "c") and _at(tokens, j + 1) == ("op", "("):
+        names = []
+        j += 2
+        while _at(tokens, j)[0] == "string":
+            names.append(_string_value(tokens[j][1]))
+            j += 1
+            if _at(tokens, j) == ("op", ","):
+                j += 1
+        if _at(tokens, j) != ("op", ")"):
+            return [], k
+        j += 1
+    else:
+        return [], k
+    closing = [("op", "]")] * (2 if double else 1)
+    if tokens[j:j + len(closing)] != closing:
+        return [], k
+    return names, j + len(closing)
+
+
+def column_references(code, frame="df"):
+    """``(used, defined)`` columns of ``frame`` the code names, or None if unknowable.
+
+    Only ``frame$col`` and literal ``[[...]]`` / ``[...]`` subsets count;
+    ``defined`` are the ones assigned to. Code that replaces the frame or its
+    names may add any column, so it cannot be judged.
+    """
+    tokens = _tokens(code)
+    used, defined = [], set()
+    for i, (kind, text) in enumerate(tokens):
+        if (kind, text) != ("name", frame):
+            continue
+        prev, nxt = _at(tokens, i - 1), _at(tokens, i + 1)
+        if prev in (("op", "->"), ("op", "->>")) or nxt in _ASSIGN[:2]:
+            return None
+        if nxt == ("op", "=") and prev not in (("op", "("), ("op", ",")):
+            return None
+        # names(df) <- ..., colnames(df)[2] <- ...
+        if prev == ("op", "(") and nxt == ("op", ")") and _at(tokens, i + 2) in _ASSIGN + (("op", "["),):
+            return None
+        names, j = [], i
+        if nxt == ("op", "$") and _at(tokens, i + 2)[0] == "name":
+            names, j = [tokens[i + 2][1].strip("`")], i + 3
+        elif nxt == ("op", "["):
+            names, j = _bracket_columns(tokens, i + 1)
+        if _at(tokens, j) in _ASSIGN:
+            defined.update(names)
+        else:
+            used.extend(names)
+    return used, defined
+
+
+def _escape_problems(tokens):
+    for kind, text in tokens:
+        if kind != "string":
+            continue
+        for match in re.finditer(r"\\(.)", text[1:-1], re.S):
+            char = match.group(1)
+            following = text[1 + match.end():2 + match.end()]
+            start = text[:1 + match.end()]
+            if char in "xuU" and following not in _HEX:
+                return f"Error: '\\{char}' used without hex digits in character string starting \"{start}\""
+            if char not in _VALID_ESCAPES and char not in "xuU":
+                return f"Error: '\\{char}' is an unrecognized escape in character string starting \"{start}\""
+    return None
+
+
+def _calls_without(tokens, function, argument):
+    """Whether some call to ``function`` does not name ``argument``."""
+    for i, token in enumerate(tokens):
+        if token != ("name", function) or _at(tokens, i + 1) != ("op", "("):
+            continue
+        depth, named = 0, False
+        for j in range(i + 1, len(tokens)):
+            if tokens[j] in (("op", "("), ("op", "["), ("op", "{")):
+                depth += 1
+            elif tokens[j] in (("op", ")"), ("op", "]"), ("op", "}")):
+                depth -= 1
+                if depth == 0:
+                    break
+            elif depth == 1 and tokens[j] == ("name", argument) and _at(tokens, j + 1) == ("op", "="):
+                named = True
+        if not named:
+            return True
+    return False
+
+
+def _heuristic_problems(code, tokens, columns, exports, prelude):
+    problems = []
+    for kind, text in tokens:
+        if kind == "string" and _WINDOWS_PATH.match(_string_value(text)):
+            problems.append(
+                f"Error: \"{_string_value(text)}\" is a Windows path; save files to the working "
+                "directory with a relative name such as \"plot.png\""
+            )
+            break
+
+    if columns is not None:
+        references = column_references(code)
+        if references is not None:
+            used, defined = references
+            known = set(columns) | defined
+            for name in dict.fromkeys(used):
+                if name not in known:
+                    problems.append(f"Error: Column `{name}` doesn't exist.")
+
+    if exports is not None:
+        for name in undefined_functions(code, exports, prelude) or []:
+            problems.append(f'Error in {name}(...) : could not find function "{name}"')
+
+    if _calls_without(tokens, "save_as_html", "path"):
+        problems.append('Error in save_as_html(...) : argument "path" is missing, with no default')
+    if fix_ggsurvplot_save(code, "ggplot", None) not in (None, code):
+        problems.append("Error in ggsave(...) : a ggsurvplot is not a ggplot; save its p$plot")
+    return problems
+
+
+def code_warnings(code):
+    """Advice on plots and tables ``code`` builds but never saves (a list)."""
+    tokens = _tokens(code)
+    called = {text for i, (kind, text) in enumerate(tokens)
+              if kind == "name" and _at(tokens, i + 1) == ("op", "(")}
+    warnings = []
+    if called & PLOT_FUNCTIONS and not called & PLOT_SAVERS:
+        warnings.append("The code builds a plot but never saves it; save it with ggsave(\"plot.png\", ...)")
+    if called & TABLE_FUNCTIONS and not called & TABLE_SAVERS:
+        warnings.append(
+            "The code builds a table but never saves it; save it with "
+            "as_flex_table(table) %>% save_as_html(path = \"table.html\")"
+        )
+    return warnings
+
+
+def check_code(code, parser=None, columns=None, exports=None, prelude="", heuristics=True):
+    """R-style error text for problems ``code`` would run into, or None.
+
+    ``parser`` is an ``RParser`` (None skips R's parser), ``columns`` the
+    dataset's columns and ``exports`` the result of ``read_r_exports`` with
+    the base packages (None skips those checks). ``prelude`` is R code run
+    before ``code``. With ``heuristics`` off only certain problems count.
+    """
+    if parser is not None:
+        problem = parser.check(code)
+        if problem:
+            return f"Error: {problem}\n{NOT_RUN_NOTE}"
+    tokens = _tokens(code)
+    problem = _escape_problems(tokens)
+    if problem:
+        return f"{problem}\n{NOT_RUN_NOTE}"
+    if not heuristics:
+        return None
+    problems = _heuristic_problems(code, tokens, columns, exports, prelude)
+    if problems:
+        return "\n".join(problems + [NOT_RUN_NOTE])
+    return None
+
+
+class RParser:
+    """R's parser in a warm worker that attaches no libraries (shared, thread-safe)."""
+
+    def __init__(self, r_exec, conda_bin_dir, work_dir, startup_timeout=30, timeout=5):
+        self.r_exec = r_exec
+        self.startup_timeout = startup_timeout
+        self.timeout = timeout
+        self.work_dir = work_dir
+        os.makedirs(work_dir, exist_ok=True)
+        self.bootstrap_path = os.path.join(work_dir, f"parser_{os.getpid()}.R")
+        write_worker_bootstrap(self.bootstrap_path, conda_bin_dir, libraries=[])
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def _ensure_worker(self):
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = RWorker(self.r_exec, self.bootstrap_path, self.startup_timeout)
+        return self._worker
+
+    def warm(self):
+        """Start the worker in the background so the first check finds it ready."""
+        def _warm():
+            with self._lock:
+                try:
+                    self._ensure_worker()
+                except (RWorkerError, OSError):
+                    self._worker = None
+        threading.Thread(target=_warm, daemon=True).start()
+
+    def check(self, code):
+        """R's syntax error for ``code``, or None (also when R cannot be asked)."""
+        fd, path = tempfile.mkstemp(suffix=".R", dir=self.work_dir)
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(code)
+            with self._lock:
+                try:
+                    ok, message = self._ensure_worker().parse(path, timeout=self.timeout)
+                except (RWorkerError, OSError):
+                    self._worker = None
+                    return None
+        finally:
+            os.remove(path)
+        return None if ok else message
+
+    def close(self):
+        with self._lock:
+            if self._worker is not None:
+                self._worker.close()
+                self._worker = None
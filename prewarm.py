@@ -0,0 +1,82 @@
+"""Speculative work started when a dataset is uploaded.
+
+Between an upload and the first question the app stages the dataset, starts
+the R workers and loads the data into them, and profiles it. Each piece of
+work is keyed (e.g. ``("stage", data_hash)``) and runs at most once: a caller
+asking for a key whose task is in flight or finished gets the same result, so
+a question arriving mid-prewarm waits for the work already under way instead
+of repeating it. A failed task is run again by the next caller.
+"""
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class Prewarmer:
+    """Keyed, deduplicated background tasks (shared by all sessions)."""
+
+    def __init__(self, max_workers=2, max_keys=64):
+        self.max_keys = max_keys
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prewarm")
+        self._futures = OrderedDict()  # key -> Future
+        self._lock = threading.Lock()
+
+    def _claim(self, key):
+        """Return ``(future, owner)``; the owner must run the task."""
+        with self._lock:
+            future = self._futures.get(key)
+            if future is not None and not _failed(future):
+                self._futures.move_to_end(key)
+                return future, False
+            future = self._futures[key] = Future()
+            # Forget the oldest finished tasks; running ones are kept
+            for old_key in [k for k, f in self._futures.items() if f.done()]:
+                if len(self._futures) <= self.max_keys:
+                    break
+                del self._futures[old_key]
+            return future, True
+
+    def _execute(self, future, fn, args, kwargs):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    def submit(self, key, fn, *args, **kwargs):
+        """Start ``fn`` in the background unless ``key`` already ran or is running."""
+        future, owner = self._claim(key)
+        if owner:
+            self._executor.submit(self._execute, future, fn, args, kwargs)
+        return future
+
+    def run(self, key, fn, *args, **kwargs):
+        """Result for ``key``, computed on this thread unless already started."""
+        future, owner = self._claim(key)
+        if owner:
+            self._execute(future, fn, args, kwargs)
+        return future.result()
+
+    def forget(self, key):
+        """Drop a finished task's result so the next caller runs it again."""
+        with self._lock:
+            future = self._futures.get(key)
+            if future is not None and future.done():
+                del self._futures[key]
+
+    def status(self, key):
+        """None (never started), "running", "done" or "failed"."""
+        with self._lock:
+            future = self._futures.get(key)
+        if future is None:
+            return None
+        if not future.done():
+            return "running"
+        return "failed" if _failed(future) else "done"
+
+
+def _failed(future):
+    return future.done() and future.exception() is not None
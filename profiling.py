@@ -0,0 +1,233 @@
+"""Per-column dataset profiles for the LLM data context.
+
+Profiles are computed with whole-frame (vectorized) pandas operations, on a
+row sample for large datasets, and cached by dataset hash. ``render_context``
+turns a profile into a compact description that fits a token budget instead
+of dumping ``describe()`` and sample rows into the prompt.
+"""
+import re
+import threading
+import warnings
+from collections import OrderedDict
+
+import pandas as pd
+
+from tokens import count_tokens
+
+# Quantiles, top values and cardinality come from a sample of this many rows
+PROFILE_SAMPLE_ROWS = 100_000
+TOP_VALUES = 5
+# Strings are tested as dates on this many non-null values
+DATE_PROBE_VALUES = 200
+# Datasets this small also get a few raw rows in the context
+SMALL_DATASET_ROWS = 100
+
+_TIME_NAME = re.compile(r"(^|[_.\s])(time|times|duration|survival|surv|follow_?up|futime|os|pfs|dfs|days|months|years)($|[_.\s])", re.I)
+_EVENT_NAME = re.compile(r"(^|[_.\s])(event|status|death|dead|died|censor|censored|fustat|outcome)($|[_.\s])", re.I)
+_DATE_NAME = re.compile(r"date|_dt$|^dt_|timestamp", re.I)
+_DATE_LIKE = re.compile(r"^\d{1,4}[-/.]\d{1,2}[-/.]\d{1,4}")
+_ID_NAME = re.compile(r"(^|[_.\s])(id|identifier|patient_?id|subject)($|[_.\s])", re.I)
+
+_CACHE_SIZE = 8
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+class DatasetProfile:
+    """Shape, per-column profiles and (for small data) a few example rows."""
+
+    def __init__(self, n_rows, n_cols, sample_rows, columns, preview=None):
+        self.n_rows = n_rows
+        self.n_cols = n_cols
+        self.sample_rows = sample_rows
+        self.columns = columns
+        self.preview = preview
+
+    @property
+    def sampled(self):
+        return self.sample_rows < self.n_rows
+
+
+def _column_kind(series):
+    dtype = series.dtype
+    if pd.api.types.is_bool_dtype(dtype):
+        return "boolean"
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return "datetime"
+    if pd.api.types.is_integer_dtype(dtype):
+        return "integer"
+    if pd.api.types.is_float_dtype(dtype):
+        return "numeric"
+    if isinstance(dtype, pd.CategoricalDtype):
+        return "categorical"
+    return "text"
+
+
+def _looks_like_dates(values):
+    probe = values.dropna().astype(str).head(DATE_PROBE_VALUES)
+    if probe.empty or probe.str.fullmatch(r"[-+]?\d+(\.\d+)?").all():
+        return False
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        try:
+            parsed = pd.to_datetime(probe, errors="coerce", format="mixed")
+        except (TypeError, ValueError):
+            parsed = pd.to_datetime(probe, errors="coerce")
+    return parsed.notna().mean() >= 0.9
+
+
+def _roles(name, kind, n_unique, n_non_null, values):
+    """Hints about what a column is for: date, time, event, id."""
+    roles = []
+    if kind == "datetime":
+        roles.append("date")
+    elif kind in ("text", "categorical") and n_non_null:
+        # Only strings that start like a date are worth trying to parse
+        first = str(values.dropna().iloc[0])
+        if (_DATE_NAME.search(name) or _DATE_LIKE.match(first)) and _looks_like_dates(values):
+            roles.append("date")
+    if kind in ("integer", "numeric") and _TIME_NAME.search(name):
+        roles.append("time")
+    if _EVENT_NAME.search(name) and 0 < n_unique <= 3:
+        roles.append("event")
+    if n_non_null >= 20 and n_unique == n_non_null and (kind == "text" or _ID_NAME.search(name)):
+        roles.append("id")
+    return roles
+
+
+def profile_dataframe(df, sample_rows=PROFILE_SAMPLE_ROWS):
+    """Profile every column; missingness is exact, the rest uses a sample."""
+    n_rows, n_cols = df.shape
+    sample = df.sample(sample_rows, random_state=0) if n_rows > sample_rows else df
+
+    missing = df.isna().sum()
+    n_unique = sample.nunique(dropna=True)
+    n_non_null = sample.notna().sum()
+
+    numeric = sample.select_dtypes(include="number")
+    quantiles = (
+        numeric.quantile([0.0, 0.25, 0.5, 0.75, 1.0]) if not numeric.empty else None
+    )
+    means = numeric.mean() if not numeric.empty else None
+
+    columns = []
+    for name in df.columns:
+        values = sample[name]
+        kind = _column_kind(values)
+        profile = {
+            "name": str(name),
+            "kind": kind,
+            "missing": int(missing[name]),
+            "missing_frac": float(missing[name]) / n_rows if n_rows else 0.0,
+            "n_unique": int(n_unique[name]),
+        }
+        if quantiles is not None and name in quantiles.columns:
+            q = quantiles[name]
+            profile["quantiles"] = [float(v) for v in q.tolist()]
+            profile["mean"] = float(means[name])
+        elif kind == "datetime" and values.notna().any():
+            profile["range"] = (str(values.min()), str(values.max()))
+        if kind in ("text", "categorical", "boolean") or (
+            kind == "integer" and profile["n_unique"] <= TOP_VALUES
+        ):
+            counts = values.value_counts(dropna=True).head(TOP_VALUES)
+            total = max(int(n_non_null[name]), 1)
+            profile["top"] = [(str(k), int(v) / total) for k, v in counts.items()]
+        profile["roles"] = _roles(
+            profile["name"], kind, profile["n_unique"], int(n_non_null[name]), values
+        )
+        columns.append(profile)
+
+    preview = df.head(10).to_string() if n_rows <= SMALL_DATASET_ROWS else None
+    return DatasetProfile(n_rows, n_cols, len(sample), columns, preview)
+
+
+def get_profile(df, data_hash):
+    """Profile a dataset once per content hash and reuse it afterwards."""
+    with _cache_lock:
+        if data_hash in _cache:
+            _cache.move_to_end(data_hash)
+            return _cache[data_hash]
+
+    profile = profile_dataframe(df)
+    with _cache_lock:
+        _cache[data_hash] = profile
+        while len(_cache) > _CACHE_SIZE:
+            _cache.popitem(last=False)
+    return profile
+
+
+def _number(value):
+    if value != value:  # NaN
+        return "NA"
+    if float(value).is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return f"{value:.4g}"
+
+
+def _column_line(col, detail):
+    """One line per column; ``detail`` 2 = full, 1 = ranges and two top values, 0 = name and type."""
+    kind = col["kind"]
+    if kind in ("text", "categorical") and col["n_unique"] <= 50:
+        kind = f"{kind}, {col['n_unique']} levels"
+    parts = [f"- {col['name']}: {kind}"]
+    if col["roles"]:
+        parts.append("role: " + "/".join(col["roles"]))
+    if detail == 0:
+        return "; ".join(parts)
+
+    if col["missing"]:
+        parts.append(f"{col['missing_frac']:.0%} missing")
+    if "quantiles" in col:
+        q = [_number(v) for v in col["quantiles"]]
+        if detail >= 2:
+            parts.append(
+                f"min {q[0]}, q1 {q[1]}, median {q[2]}, q3 {q[3]}, max {q[4]}, mean {_number(col['mean'])}"
+            )
+        else:
+            parts.append(f"range {q[0]}..{q[4]}")
+    elif "range" in col:
+        parts.append(f"range {col['range'][0]}..{col['range'][1]}")
+    if "top" in col and col["top"]:
+        top = col["top"] if detail >= 2 else col["top"][:2]
+        parts.append("top: " + ", ".join(f"{v} ({share:.0%})" for v, share in top))
+    elif col["kind"] in ("text", "categorical"):
+        parts.append(f"{col['n_unique']} distinct")
+    return "; ".join(parts)
+
+
+def render_context(profile, token_budget=1200, model="gpt-4.1"):
+    """Compact data description for the prompt, kept within ``token_budget``.
+
+    Detail is shed in steps: first the small-data row preview, then top values
+    and quantiles, then whole columns (reported as "... N more columns").
+    """
+    header = f"Dataset: {profile.n_rows:,} rows x {profile.n_cols} columns"
+    if profile.sampled:
+        header += f" (statistics from a {profile.sample_rows:,}-row sample)"
+    header += "\nColumns (name: type; role; missing; summary):"
+
+    for with_preview in (True, False):
+        for detail in (2, 1, 0):
+            lines = [header] + [_column_line(col, detail) for col in profile.columns]
+            if with_preview and profile.preview:
+                lines.append("First rows:\n" + profile.preview)
+            text = "\n".join(lines)
+            if count_tokens(text, model) <= token_budget:
+                return text
+        if not profile.preview:
+            break
+
+    # Still too wide: keep as many name/type lines as fit
+    lines = [header]
+    used = count_tokens(header, model)
+    for index, col in enumerate(profile.columns):
+        line = _column_line(col, 0)
+        cost = count_tokens(line, model) + 1
+        remaining = len(profile.columns) - index
+        if used + cost + 12 > token_budget:
+            lines.append(f"... and {remaining} more columns")
+            break
+        lines.append(line)
+        used += cost
+    return "\n".join(lines)
@@ -0,0 +1,332 @@
+"""Column projection: which dataset columns a piece of generated R code uses.
+
+The code is tokenized once (comments, strings, backquoted names) and every
+name or string equal to a column of ``df`` counts as used. Projection is only
+safe when ``df`` (and any data frame derived from it with all its columns)
+is used in ways that cannot see the other columns: ``df$col``,
+``df[["col"]]``, explicit column subsets, ``data = df`` in model and plot
+calls, and pipelines through verbs that only touch named columns. Anything
+else (``tbl_summary(df)``, ``names(df)``, ``lm(y ~ ., df)``, printing the
+frame, tidyselect helpers, metaprogramming) falls back to the full frame.
+"""
+import bisect
+import re
+
+_TOKEN = re.compile(r"""
+    (?P<comment>\#[^\n]*)
+  | (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+  | (?P<backtick>`(?:[^`\\]|\\.)*`)
+  | (?P<number>0[xX][0-9a-fA-F]+L?|(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?[Li]?)
+  | (?P<name>(?:[A-Za-z]|\.(?!\d))[\w.]*)
+  | (?P<newline>\n)
+  | (?P<op>%[^%\n]*%|<<-|->>|<-|->|\|>|==|!=|<=|>=|&&|\|\||:::|::|!!!|!!|[-+*/^~!&|<>=$@:?,;()\[\]{}])
+  | (?P<space>[ \t\r\f\v]+)
+  | (?P<other>.)
+""", re.X)
+
+_ESCAPE = re.compile(r"\\(.)")
+
+_PIPES = {"%>%", "|>"}
+_ASSIGN = {"<-", "=", "<<-"}
+_OPEN = {"(": ")", "[": "]", "{": "}"}
+# A line ending in one of these continues on the next line
+_CONTINUES = {
+    "+", "-", "*", "/", "^", "~", "&", "|", "&&", "||", "<-", "<<-", "=", "->", "==",
+    "!=", "<", ">", "<=", ">=", ",", "$", "@", ":", "::", ":::", "!", "|>",
+}
+
+# Anywhere in the code these need every column (or make usage unknowable)
+ALL_COLUMN_FUNCTIONS = {
+    "everything", "where", "starts_with", "ends_with", "contains", "matches",
+    "num_range", "last_col", "get", "mget", "exists", "eval", "evalq", "parse",
+    "assign", "sym", "syms", "as.name", "as.symbol", "as.formula", "reformulate",
+    "attach", "clean_names", "rename_with",
+    "mutate_all", "mutate_if", "mutate_at", "transmute_all", "transmute_if", "transmute_at",
+    "summarise_all", "summarise_if", "summarise_at", "summarize_all", "summarize_if",
+    "summarize_at", "select_all", "select_if", "select_at", "rename_all", "rename_if",
+    "rename_at", "filter_all", "filter_if", "filter_at", "group_by_all", "group_by_if",
+    "group_by_at", "distinct_all", "arrange_all",
+}
+
+# Return the frame with all its columns; usage depends on what follows
+FRAME_VERBS = {
+    "filter", "mutate", "arrange", "group_by", "ungroup", "rename", "relocate",
+    "slice", "slice_head", "slice_tail", "slice_min", "slice_max", "slice_sample",
+    "sample_n", "sample_frac", "subset", "transform", "within", "rowwise",
+    "drop_na", "distinct", "as.data.frame", "as_tibble", "data.frame",
+}
+
+# Without arguments these look at every column
+ARGLESS_ALL_COLUMNS = {"drop_na", "distinct"}
+
+# Only use the columns they name; safe with the frame as first argument or piped
+REDUCERS = {
+    "select", "transmute", "summarise", "summarize", "count", "tally", "add_count",
+    "pull", "nrow", "NROW", "with", "ggplot", "reframe",
+}
+
+# Only use the columns their formula/aesthetics name when given ``data = df``
+DATA_ARG_FUNCTIONS = {
+    "lm", "glm", "aov", "anova", "coxph", "survfit", "survdiff", "survreg", "surv_fit",
+    "ggplot", "ggsurvplot", "ggforest", "t.test", "wilcox.test", "kruskal.test",
+    "cor.test", "chisq.test", "fisher.test", "aggregate", "xtabs", "boxplot", "nls",
+    "loess", "lmer", "glmer", "gam", "polr", "multinom", "roc", "ggboxplot",
+    "ggscatter", "ggbarplot", "gghistogram", "ggdensity", "ggline", "ggviolin",
+    "tbl_cross", "cox.zph",
+}
+
+# Errors that suggest a projected frame lacked a column the code needed
+MISSING_COLUMN_ERROR = re.compile(
+    r"object '[^']*' not found|undefined columns selected|[Cc]olumn `[^`]*` (doesn't|does not) exist"
+    r"|[Cc]an't subset columns|not found in 'data'|subscript out of bounds"
+)
+
+
+class _Code:
+    """Tokens of an R snippet with bracket matching and statement bounds."""
+
+    def __init__(self, code):
+        self.tokens = []  # (kind, value)
+        self.match = {}
+        self.parent = []  # index of the innermost open bracket around each token
+        self.statements = []  # (start, end) token ranges, in order
+        stack = []
+        start = 0
+        for m in _TOKEN.finditer(code):
+            kind, text = m.lastgroup, m.group()
+            if kind in ("comment", "space"):
+                continue
+            if kind == "newline" or (kind == "op" and text == ";"):
+                # Statements end at line breaks outside () and [] unless continued
+                open_round = any(self.tokens[i][1] in "([" for i in stack)
+                last = self.tokens[-1] if self.tokens else None
+                continued = last is not None and last[0] == "op" and (
+                    last[1] in _CONTINUES or last[1] in _PIPES or last[1].startswith("%")
+                )
+                if text == ";" or not (open_round or continued):
+                    self._end_statement(start)
+                    start = len(self.tokens)
+                continue
+            if kind == "string":
+                value = _ESCAPE.sub(r"\1", text[1:-1])
+            elif kind == "backtick":
+                kind, value = "name", _ESCAPE.sub(r"\1", text[1:-1])
+            else:
+                value = text
+            index = len(self.tokens)
+            self.parent.append(stack[-1] if stack else None)
+            self.tokens.append((kind, value))
+            if kind != "op":
+                continue
+            if value in _OPEN:
+                stack.append(index)
+            elif value in (")", "]", "}"):
+                if not stack or _OPEN[self.tokens[stack[-1]][1]] != value:
+                    raise ValueError("unbalanced brackets")
+                opened = stack.pop()
+                self.match[opened] = index
+                self.match[index] = opened
+            if value in ("{", "}") and not any(self.tokens[i][1] in "([" for i in stack):
+                # Braces delimit statements as well (function bodies, if/for blocks)
+                self._end_statement(start, index)
+                start = index + 1
+        if stack:
+            raise ValueError("unbalanced brackets")
+        self._end_statement(start)
+
+    def _end_statement(self, start, end=None):
+        end = len(self.tokens) if end is None else end
+        if end > start:
+            self.statements.append((start, end))
+
+    def kind(self, i):
+        return self.tokens[i][0] if 0 <= i < len(self.tokens) else None
+
+    def value(self, i):
+        return self.tokens[i][1] if 0 <= i < len(self.tokens) else None
+
+    def is_op(self, i, *values):
+        return self.kind(i) == "op" and self.value(i) in values
+
+    def statement(self, i):
+        """``(start, end)`` of the statement containing token ``i``, if any."""
+        index = bisect.bisect_right(self.statements, (i, float("inf"))) - 1
+        if index >= 0 and self.statements[index][0] <= i < self.statements[index][1]:
+            return self.statements[index]
+        return None
+
+    def function_at(self, open_paren):
+        """Name of the function called with the paren at ``open_paren``."""
+        if self.kind(open_paren - 1) == "name":
+            return self.value(open_paren - 1)
+        return None
+
+    def call_start(self, open_paren):
+        """First token of the call expression (``pkg::fn(`` starts at ``pkg``)."""
+        start = open_paren - 1
+        if self.is_op(start - 1, "::", ":::") and self.kind(start - 2) == "name":
+            start -= 2
+        return start
+
+
+def _literal_columns(code, start, end):
+    """Whether tokens[start:end] only spell out literal column names."""
+    if start >= end:
+        return False
+    for i in range(start, end):
+        kind, value = code.tokens[i]
+        if kind == "string" or (kind == "name" and value == "c"):
+            continue
+        if kind == "op" and value in ("(", ")", ","):
+            continue
+        return False
+    return True
+
+
+def _top_level_commas(code, open_bracket):
+    close = code.match[open_bracket]
+    return [
+        i for i in range(open_bracket + 1, close)
+        if code.is_op(i, ",") and code.parent[i] == open_bracket
+    ]
+
+
+def _args_empty(code, open_paren):
+    return code.match[open_paren] == open_paren + 1
+
+
+class _Analysis:
+    def __init__(self, code):
+        self.code = code
+        self.frames = {"df"}
+        self.new_frames = set()
+
+    def frame_value_ok(self, start, end):
+        """Whether a full-width frame value at tokens[start:end] is used safely."""
+        code = self.code
+        while code.is_op(end, *_PIPES):
+            step = end + 1
+            if code.kind(step) == "name" and code.is_op(step + 1, "::", ":::"):
+                step += 2
+            if code.kind(step) != "name" or not code.is_op(step + 1, "("):
+                return False
+            function = code.value(step)
+            open_paren = step + 1
+            if function in REDUCERS:
+                return True
+            if function not in FRAME_VERBS:
+                return False
+            if function in ARGLESS_ALL_COLUMNS and _args_empty(code, open_paren):
+                return False
+            end = code.match[open_paren] + 1
+
+        # The chain's value is a frame with every column: only assigning it is safe
+        bounds = code.statement(start)
+        if bounds is None:
+            return False
+        s, e = bounds
+        if (code.kind(s) == "name" and code.is_op(s + 1, *_ASSIGN)
+                and start == s + 2 and end == e):
+            target = code.value(s)
+        elif code.is_op(end, "->") and code.kind(end + 1) == "name" and start == s and end + 2 == e:
+            target = code.value(end + 1)
+        else:
+            return False
+        if target not in self.frames:
+            self.new_frames.add(target)
+        return True
+
+    def frame_use_ok(self, i):
+        """Whether the frame named by token ``i`` is used without seeing every column."""
+        code = self.code
+        nxt, prv = i + 1, i - 1
+        bounds = code.statement(i)
+        at_start = bounds is not None and bounds[0] == i
+
+        if code.is_op(nxt, "$", "@"):
+            return True
+        if code.is_op(nxt, "[") and code.is_op(nxt + 1, "[") and code.match[nxt] == code.match[nxt + 1] + 1:
+            # df[["col"]]
+            return code.kind(nxt + 2) == "string" and code.match[nxt + 1] == nxt + 3
+        if code.is_op(nxt, "["):
+            commas = _top_level_commas(code, nxt)
+            close = code.match[nxt]
+            if len(commas) == 1:
+                # df[rows, c("a", "b")]
+                return _literal_columns(code, commas[0] + 1, close)
+            return not commas and _literal_columns(code, nxt + 1, close)
+        if at_start and code.is_op(nxt, *_ASSIGN):
+            return True  # df <- ...
+        if code.is_op(prv, "->") and not at_start:
+            return True
+        if code.is_op(prv, "=") and code.value(prv - 1) == "data":
+            open_paren = code.parent[i]
+            return open_paren is not None and code.function_at(open_paren) in DATA_ARG_FUNCTIONS
+        if code.is_op(prv, "(") and code.is_op(nxt, ",", ")"):
+            # First argument of a call
+            function = code.function_at(prv)
+            if function in REDUCERS:
+                return True
+            if function in FRAME_VERBS:
+                if function in ARGLESS_ALL_COLUMNS and code.is_op(nxt, ")"):
+                    return False
+                return self.frame_value_ok(code.call_start(prv), code.match[prv] + 1)
+            return False
+        return self.frame_value_ok(i, i + 1)
+
+    def safe(self):
+        code = self.code
+        for i, (kind, value) in enumerate(code.tokens):
+            if kind == "op" and value in ("!!", "!!!"):
+                return False
+            if kind != "name":
+                continue
+            if value == "." or (value in ALL_COLUMN_FUNCTIONS and code.is_op(i + 1, "(")):
+                return False
+            if value in (".data", ".env") and code.is_op(i + 1, "[") and code.kind(i + 3) != "string":
+                return False
+            if value == "select" and code.is_op(i + 1, "("):
+                # Negative selections and ranges keep columns the code never names
+                close = code.match[i + 1]
+                if any(code.is_op(j, "-", ":", "!") and code.parent[j] == i + 1
+                       for j in range(i + 2, close)):
+                    return False
+            if value in self.frames and not code.is_op(i - 1, "$", "@", "::"):
+                if not self.frame_use_ok(i):
+                    return False
+        return True
+
+
+def referenced_columns(code, columns):
+    """Columns of ``columns`` the R ``code`` needs, or None for all of them.
+
+    Always returns at least one column so ``nrow(df)`` keeps working; returns
+    None when the usage is ambiguous or every column is needed anyway.
+    """
+    try:
+        parsed = _Code(code)
+    except ValueError:
+        return None
+
+    analysis = _Analysis(parsed)
+    # Frames derived from df are found as they are checked; re-check with them
+    for _ in range(10):
+        if not analysis.safe():
+            return None
+        if not analysis.new_frames:
+            break
+        analysis.frames |= analysis.new_frames
+        analysis.new_frames = set()
+    else:
+        return None
+
+    mentioned = {value for kind, value in parsed.tokens if kind in ("name", "string")}
+    used = [col for col in columns if col in mentioned]
+    if len(used) == len(columns):
+        return None
+    return used or list(columns[:1])
+
+
+def is_missing_column_error(stderr):
+    """Whether an R error could come from a column projected away."""
+    return bool(MISSING_COLUMN_ERROR.search(stderr or ""))
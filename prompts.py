@@ -0,0 +1,245 @@
+"""Prompt assembly for the chat and auto-fix calls.
+
+Static instructions always come first and are byte-identical across datasets
+and conversations, so provider-side prompt caching can reuse that prefix;
+the dataset description, session state, history and the question follow.
+Prompts are measured with a local tokenizer and trimmed to a budget in a
+fixed order: old history first, then the data description. The question and
+the code being fixed are never cut.
+"""
+from tokens import count_message_tokens, count_tokens, truncate_tokens, MESSAGE_OVERHEAD_TOKENS
+
+CHAT_INSTRUCTIONS = """You are a helpful data analyst assistant using R.
+
+The user has uploaded a CSV file. The data is loaded in an R dataframe called `df`; \
+a description of the dataset follows these instructions.
+
+Guidelines:
+- Answer the user's question clearly and concisely
+- Write R code using base R, dplyr, ggplot2, gtsummary, and survival
+- For regression tables, use gtsummary's tbl_regression or tbl_summary
+- For visualizations, use ggplot2 and save plots using ggsave()
+- Always validate data before operations
+- Keep responses focused on the data and question
+- Summarize findings and insights
+
+When writing code:
+- The dataframe is available as 'df'
+- Libraries available: ggplot2, dplyr, gtsummary, survival, survminer, flextable
+- For survival plots, MUST load survminer: library(survminer) before using ggsurvplot()
+- For plots, save them using: ggsave("plot.png", width=10, height=6)
+- For ggsurvplot, save using: ggsave("plot.png", p$plot, width=10, height=6)
+- You can create multiple plots: plot1.png, plot2.png, etc.
+- For gtsummary tables, MUST save as HTML using flextable with pipe operator:
+  table <- tbl_regression(model, exponentiate = TRUE)
+  as_flex_table(table) %>% save_as_html(path = "table.html")
+- IMPORTANT: Use pipe operator (%>%) and path parameter in save_as_html()
+- Always add titles and labels to plots
+- Print results using print() or cat()
+
+Example code structure for tables:
+```r
+# Cox regression model
+library(survival)
+library(gtsummary)
+library(flextable)
+
+
+# Create and save table as HTML (CORRECT SYNTAX)
+table <- tbl_regression(model, exponentiate = TRUE)
+as_flex_table(table) %>% save_as_html(path = "table.html")
+
+# For summary tables
+summary_table <- tbl_summary(df, by = group_var)
+as_flex_table(summary_table) %>% save_as_html(path = "summary.html")
+
+# Alternative syntax also works:
+# save_as_html(as_flex_table(table), path = "table.html")
+```
+
+Example for Kaplan-Meier plots:
+```r
+# Create plot with ggsurvplot
+p <- ggsurvplot(
+  km_fit,
+  data = df,
+  risk.table = TRUE,
+  pval = TRUE,
+  conf.int = TRUE,
+  xlab = "Time",
+  ylab = "Survival Probability",
+  title = "Kaplan-Meier Curves"
+)
+
+# Save plot (note: use p$plot for ggsurvplot objects)
+ggsave("km_plot.png", p$plot, width = 10, height = 6)
+```
+
+Example for plots:
+```r
+# Visualization
+p <- ggplot(df, aes(x=x, y=y)) +
+  geom_point() +
+  labs(title="My Plot", x="X axis", y="Y axis")
+
+ggsave("plot.png", p, width=10, height=6)
+```
+"""
+
+SESSION_INSTRUCTIONS = """The R session persists between questions: objects created by earlier code \
+(fitted models, derived data frames, a modified `df`) are still available. \
+Reuse them instead of recomputing when the question builds on earlier results.
+Objects currently defined: {objects}"""
+
+FIX_INSTRUCTIONS = """You are an R debugging expert. Fix the code and return ONLY the corrected R code.
+
+The user message contains the data context, the original code and the error message.
+
+Requirements:
+- Return ONLY valid R code in a ```r code block
+- Fix the error but keep the same intent
+- Use forward slashes (/) for any file paths
+- Ensure all column names are correctly referenced
+- The dataframe is called 'df'
+- Libraries available: ggplot2, dplyr, gtsummary, survival, survminer, flextable
+- For Kaplan-Meier plots, MUST load library(survminer) before using ggsurvplot()
+- For ggsurvplot objects, save using: ggsave("plot.png", p$plot, width=10, height=6)
+- For gtsummary tables, use correct syntax: as_flex_table(table) %>% save_as_html(path = "table.html")
+- IMPORTANT: Always use pipe operator (%>%) and path parameter in save_as_html()
+"""
+
+
+class Prompt:
+    """Assembled messages plus their size, for display and metrics."""
+
+    def __init__(self, messages, tokens, static_tokens, history_used=0, history_total=0,
+                 trimmed=()):
+        self.messages = messages
+        self.tokens = tokens
+        self.static_tokens = static_tokens
+        self.history_used = history_used
+        self.history_total = history_total
+        self.trimmed = list(trimmed)
+
+    def describe(self):
+        text = f"{self.tokens:,} tokens ({self.static_tokens:,} in the cacheable prefix)"
+        if self.history_total:
+            text += f" · {self.history_used}/{self.history_total} history messages"
+        if self.trimmed:
+            text += " · trimmed: " + ", ".join(self.trimmed)
+        return text
+
+
+class PromptBuilder:
+    """Builds chat and auto-fix prompts within a token budget."""
+
+    def __init__(self, model, budget=6000, history_messages=6, history_message_tokens=300,
+                 error_tokens=600):
+        self.model = model
+        self.budget = budget
+        self.history_messages = history_messages
+        self.history_message_tokens = history_message_tokens
+        self.error_tokens = error_tokens
+        self._chat_static_tokens = count_message_tokens(
+            [{"role": "system", "content": CHAT_INSTRUCTIONS}], model
+        )
+        self._fix_static_tokens = count_message_tokens(
+            [{"role": "system", "content": FIX_INSTRUCTIONS}], model
+        )
+
+    def _tokens(self, text):
+        return count_tokens(text, self.model) + MESSAGE_OVERHEAD_TOKENS
+
+    def chat(self, question, data_context, history=(), session_objects=None):
+        """Messages for answering ``question``.
+
+        ``history`` is the earlier conversation (without the question itself);
+        ``session_objects`` lists R objects kept by a persistent session, or
+        None when sessions are off.
+        """
+        trimmed = []
+        context = "Dataset description:\n" + data_context
+        if session_objects is not None:
+            context += "\n\n" + SESSION_INSTRUCTIONS.format(
+                objects=", ".join(session_objects) if session_objects else "none yet"
+            )
+
+        # Answers with several code blocks are stored once per block
+        unique = []
+        for m in history:
+            if not unique or (m["role"], m["content"]) != (unique[-1]["role"], unique[-1]["content"]):
+                unique.append(m)
+
+        recent = []
+        for m in unique[-self.history_messages:]:
+            content = truncate_tokens(m["content"], self.history_message_tokens, self.model)
+            if content != m["content"] and "long history messages" not in trimmed:
+                trimmed.append("long history messages")
+            recent.append({"role": m["role"], "content": content})
+
+        fixed = self._chat_static_tokens + self._tokens(question)
+        context_tokens = self._tokens(context)
+        history_tokens = [self._tokens(m["content"]) for m in recent]
+
+        # Oldest history goes first, then the data description is shortened
+        while recent and fixed + context_tokens + sum(history_tokens) > self.budget:
+            recent.pop(0)
+            history_tokens.pop(0)
+            if "old history" not in trimmed:
+                trimmed.append("old history")
+        if fixed + context_tokens > self.budget:
+            context = truncate_tokens(
+                context, max(self.budget - fixed - MESSAGE_OVERHEAD_TOKENS, 0), self.model
+            )
+            context_tokens = self._tokens(context)
+            trimmed.append("data description")
+
+        messages = [
+            {"role": "system", "content": CHAT_INSTRUCTIONS},
+            {"role": "system", "content": context},
+            *recent,
+            {"role": "user", "content": question},
+        ]
+        return Prompt(
+            messages,
+            fixed + context_tokens + sum(history_tokens),
+            self._chat_static_tokens,
+            history_used=len(recent),
+            history_total=min(len(unique), self.history_messages),
+            trimmed=trimmed,
+        )
+
+    def fix(self, code, error, data_context, warnings=()):
+        """Messages asking for a corrected version of ``code`` that failed with ``error``.
+
+        ``warnings`` are further problems noticed in the code, fixed alongside.
+        """
+        trimmed = []
+        if count_tokens(error, self.model) > self.error_tokens:
+            # R prints warnings first; the error itself is at the end
+            error = truncate_tokens(error, self.error_tokens, self.model, keep="tail")
+            trimmed.append("error message")
+
+        parts = [
+            "Original code:\n```r\n" + code + "\n```",
+            "Error message:\n" + error,
+        ]
+        if warnings:
+            parts.append("Also fix:\n" + "\n".join(f"- {warning}" for warning in warnings))
+        fixed = self._fix_static_tokens + self._tokens("\n\n".join(parts))
+        context = "Data context:\n" + data_context
+        if fixed + count_tokens(context, self.model) > self.budget:
+            context = truncate_tokens(context, max(self.budget - fixed, 0), self.model)
+            trimmed.append("data context")
+
+        user = "\n\n".join([context] + parts)
+        messages = [
+            {"role": "system", "content": FIX_INSTRUCTIONS},
+            {"role": "user", "content": user},
+        ]
+        return Prompt(
+            messages,
+            self._fix_static_tokens + self._tokens(user),
+            self._fix_static_tokens,
+            trimmed=trimmed,
+        )
@@ -0,0 +1,283 @@
+"""Attach only the analysis libraries a piece of generated R code calls.
+
+A script run with a fresh ``Rscript`` pays for attaching every library in its
+preamble, and gtsummary, survminer and flextable are among the slowest R
+packages to attach. ``required_libraries`` finds the names the code uses that
+one of the libraries exports (including packages a library attaches with
+itself, e.g. ggpubr for survminer) and returns just those libraries, in the
+usual attach order. The exports are read from the R installation once and
+cached on disk.
+
+Callers fall back to the full preamble when the answer is None (exports
+unknown, code that cannot be analyzed or looks functions up by name) and when
+a run fails with "could not find function". ``undefined_functions`` uses the
+same exports (with the base packages) to find calls nothing would define.
+"""
+import json
+import os
+import re
+import subprocess
+import tempfile
+import uuid
+
+from r_worker import R_LIBRARIES
+
+_TOKEN = re.compile(r"""
+    (?P<comment>\#[^\n]*)
+  | (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+  | (?P<name>`(?:[^`\\]|\\.)*`|(?:[A-Za-z]|\.(?!\d))[\w.]*)
+  | (?P<op>%[^%\n]*%|<<-|->>|<-|->|:::|::|==|[$@=(){}\[\],;])
+  | (?P<other>[^\s])
+""", re.X)
+
+# Calls that look functions up from strings: usage cannot be known
+DYNAMIC_LOOKUP = {"do.call", "match.fun", "get", "get0", "mget", "getFunction", "eval", "parse"}
+
+# Packages every R session attaches
+BASE_PACKAGES = ["base", "methods", "datasets", "utils", "grDevices", "graphics", "stats"]
+
+# Calls that can make functions appear that no known package exports
+ATTACH_CALLS = {"library", "require", "attach", "source", "sys.source", "load"}
+
+# Resolved by tidyselect inside select() and friends, whatever is attached
+TIDYSELECT_HELPERS = {
+    "where", "all_of", "any_of", "everything", "starts_with", "ends_with", "contains",
+    "matches", "num_range", "last_col", "one_of",
+}
+
+_KEYWORDS = {"if", "for", "while", "repeat", "function", "return", "switch"}
+
+MISSING_FUNCTION_ERROR = re.compile(
+    r'could not find function "[^"]+"|data set .* not found'
+)
+
+# Exports of each package and the packages its Depends field attaches with it
+EXPORTS_SCRIPT = r"""
+pkgs <- commandArgs(trailingOnly = TRUE)
+attached_by_default <- c("R", "base", "methods", "datasets", "utils", "grDevices", "graphics", "stats")
+seen <- character(0)
+while (length(pkgs) > 0) {
+    p <- pkgs[1]
+    pkgs <- pkgs[-1]
+    if (p %in% seen) next
+    seen <- c(seen, p)
+    if (!suppressWarnings(requireNamespace(p, quietly = TRUE))) next
+    deps <- packageDescription(p)$Depends
+    deps <- if (is.null(deps)) character(0) else trimws(sub("\\(.*", "", strsplit(deps, ",")[[1]]))
+    deps <- setdiff(deps[nzchar(deps)], attached_by_default)
+    pkgs <- c(pkgs, deps)
+    cat(p, paste(deps, collapse = ","), getNamespaceExports(p), sep = "\t")
+    cat("\n")
+}
+"""
+
+
+def read_r_exports(r_exec, libraries=R_LIBRARIES, cache_path=None, timeout=180):
+    """Names visible after ``library(pkg)``, for each of ``libraries``.
+
+    Returns ``{package: [names]}``, or None when R could not be queried.
+    Results are cached in ``cache_path`` per Rscript and library list.
+    """
+    key = [r_exec, list(libraries)]
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path, "r", encoding="utf-8") as f:
+                cached = json.load(f)
+            if cached.get("key") == key:
+                return cached["exports"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    fd, script_path = tempfile.mkstemp(suffix=".R")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(EXPORTS_SCRIPT)
+        result = subprocess.run(
+            [r_exec, script_path, *libraries],
+            capture_output=True,
+            text=True,
+            timeout=timeout,
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    finally:
+        os.remove(script_path)
+    if result.returncode != 0:
+        return None
+
+    found = {}  # package -> (depends, exports)
+    for line in result.stdout.splitlines():
+        fields = line.split("\t")
+        if len(fields) >= 2:
+            found[fields[0]] = ([d for d in fields[1].split(",") if d], fields[2:])
+
+    def visible(package, seen):
+        if package in seen or package not in found:
+            return set()
+        seen.add(package)
+        depends, names = found[package]
+        names = set(names)
+        for dependency in depends:
+            names |= visible(dependency, seen)
+        return names
+
+    exports = {package: sorted(visible(package, set())) for package in libraries if package in found}
+    if cache_path:
+        tmp_path = f"{cache_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"key": key, "exports": exports}, f)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    return exports
+
+
+def _names(code):
+    """``(used, assigned)`` names of an R snippet, or None if it cannot be analyzed.
+
+    Used names exclude ``pkg::name``, ``x$name`` / ``x@name`` and argument
+    names (``f(name = ...)``); assigned names are those bound with ``<-``,
+    ``->`` or a top-level ``=``.
+    """
+    tokens = []
+    for m in _TOKEN.finditer(code):
+        kind = m.lastgroup
+        if kind in ("comment", "string"):
+            tokens.append(("string", None))
+            continue
+        text = m.group()
+        if kind == "name" and text.startswith("`"):
+            text = text[1:-1]
+        tokens.append((kind, text))
+
+    used, assigned = set(), set()
+    depth = 0  # () and [] nesting; {} bodies count as top level
+    for i, (kind, text) in enumerate(tokens):
+        if kind == "op" and text in ("(", "["):
+            depth += 1
+        elif kind == "op" and text in (")", "]"):
+            depth -= 1
+            if depth < 0:
+                return None
+        if kind == "op" and text.startswith("%"):
+            used.add(text)
+        if kind != "name":
+            continue
+        prev = tokens[i - 1] if i else (None, None)
+        nxt = tokens[i + 1] if i + 1 < len(tokens) else (None, None)
+        if prev[0] == "op" and prev[1] in ("::", ":::", "$", "@"):
+            continue
+        if nxt == ("op", "::") or nxt == ("op", ":::"):
+            continue
+        if nxt == ("op", "=") and depth > 0:
+            continue
+        if nxt[0] == "op" and (nxt[1] in ("<-", "<<-") or (nxt[1] == "=" and depth == 0)):
+            assigned.add(text)
+            continue
+        if prev[0] == "op" and prev[1] in ("->", "->>"):
+            assigned.add(text)
+            continue
+        used.add(text)
+    if depth != 0:
+        return None
+    return used, assigned
+
+
+def required_libraries(code, exports, libraries=R_LIBRARIES, prelude=""):
+    """Libraries (in attach order) whose exports ``code`` uses, or None if unknown.
+
+    ``exports`` comes from ``read_r_exports``. Names the code or the
+    ``prelude`` assign themselves do not count. A name exported by several
+    libraries is credited to one already needed, else to the first in order.
+    """
+    if not exports or any(package not in exports for package in libraries):
+        return None
+    names = _names(code)
+    prelude_names = _names(prelude) if prelude else (set(), set())
+    if names is None or prelude_names is None:
+        return None
+    used, assigned = names
+    if used & DYNAMIC_LOOKUP:
+        return None
+    used -= assigned | prelude_names[1]
+
+    providers = {}
+    for package in libraries:
+        for name in used.intersection(exports[package]):
+            providers.setdefault(name, []).append(package)
+    needed = set()
+    # Names only one library provides decide first; shared names reuse them
+    for name, packages in sorted(providers.items(), key=lambda item: len(item[1])):
+        if not needed.intersection(packages):
+            needed.add(packages[0])
+    return [package for package in libraries if package in needed]
+
+
+def _calls(code):
+    """``(called, formals, attached)`` of an R snippet, or None if it cannot be analyzed.
+
+    Called names are those written ``name(`` (not ``pkg::name(`` or
+    ``x$name(``); formals are the argument names of functions the code
+    defines; attached are the arguments of ``library()``-like calls.
+    """
+    tokens = [(m.lastgroup, m.group()) for m in _TOKEN.finditer(code) if m.lastgroup != "comment"]
+    called, formals, attached = [], set(), []
+    for i, (kind, text) in enumerate(tokens):
+        nxt = tokens[i + 1] if i + 1 < len(tokens) else (None, None)
+        if nxt != ("op", "("):
+            continue
+        if (kind, text) in (("other", "\\"), ("name", "function")):
+            depth = 0
+            for j in range(i + 1, len(tokens)):
+                if tokens[j] in (("op", "("), ("op", "["), ("op", "{")):
+                    depth += 1
+                elif tokens[j] in (("op", ")"), ("op", "]"), ("op", "}")):
+                    depth -= 1
+                    if depth == 0:
+                        break
+                elif depth == 1 and tokens[j][0] == "name" and tokens[j - 1] in (("op", "("), ("op", ",")):
+                    formals.add(tokens[j][1].strip("`"))
+            else:
+                return None
+            continue
+        if kind != "name" or text.startswith("`"):
+            continue
+        prev = tokens[i - 1] if i else (None, None)
+        if prev[0] == "op" and prev[1] in ("::", ":::", "$", "@"):
+            continue
+        called.append(text)
+        if text in ATTACH_CALLS:
+            argument = tokens[i + 2] if i + 2 < len(tokens) else (None, None)
+            attached.append(argument[1].strip("`\"'") if argument[0] in ("name", "string") else None)
+    return called, formals, attached
+
+
+def undefined_functions(code, exports, prelude=""):
+    """Functions ``code`` calls that nothing attached defines, or None if unknown.
+
+    ``exports`` comes from ``read_r_exports`` and must cover BASE_PACKAGES.
+    Functions the code or ``prelude`` define and arguments of functions it
+    defines do not count; code that attaches or sources anything else cannot
+    be judged.
+    """
+    if not exports or any(package not in exports for package in BASE_PACKAGES):
+        return None
+    calls = _calls(code)
+    names = _names(code)
+    prelude_names = _names(prelude) if prelude else (set(), set())
+    if calls is None or names is None or prelude_names is None:
+        return None
+    called, formals, attached = calls
+    if any(package not in exports for package in attached):
+        return None
+    known = set(_KEYWORDS) | TIDYSELECT_HELPERS | formals | names[1] | prelude_names[1]
+    for package in exports.values():
+        known.update(package)
+    return list(dict.fromkeys(name for name in called if name not in known))
+
+
+def is_missing_function_error(stderr):
+    """Whether a run failed because a library it needed was not attached."""
+    return bool(MISSING_FUNCTION_ERROR.search(stderr or ""))
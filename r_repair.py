@@ -0,0 +1,564 @@
+"""Local, deterministic repair of failed R code.
+
+Before a failing block is sent back to the LLM, the repair engine tries:
+
+1. rules that recognize common error signatures and rewrite the code, and
+2. patches learned from earlier successful LLM fixes of the same error
+   signature, stored in SQLite and replayed on new code when they apply.
+
+Only errors neither can handle go to the LLM.
+"""
+import difflib
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+
+# Functions the generated code commonly calls, mapped to the package providing them
+FUNCTION_PACKAGES = {
+    "ggsurvplot": "survminer",
+    "ggforest": "survminer",
+    "surv_fit": "survminer",
+    "surv_pvalue": "survminer",
+    "tbl_regression": "gtsummary",
+    "tbl_summary": "gtsummary",
+    "tbl_uvregression": "gtsummary",
+    "tbl_survfit": "gtsummary",
+    "tbl_merge": "gtsummary",
+    "tbl_stack": "gtsummary",
+    "as_flex_table": "gtsummary",
+    "add_p": "gtsummary",
+    "add_overall": "gtsummary",
+    "add_n": "gtsummary",
+    "bold_labels": "gtsummary",
+    "modify_header": "gtsummary",
+    "save_as_html": "flextable",
+    "save_as_docx": "flextable",
+    "flextable": "flextable",
+    "autofit": "flextable",
+    "set_caption": "flextable",
+    "Surv": "survival",
+    "survfit": "survival",
+    "survdiff": "survival",
+    "coxph": "survival",
+    "cox.zph": "survival",
+    "ggplot": "ggplot2",
+    "ggsave": "ggplot2",
+    "aes": "ggplot2",
+    "labs": "ggplot2",
+    "theme_minimal": "ggplot2",
+    "%>%": "dplyr",
+    "mutate": "dplyr",
+    "summarise": "dplyr",
+    "summarize": "dplyr",
+    "group_by": "dplyr",
+    "arrange": "dplyr",
+    "n_distinct": "dplyr",
+    "case_when": "dplyr",
+    "left_join": "dplyr",
+}
+
+_ERROR_LINE = re.compile(r"^Error\b.*$", re.MULTILINE)
+_QUOTED = re.compile(r"'[^']*'|\"[^\"]*\"|`[^`]*`|‘[^’]*’")
+_NUMBER = re.compile(r"\b\d+(\.\d+)?\b")
+# Errors whose quoted name is what a fix depends on (the package to attach,
+# the object to define), so it stays in the signature
+_NAMED_ERROR = re.compile(r"(?:could not find function|object|there is no package called)\s*$")
+
+
+def error_signature(stderr):
+    """Reduce an R error message to a code-independent signature.
+
+    Quoted names, numbers and whitespace are normalized so the same kind of
+    failure on a different column or file maps to the same signature. The
+    name in "could not find function", "object ... not found" and "no
+    package called" errors is kept: their fixes only fit that name.
+    """
+    match = _ERROR_LINE.search(stderr or "")
+    text = stderr[match.start():] if match else (stderr or "")
+    # The failing call is echoed verbatim; only the message identifies the error
+    text = re.sub(r"^Error in .*? :\s", "Error in <call> : ", text.strip(), count=1, flags=re.DOTALL)
+    lines = [
+        line for line in text.splitlines()
+        if not line.startswith(("Calls:", "Execution halted", "In addition"))
+    ]
+    text = "\n".join(lines[:3])
+    text = _QUOTED.sub(
+        lambda m: m.group(0) if _NAMED_ERROR.search(m.string, 0, m.start()) else "<q>", text
+    )
+    text = _NUMBER.sub("<n>", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class RepairContext:
+    """What rules may know about the dataset the code runs against."""
+
+    def __init__(self, df):
+        self.df = df
+        self.columns = [str(c) for c in df.columns]
+        self._numeric = None
+        self._numeric_like = None
+
+    @property
+    def numeric_columns(self):
+        if self._numeric is None:
+            self._numeric = {
+                str(c) for c in self.df.columns
+                if pd.api.types.is_numeric_dtype(self.df[c].dtype)
+                and not pd.api.types.is_bool_dtype(self.df[c].dtype)
+            }
+        return self._numeric
+
+    @property
+    def numeric_like_columns(self):
+        """Text columns whose values are (almost all) numbers, e.g. "<5" noise."""
+        if self._numeric_like is None:
+            self._numeric_like = set()
+            for c in self.df.columns:
+                s = self.df[c]
+                if pd.api.types.is_numeric_dtype(s.dtype) or pd.api.types.is_bool_dtype(s.dtype):
+                    continue
+                values = s.dropna()
+                if values.empty:
+                    continue
+                values = values.astype(str).head(10000)
+                converted = pd.to_numeric(values, errors="coerce")
+                if converted.notna().mean() >= 0.9:
+                    self._numeric_like.add(str(c))
+        return self._numeric_like
+
+
+# --- Helpers for rewriting calls ---------------------------------------------
+
+def _r_name(name):
+    """Reference a column in R code, backquoting non-syntactic names."""
+    if re.fullmatch(r"[A-Za-z.][\w.]*", name) and not re.match(r"\.\d", name):
+        return name
+    return f"`{name}`"
+
+
+def _find_calls(code, function):
+    """Yield ``(start, open_paren, close_paren)`` for each call to ``function``."""
+    for match in re.finditer(rf"(?<![\w.$]){re.escape(function)}\s*\(", code):
+        open_paren = match.end() - 1
+        depth = 0
+        quote = None
+        i = open_paren
+        while i < len(code):
+            ch = code[i]
+            if quote:
+                if ch == "\\":
+                    i += 1
+                elif ch == quote:
+                    quote = None
+            elif ch in "\"'`":
+                quote = ch
+            elif ch == "(":
+                depth += 1
+            elif ch == ")":
+                depth -= 1
+                if depth == 0:
+                    yield match.start(), open_paren, i
+                    break
+            i += 1
+
+
+def _split_args(args):
+    """Split an argument list at top-level commas."""
+    parts, depth, quote, current = [], 0, None, ""
+    i = 0
+    while i < len(args):
+        ch = args[i]
+        if quote:
+            if ch == "\\" and i + 1 < len(args):
+                current += ch + args[i + 1]
+                i += 2
+                continue
+            if ch == quote:
+                quote = None
+        elif ch in "\"'`":
+            quote = ch
+        elif ch in "([{":
+            depth += 1
+        elif ch in ")]}":
+            depth -= 1
+        elif ch == "," and depth == 0:
+            parts.append(current)
+            current = ""
+            i += 1
+            continue
+        current += ch
+        i += 1
+    if current.strip():
+        parts.append(current)
+    return parts
+
+
+def _rewrite_calls(code, function, rewrite_args):
+    """Rewrite the argument list of every call to ``function``.
+
+    ``rewrite_args(args, call_start)`` returns a new list of argument strings
+    or None to leave the call untouched.
+    """
+    pieces, last = [], 0
+    for start, open_paren, close_paren in _find_calls(code, function):
+        if start < last:
+            continue
+        args = _split_args(code[open_paren + 1:close_paren])
+        new_args = rewrite_args(args, start)
+        if new_args is None:
+            continue
+        pieces.append(code[last:open_paren + 1])
+        pieces.append(", ".join(a.strip() for a in new_args))
+        last = close_paren
+    pieces.append(code[last:])
+    return "".join(pieces)
+
+
+def _replace_name(code, old, new):
+    """Replace a bare/quoted identifier without touching longer names."""
+    escaped = re.escape(old)
+    quoted = f"`{new.strip('`')}`"
+    code = re.sub(rf"`{escaped}`", lambda _: quoted, code)
+    return re.sub(rf"(?<![\w.`]){escaped}(?![\w.`])", lambda _: new, code)
+
+
+# --- Rules ---------------------------------------------------------------------
+# Each rule takes (code, error, context) and returns fixed code or None.
+
+def fix_windows_paths(code, error, context):
+    """Backslashes in paths make R read escapes like \\U."""
+    if "\\U" in error or "\\u" in error or re.search(r"used without hex digits|is an unrecognized escape", error):
+        return code.replace("\\", "/")
+    return None
+
+
+def fix_missing_library(code, error, context):
+    """Attach the package of a function R could not find."""
+    missing = re.findall(r'could not find function "([^"]+)"', error)
+    libraries = []
+    for function in missing:
+        package = FUNCTION_PACKAGES.get(function)
+        if package and not re.search(rf"library\(\s*{re.escape(package)}\s*\)", code):
+            libraries.append(f"library({package})")
+    if not libraries:
+        return None
+    return "\n".join(dict.fromkeys(libraries)) + "\n" + code
+
+
+def fix_save_as_html_path(code, error, context):
+    """flextable::save_as_html() needs the file passed as ``path =``."""
+    if "save_as_html" not in code or "path" not in error:
+        return None
+
+    def add_path(args, _start):
+        if any(re.match(r"\s*path\s*=", a) for a in args):
+            return None
+        for i in range(len(args) - 1, -1, -1):
+            if re.fullmatch(r"\s*[\"'][^\"']+\.html?[\"']\s*", args[i]):
+                return args[:i] + [f"path = {args[i].strip()}"] + args[i + 1:]
+        return args + ['path = "table.html"']
+
+    return _rewrite_calls(code, "save_as_html", add_path)
+
+
+def fix_ggsurvplot_save(code, error, context):
+    """ggsave() needs ``p$plot`` for ggsurvplot objects."""
+    if "ggsurvplot" not in code or not re.search(r"ggplot|grid\.draw|ggsurvplot", error):
+        return None
+    assignments = [
+        (m.start(), m.group(1))
+        for m in re.finditer(r"([A-Za-z.][\w.]*)\s*(?:<-|=)\s*ggsurvplot\s*\(", code)
+    ]
+    if not assignments:
+        return None
+    surv_vars = {name for _, name in assignments}
+
+    def use_plot(args, start):
+        named = [i for i, a in enumerate(args) if re.match(r"\s*plot\s*=", a)]
+        if named:
+            i = named[0]
+            value = args[i].split("=", 1)[1].strip()
+            if value in surv_vars:
+                return args[:i] + [f"plot = {value}$plot"] + args[i + 1:]
+            return None
+        positional = [i for i, a in enumerate(args) if not re.match(r"\s*[\w.]+\s*=", a)]
+        if len(positional) >= 2:
+            i = positional[1]
+            if args[i].strip() in surv_vars:
+                return args[:i] + [f"{args[i].strip()}$plot"] + args[i + 1:]
+            return None
+        # No plot given: ggsave would use last_plot(); save the latest ggsurvplot
+        previous = [name for pos, name in assignments if pos < start]
+        if previous:
+            return args + [f"plot = {previous[-1]}$plot"]
+        return None
+
+    return _rewrite_calls(code, "ggsave", use_plot)
+
+
+_MISSING_NAME_PATTERNS = [
+    r"object '([^']+)' not found",
+    r"[Cc]olumn `([^`]+)` (?:doesn't|does not) exist",
+    r"[Cc]olumn `([^`]+)` not found",
+    r"object ‘([^’]+)’ not found",
+]
+
+
+def fix_column_names(code, error, context):
+    """Replace misspelled column names with their closest match in df."""
+    missing = set()
+    for pattern in _MISSING_NAME_PATTERNS:
+        missing.update(re.findall(pattern, error))
+    if "undefined columns selected" in error:
+        # Names used as df$x / df[["x"]] / "x" that aren't columns
+        candidates = re.findall(r"\$`?([\w.]+)`?|\[\[\s*[\"']([^\"']+)[\"']\s*\]\]", code)
+        missing.update(a or b for a, b in candidates)
+    columns = context.columns
+    lowered = {c.lower(): c for c in columns}
+    fixed = code
+    for name in missing:
+        if name in columns:
+            continue
+        # A variable the code defines itself is an ordering problem, not a typo
+        if re.search(rf"(?<![\w.]){re.escape(name)}\s*(<-|=)(?!=)", code):
+            continue
+        match = lowered.get(name.lower())
+        if match is None:
+            close = difflib.get_close_matches(name, columns, n=1, cutoff=0.75)
+            if not close:
+                continue
+            match = close[0]
+        fixed = _replace_name(fixed, name, _r_name(match))
+    return fixed if fixed != code else None
+
+
+_DISCRETE_AES = r"fill|colou?r|shape|linetype|group"
+
+
+def fix_scale_types(code, error, context):
+    """Numeric columns mapped to discrete aesthetics need factor(), and back."""
+    if "Continuous value supplied to discrete scale" in error:
+        def wrap(match):
+            name = match.group(2).strip("`")
+            if name in context.numeric_columns:
+                return f"{match.group(1)} = factor({match.group(2)})"
+            return match.group(0)
+        fixed = re.sub(rf"\b({_DISCRETE_AES})\s*=\s*(`[^`]+`|[A-Za-z.][\w.]*)", wrap, code)
+        return fixed if fixed != code else None
+    if "Discrete value supplied to continuous scale" in error:
+        def unwrap(match):
+            name = match.group(2).strip("`")
+            if name in context.numeric_like_columns:
+                return f"{match.group(1)} = as.numeric({match.group(2)})"
+            return match.group(0)
+        fixed = re.sub(r"\b(x|y)\s*=\s*(`[^`]+`|[A-Za-z.][\w.]*)", unwrap, code)
+        return fixed if fixed != code else None
+    return None
+
+
+_NON_NUMERIC_ERRORS = (
+    "non-numeric argument",
+    "must be numeric",
+    "argument is not numeric or logical",
+    "invalid 'type' (character)",
+    "need numeric data",
+)
+
+
+def fix_numeric_text_columns(code, error, context):
+    """Convert number-like text columns with as.numeric() where used as numbers."""
+    if not any(marker in error for marker in _NON_NUMERIC_ERRORS):
+        return None
+    fixed = code
+    for name in context.numeric_like_columns:
+        escaped = re.escape(name)
+        fixed = re.sub(
+            rf"(?<!as\.numeric\()(\bdf\$(?:{escaped}|`{escaped}`)(?![\w.])|\bdf\[\[\s*[\"']{escaped}[\"']\s*\]\])",
+            r"as.numeric(\1)",
+            fixed,
+        )
+    return fixed if fixed != code else None
+
+
+DEFAULT_RULES = [
+    fix_windows_paths,
+    fix_missing_library,
+    fix_save_as_html_path,
+    fix_ggsurvplot_save,
+    fix_column_names,
+    fix_scale_types,
+    fix_numeric_text_columns,
+]
+
+
+# --- Learned patches -------------------------------------------------------------
+
+def make_patch(before, after):
+    """Line-level edit script turning ``before`` into ``after``."""
+    a = before.splitlines()
+    b = after.splitlines()
+    matcher = difflib.SequenceMatcher(None, [l.strip() for l in a], [l.strip() for l in b])
+    ops = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            continue
+        ops.append({
+            "old": [l.strip() for l in a[i1:i2]],
+            "new": b[j1:j2],
+            "anchor": a[i1 - 1].strip() if i1 > 0 else None,
+        })
+    return ops
+
+
+def apply_patch(code, ops):
+    """Apply a patch from make_patch(); returns None if any edit doesn't fit."""
+    lines = code.splitlines()
+    for op in ops:
+        stripped = [l.strip() for l in lines]
+        if op["old"]:
+            n = len(op["old"])
+            at = next(
+                (i for i in range(len(lines) - n + 1) if stripped[i:i + n] == op["old"]),
+                None,
+            )
+            if at is None:
+                return None
+            lines[at:at + n] = op["new"]
+        elif all(l.strip() in stripped for l in op["new"]):
+            # Already inserted (e.g. by an earlier application of this patch)
+            continue
+        elif op["anchor"] is None:
+            lines[0:0] = op["new"]
+        else:
+            if op["anchor"] not in stripped:
+                return None
+            at = stripped.index(op["anchor"]) + 1
+            lines[at:at] = op["new"]
+    patched = "\n".join(lines)
+    return patched if patched != code else None
+
+
+class PatchStore:
+    """Error signature -> patches learned from successful LLM fixes (SQLite)."""
+
+    MAX_PATCH_OPS = 12
+    MAX_PER_SIGNATURE = 5
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS patches ("
+                " signature TEXT NOT NULL, patch_id TEXT NOT NULL, patch TEXT NOT NULL,"
+                " hits INTEGER NOT NULL DEFAULT 0, created REAL NOT NULL,"
+                " PRIMARY KEY (signature, patch_id))"
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def learn(self, error, before, after):
+        ops = make_patch(before, after)
+        if not ops or len(ops) > self.MAX_PATCH_OPS:
+            return
+        signature = error_signature(error)
+        patch = json.dumps(ops, sort_keys=True)
+        patch_id = hashlib.sha256(patch.encode("utf-8")).hexdigest()[:16]
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO patches (signature, patch_id, patch, created)"
+                " VALUES (?, ?, ?, ?)",
+                (signature, patch_id, patch, time.time()),
+            )
+            # Keep only the most useful patches per signature
+            conn.execute(
+                "DELETE FROM patches WHERE signature = ? AND patch_id NOT IN ("
+                " SELECT patch_id FROM patches WHERE signature = ?"
+                " ORDER BY hits DESC, created DESC LIMIT ?)",
+                (signature, signature, self.MAX_PER_SIGNATURE),
+            )
+
+    def lookup(self, error, code, exclude=()):
+        """Return ``(fixed_code, patch_id)`` for the first learned patch that applies.
+
+        Patches whose id is in ``exclude`` (already tried on this code) are skipped.
+        """
+        signature = error_signature(error)
+        with self._lock, self._connect() as conn:
+            rows = conn.execute(
+                "SELECT patch_id, patch FROM patches WHERE signature = ?"
+                " ORDER BY hits DESC, created DESC",
+                (signature,),
+            ).fetchall()
+            for patch_id, patch in rows:
+                if patch_id in exclude:
+                    continue
+                fixed = apply_patch(code, json.loads(patch))
+                if fixed is not None:
+                    conn.execute(
+                        "UPDATE patches SET hits = hits + 1 WHERE signature = ? AND patch_id = ?",
+                        (signature, patch_id),
+                    )
+                    return fixed, patch_id
+        return None, None
+
+
+class RepairEngine:
+    """Pluggable local repair: rules first, then learned patches."""
+
+    def __init__(self, rules=None, store=None):
+        self.rules = list(DEFAULT_RULES if rules is None else rules)
+        self.store = store
+        self.stats = {"rule_fixes": 0, "learned_fixes": 0, "misses": 0}
+
+    def register(self, rule, first=False):
+        """Add a rule ``rule(code, error, context) -> fixed code or None``."""
+        if first:
+            self.rules.insert(0, rule)
+        else:
+            self.rules.append(rule)
+
+    def repair(self, code, error, context, tried=None):
+        """Return ``(fixed_code, source)``, or ``(None, None)`` if nothing applies.
+
+        ``tried`` is a set of learned patch ids already used on this block;
+        the patch used is added to it, so each is tried at most once.
+        """
+        for rule in self.rules:
+            try:
+                fixed = rule(code, error, context)
+            except Exception:
+                # A broken rule must never take down the chat
+                continue
+            if fixed and fixed != code:
+                self.stats["rule_fixes"] += 1
+                return fixed, rule.__name__
+        if self.store is not None:
+            fixed, patch_id = self.store.lookup(error, code, exclude=tried or ())
+            if fixed:
+                if tried is not None:
+                    tried.add(patch_id)
+                self.stats["learned_fixes"] += 1
+                return fixed, f"learned patch {patch_id}"
+        self.stats["misses"] += 1
+        return None, None
+
+    def learn(self, error, before, after):
+        """Remember a fix that made failing code succeed."""
+        if self.store is not None and before.strip() != after.strip():
+            self.store.learn(error, before, after)
@@ -0,0 +1,1004 @@
+"""Pool of long-lived R worker processes.
+
+Each worker is an ``Rscript`` process that loads the analysis libraries and the
+Pandoc configuration once at startup, then executes jobs sent to it over its
+stdin pipe. Every job runs in a fresh environment and the worker's global
+state is reset afterwards, so jobs cannot see each other's objects. The last
+dataset a worker loaded in full stays in its memory for later jobs.
+"""
+import os
+import queue
+import secrets
+import signal
+import subprocess
+import threading
+import time
+from collections import deque
+
+from dataset_store import r_string
+
+try:
+    import resource
+except ImportError:  # Windows: no rlimits, jobs only get the wall-clock timeout
+    resource = None
+
+# How often running jobs are checked for cancellation and memory use (seconds)
+POLL_INTERVAL = 0.25
+
+# Libraries attached in every worker (and in the one-shot Rscript fallback)
+R_LIBRARIES = [
+    "ggplot2",
+    "dplyr",
+    "gtsummary",
+    "survival",
+    "survminer",
+    "flextable",
+    "broom.helpers",
+]
+
+WORKER_BOOTSTRAP = r"""
+# --- PANDOC CONFIG (MANDATORY) ---
+conda_dir <- "{conda_bin_dir}"
+Sys.setenv(RSTUDIO_PANDOC = conda_dir)
+Sys.setenv(PATH = paste(conda_dir, Sys.getenv("PATH"), sep=":"))
+rm(conda_dir)
+
+# Load Libraries
+suppressPackageStartupMessages({{
+{library_calls}
+}})
+{prelude}
+# Packages and data a job attaches beyond these are detached after it
+.worker_search <- search()
+.worker_token <- commandArgs(trailingOnly = TRUE)[1]
+.worker_cpu_limit <- as.numeric(commandArgs(trailingOnly = TRUE)[2])
+
+.worker_reply <- function(...) {{
+    cat(.worker_token, ..., sep = "\t", file = .worker_stdout)
+    cat("\n", file = .worker_stdout)
+    flush(.worker_stdout)
+}}
+
+.worker_sessions <- new.env()
+
+# The last dataset loaded in full stays in memory; jobs get copy-on-modify
+# references, so changes they make to their df never reach the cached one
+.worker_data <- new.env()
+
+.worker_dataset <- function(loader, columns = NULL) {{
+    cached <- identical(.worker_data$loader, loader) &&
+        identical(class(.worker_data$df), "data.frame")
+    if (!cached) {{
+        env <- new.env(parent = globalenv())
+        if (!is.null(columns)) {{
+            # Not worth evicting the cached dataset for a partial load
+            assign(".df_columns", columns, envir = env)
+            source(loader, local = env)
+            return(env$df)
+        }}
+        .worker_data$loader <- NULL
+        .worker_data$df <- NULL
+        invisible(gc(verbose = FALSE))
+        source(loader, local = env)
+        .worker_data$df <- env$df
+        .worker_data$loader <- loader
+    }}
+    df <- .worker_data$df
+    if (!is.null(columns)) df <- df[, names(df) %in% columns, drop = FALSE]
+    df
+}}
+
+.worker_loaded <- function() {{
+    if (is.null(.worker_data$loader)) "" else .worker_data$loader
+}}
+
+.worker_session_env <- function(session_id, snapshot) {{
+    if (!exists(session_id, envir = .worker_sessions, inherits = FALSE)) {{
+        env <- new.env(parent = globalenv())
+        if (file.exists(snapshot)) {{
+            try(load(snapshot, envir = env), silent = TRUE)
+        }}
+        assign(session_id, env, envir = .worker_sessions)
+    }}
+    get(session_id, envir = .worker_sessions, inherits = FALSE)
+}}
+
+.worker_save_session <- function(env, snapshot, max_bytes) {{
+    # The staged dataset is reloaded on restore, so an unmodified df is skipped
+    keep <- setdiff(ls(env, all.names = TRUE), ".df_source")
+    if (exists(".df_source", envir = env, inherits = FALSE) &&
+        exists("df", envir = env, inherits = FALSE) &&
+        identical(get("df", envir = env), get(".df_source", envir = env))) {{
+        keep <- setdiff(keep, "df")
+    }}
+    size <- sum(vapply(keep, function(n) as.numeric(object.size(get(n, envir = env))), numeric(1)))
+    if (size <= max_bytes) {{
+        tmp <- paste0(snapshot, ".tmp")
+        saved <- tryCatch({{
+            save(list = keep, envir = env, file = tmp, compress = FALSE)
+            file.rename(tmp, snapshot)
+        }}, error = function(e) FALSE)
+        if (!isTRUE(saved)) unlink(tmp)
+    }}
+    size
+}}
+
+.worker_run_job <- function(script, out_file, err_file, wd, job_env = new.env(parent = globalenv())) {{
+    baseline <- ls(globalenv(), all.names = TRUE)
+    base_options <- options()
+    home <- getwd()
+
+    out_con <- file(out_file, open = "wt")
+    err_con <- file(err_file, open = "wt")
+    sink(out_con)
+    sink(err_con, type = "message")
+
+    ok <- tryCatch({{
+        setwd(wd)
+        # Per-job CPU budget; the process-wide RLIMIT_CPU would outlive the job
+        if (.worker_cpu_limit > 0) setTimeLimit(cpu = .worker_cpu_limit)
+        withCallingHandlers(
+            source(script, local = job_env, echo = FALSE, print.eval = TRUE),
+            warning = function(w) {{
+                message("Warning message:\n", conditionMessage(w))
+                invokeRestart("muffleWarning")
+            }}
+        )
+        TRUE
+    }}, error = function(e) {{
+        call <- conditionCall(e)
+        prefix <- if (is.null(call)) "Error: " else paste0("Error in ", deparse(call)[1], " : ")
+        message(prefix, conditionMessage(e))
+        message("Execution halted")
+        FALSE
+    }})
+
+    setTimeLimit()
+
+    # Unwind any sinks the job left behind, then our own
+    while (sink.number() > 0) sink()
+    sink(type = "message")
+    close(out_con)
+    close(err_con)
+
+    # Reset worker state so the next job starts clean
+    try(grDevices::graphics.off(), silent = TRUE)
+    setwd(home)
+    for (name in setdiff(search(), .worker_search)) {{
+        try(detach(name, character.only = TRUE), silent = TRUE)
+    }}
+    options(base_options)
+    added <- setdiff(names(options()), names(base_options))
+    if (length(added) > 0) options(setNames(vector("list", length(added)), added))
+    leaked <- setdiff(ls(globalenv(), all.names = TRUE), baseline)
+    rm(list = leaked, envir = globalenv())
+    rm(job_env)
+    invisible(gc(verbose = FALSE))
+
+    if (ok) "ok" else "error"
+}}
+
+.worker_main <- function() {{
+    con <- file("stdin", open = "r")
+    .worker_reply("READY", R.version.string)
+    repeat {{
+        line <- readLines(con, n = 1)
+        if (length(line) == 0) break
+        parts <- strsplit(line, "\t", fixed = TRUE)[[1]]
+        cmd <- parts[1]
+        job_id <- parts[2]
+        if (cmd == "QUIT") break
+        if (cmd == "PING") {{
+            .worker_reply("PONG", job_id)
+        }} else if (cmd == "RUN") {{
+            status <- .worker_run_job(parts[3], parts[4], parts[5], parts[6])
+            .worker_reply("DONE", job_id, status, .worker_loaded())
+        }} else if (cmd == "SRUN") {{
+            env <- .worker_session_env(parts[7], parts[8])
+            status <- .worker_run_job(parts[3], parts[4], parts[5], parts[6], env)
+            size <- .worker_save_session(env, parts[8], as.numeric(parts[9]))
+            objects <- gsub("[\t\n,]", "_", head(ls(env), 100))
+            .worker_reply("DONE", job_id, status, format(size, scientific = FALSE),
+                          paste(objects, collapse = ","))
+        }} else if (cmd == "LOAD") {{
+            ok <- tryCatch({{
+                .worker_dataset(parts[3])
+                TRUE
+            }}, error = function(e) FALSE)
+            .worker_reply("LOADED", job_id, if (ok) "ok" else "error")
+        }} else if (cmd == "PARSE") {{
+            problem <- tryCatch({{
+                parse(text = readLines(parts[3], warn = FALSE, encoding = "UTF-8"), keep.source = FALSE)
+                ""
+            }}, error = function(e) conditionMessage(e))
+            .worker_reply("PARSED", job_id, if (nzchar(problem)) "error" else "ok",
+                          gsub("\n", "\\n", gsub("\t", " ", problem, fixed = TRUE), fixed = TRUE))
+        }} else if (cmd == "SDROP") {{
+            if (exists(parts[3], envir = .worker_sessions, inherits = FALSE)) {{
+                rm(list = parts[3], envir = .worker_sessions)
+            }}
+            invisible(gc(verbose = FALSE))
+            .worker_reply("DROPPED", job_id)
+        }}
+    }}
+}}
+
+.worker_stdout <- stdout()
+.worker_main()
+"""
+
+
+class RWorkerError(Exception):
+    """Raised when an R worker cannot be started or stops responding."""
+
+
+# Returned by RWorker._wait_reply when the caller's cancel event fires
+_CANCELLED = ["CANCELLED"]
+CANCELLED_MESSAGE = "Execution cancelled by user"
+# ... and when the worker grows past its memory limit
+_OVER_MEMORY = ["OVER_MEMORY"]
+
+
+def memory_limit_message(memory_limit):
+    return f"R was stopped: it used more than {int(memory_limit) // 1024 ** 2} MB of memory"
+
+
+def build_library_calls(libraries=None, indent="    "):
+    """Render ``library()`` calls for the given packages (None: all of R_LIBRARIES)."""
+    return "\n".join(
+        f"{indent}library({lib})" for lib in (R_LIBRARIES if libraries is None else libraries)
+    )
+
+
+def write_worker_bootstrap(path, conda_bin_dir, libraries=None, prelude=""):
+    """Write the worker bootstrap script (``libraries=[]`` attaches none)."""
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(WORKER_BOOTSTRAP.format(
+            conda_bin_dir=conda_bin_dir.replace("\\", "/"),
+            library_calls=build_library_calls(libraries),
+            prelude=prelude,
+        ))
+
+
+def build_r_script(code, data_loader_r, output_dir_r, preamble=True, session=False,
+                   columns=None, conda_bin_dir=None, prelude="", libraries=None):
+    """Build the R script for a job; workers already have the preamble loaded.
+
+    Without the preamble the script runs on a worker and takes ``df`` from the
+    worker's in-memory copy of the dataset when it has one. In a persistent
+    session the dataset is only loaded once, so changes the code makes to
+    ``df`` carry over to later blocks. ``columns`` restricts loading to those
+    columns (None loads all of them). ``prelude`` is R code run after the
+    libraries when the preamble is included; ``libraries`` limits the
+    preamble to those packages (None attaches all of R_LIBRARIES).
+    """
+    setup = ""
+    if preamble and conda_bin_dir:
+        setup = f"""
+# --- PANDOC CONFIG (MANDATORY) ---
+# Force R to find Pandoc in the same directory as Python/R
+conda_dir <- "{conda_bin_dir}"
+Sys.setenv(RSTUDIO_PANDOC = conda_dir)
+Sys.setenv(PATH = paste(conda_dir, Sys.getenv("PATH"), sep=":"))
+"""
+    library_block = ""
+    if preamble:
+        if libraries is None or libraries:
+            library_block = f"""
+# Load Libraries
+suppressPackageStartupMessages({{
+{build_library_calls(libraries)}
+}})"""
+        library_block += f"\n{prelude}"
+
+    columns_r = "NULL" if columns is None else f'c({", ".join(r_string(c) for c in columns)})'
+    if not preamble:
+        load_data = f'df <- .worker_dataset("{data_loader_r}", {columns_r})'
+    elif columns is not None:
+        load_data = f""".df_columns <- {columns_r}
+source("{data_loader_r}", local = TRUE)
+rm(.df_columns)"""
+    else:
+        load_data = f'source("{data_loader_r}", local = TRUE)'
+    if session:
+        load_data = f"""if (!exists("df", inherits = FALSE)) {{
+    {load_data}
+    .df_source <- df
+}}"""
+
+    return f"""{setup}
+# Setup working dir
+setwd("{output_dir_r}")
+{load_data}
+{library_block}
+# User Code
+{code}
+"""
+
+
+def _kill_process_tree(proc):
+    """Kill a worker and everything it spawned (it runs in its own session)."""
+    if proc.poll() is not None:
+        return
+    try:
+        if hasattr(os, "killpg"):
+            os.killpg(proc.pid, signal.SIGKILL)
+        else:
+            proc.kill()
+    except (ProcessLookupError, PermissionError):
+        proc.kill()
+    try:
+        proc.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        pass
+
+
+def _apply_cpu_limit(pid, cpu_limit):
+    """Cap a started process's CPU time (SIGXCPU at the limit, SIGKILL a little later).
+
+    Applied with ``prlimit`` after the fork rather than in a ``preexec_fn``,
+    which is unsafe in a process with threads. Where ``prlimit`` is missing
+    only the wall-clock timeout applies.
+    """
+    if not cpu_limit or resource is None or not hasattr(resource, "prlimit"):
+        return
+    try:
+        resource.prlimit(pid, resource.RLIMIT_CPU, (int(cpu_limit), int(cpu_limit) + 5))
+    except (OSError, ValueError):
+        pass
+
+
+def resident_bytes(pid):
+    """Resident memory of a process, or None where ``/proc`` is unavailable.
+
+    Memory limits are enforced on this rather than with RLIMIT_AS: address
+    space also counts memory-mapped datasets and allocator reservations
+    (arrow's jemalloc), which would fail allocations long before the process
+    really uses that much memory.
+    """
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def _over_limit(pid, memory_limit):
+    if not memory_limit:
+        return False
+    rss = resident_bytes(pid)
+    return rss is not None and rss > memory_limit
+
+
+def run_script_once(r_exec, script_path, cwd, timeout=120, cancel=None,
+                    memory_limit=None, cpu_limit=None):
+    """Run a script with a fresh ``Rscript`` process.
+
+    Returns ``(success, stdout, stderr)``; the whole process tree is killed on
+    timeout, when ``cancel`` is set or when its resident memory exceeds
+    ``memory_limit`` bytes. ``cpu_limit`` caps its CPU seconds.
+    """
+    popen_kwargs = {}
+    if os.name == "posix":
+        popen_kwargs["start_new_session"] = True
+    proc = subprocess.Popen(
+        [r_exec, script_path],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        cwd=cwd,
+        **popen_kwargs
+    )
+    _apply_cpu_limit(proc.pid, cpu_limit)
+    deadline = time.time() + timeout
+    while True:
+        try:
+            stdout, stderr = proc.communicate(timeout=POLL_INTERVAL)
+            return proc.returncode == 0, stdout, stderr
+        except subprocess.TimeoutExpired:
+            if cancel is not None and cancel.is_set():
+                message = CANCELLED_MESSAGE
+            elif _over_limit(proc.pid, memory_limit):
+                message = memory_limit_message(memory_limit)
+            elif time.time() >= deadline:
+                message = f"R execution timed out after {timeout} seconds"
+            else:
+                continue
+        _kill_process_tree(proc)
+        stdout, stderr = proc.communicate()
+        return False, stdout, (stderr + "\n" + message).lstrip()
+
+
+def _read_text(path):
+    try:
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            return f.read()
+    except OSError:
+        return ""
+
+
+class RWorker:
+    """A single long-lived ``Rscript`` process speaking the worker protocol."""
+
+    def __init__(self, r_exec, bootstrap_path, startup_timeout=120,
+                 memory_limit=None, cpu_limit=None):
+        self.token = secrets.token_hex(8)
+        self.jobs_run = 0
+        self.started_at = time.time()
+        # Loader path of the dataset held in the worker's memory, if any
+        self.dataset = None
+        self._replies = queue.Queue()
+        self._stderr_tail = deque(maxlen=50)
+        self._job_seq = 0
+        self._eof = False
+        # Checked while jobs run; CPU time is limited per job inside R
+        self.memory_limit = memory_limit
+
+        popen_kwargs = {}
+        if os.name == "posix":
+            popen_kwargs["start_new_session"] = True
+        self.proc = subprocess.Popen(
+            [r_exec, bootstrap_path, self.token, str(int(cpu_limit or 0))],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            encoding="utf-8",
+            errors="replace",
+            bufsize=1,
+            **popen_kwargs
+        )
+        threading.Thread(target=self._pump_stdout, daemon=True).start()
+        threading.Thread(target=self._pump_stderr, daemon=True).start()
+
+        reply = self._wait_reply(startup_timeout)
+        if reply is None or reply[0] != "READY":
+            self.kill()
+            raise RWorkerError(
+                "R worker failed to start:\n" + "\n".join(self._stderr_tail)
+            )
+        self.r_version = reply[1] if len(reply) > 1 else ""
+
+    def _pump_stdout(self):
+        # Only lines carrying our token are protocol replies; anything else was
+        # written straight to the file descriptor by user code and is dropped.
+        for line in self.proc.stdout:
+            parts = line.rstrip("\n").split("\t")
+            if parts and parts[0] == self.token:
+                self._replies.put(parts[1:])
+        self._eof = True
+        self._replies.put(None)
+
+    def _pump_stderr(self):
+        for line in self.proc.stderr:
+            self._stderr_tail.append(line.rstrip("\n"))
+
+    def _wait_reply(self, timeout, job_id=None, cancel=None, watch_memory=False):
+        # Replies to earlier, abandoned requests (e.g. a late PONG) are skipped
+        deadline = time.time() + timeout
+        poll = cancel is not None or (watch_memory and self.memory_limit)
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            if cancel is not None and cancel.is_set():
+                return _CANCELLED
+            if watch_memory and _over_limit(self.proc.pid, self.memory_limit):
+                return _OVER_MEMORY
+            try:
+                reply = self._replies.get(timeout=min(remaining, POLL_INTERVAL) if poll else remaining)
+            except queue.Empty:
+                continue
+            if reply is None or job_id is None or reply[1:2] == [job_id]:
+                return reply
+
+    def _send(self, *fields):
+        for field in fields:
+            if "\t" in field or "\n" in field:
+                raise ValueError(f"Invalid character in worker command field: {field!r}")
+        self.proc.stdin.write("\t".join(fields) + "\n")
+        self.proc.stdin.flush()
+
+    def _next_job_id(self):
+        self._job_seq += 1
+        return str(self._job_seq)
+
+    def is_alive(self):
+        return self.proc.poll() is None
+
+    def ping(self, timeout=5):
+        """Health check: the worker must answer a PING within ``timeout`` seconds."""
+        if not self.is_alive():
+            return False
+        job_id = self._next_job_id()
+        try:
+            self._send("PING", job_id)
+        except (BrokenPipeError, OSError):
+            return False
+        reply = self._wait_reply(timeout, job_id)
+        return reply is not None and reply[0] == "PONG"
+
+    def load_dataset(self, loader_path, timeout=120):
+        """Load a staged dataset into the worker's memory for later jobs.
+
+        Returns whether it loaded; a worker that does not answer in time is
+        killed.
+        """
+        if self.dataset == loader_path:
+            return True
+        job_id = self._next_job_id()
+        try:
+            self._send("LOAD", job_id, loader_path)
+        except (BrokenPipeError, OSError):
+            return False
+        reply = self._wait_reply(timeout, job_id)
+        if reply is None:
+            self.kill()
+            return False
+        if reply[2:3] == ["ok"]:
+            self.dataset = loader_path
+            return True
+        return False
+
+    def parse(self, script_path, timeout=10):
+        """Check a file with R's parser without running it.
+
+        Returns ``(ok, message)``, the message being R's syntax error. Raises
+        RWorkerError (after killing the worker) when it does not answer.
+        """
+        job_id = self._next_job_id()
+        try:
+            self._send("PARSE", job_id, script_path)
+        except (BrokenPipeError, OSError) as e:
+            self.kill()
+            raise RWorkerError(f"R worker is not accepting jobs: {e}")
+        reply = self._wait_reply(timeout, job_id)
+        if reply is None or reply[0] != "PARSED":
+            self.kill()
+            raise RWorkerError("R worker did not answer a parse request")
+        message = reply[3] if len(reply) > 3 else ""
+        return reply[2:3] == ["ok"], message.replace("\\n", "\n")
+
+    def run(self, script_path, output_dir, timeout=120, cancel=None):
+        """Execute an R script file inside the worker in a fresh environment.
+
+        Returns ``(success, stdout, stderr)``. On timeout, crash or when the
+        ``cancel`` event is set, the worker is killed and must not be reused.
+        """
+        success, stdout, stderr, _ = self._run_job(
+            "RUN", script_path, output_dir, timeout, cancel=cancel
+        )
+        return success, stdout, stderr
+
+    def run_in_session(self, script_path, output_dir, session_id, snapshot_path,
+                       max_bytes, timeout=120, cancel=None):
+        """Execute a script in a persistent session environment.
+
+        The environment is created on first use (restored from ``snapshot_path``
+        if it exists) and saved back there after the job when its size is within
+        ``max_bytes``. Returns ``(success, stdout, stderr, size, objects)``;
+        ``size`` is None when the worker died, timed out or was cancelled.
+        """
+        success, stdout, stderr, reply = self._run_job(
+            "SRUN", script_path, output_dir, timeout,
+            session_id, snapshot_path, str(int(max_bytes)), cancel=cancel,
+        )
+        if reply is None:
+            return success, stdout, stderr, None, []
+        size = float(reply[3]) if len(reply) > 3 else 0.0
+        objects = [name for name in reply[4].split(",") if name] if len(reply) > 4 else []
+        return success, stdout, stderr, size, objects
+
+    def drop_session(self, session_id, timeout=30):
+        """Forget a session environment held by this worker."""
+        job_id = self._next_job_id()
+        try:
+            self._send("SDROP", job_id, session_id)
+        except (BrokenPipeError, OSError):
+            return False
+        return self._wait_reply(timeout, job_id) is not None
+
+    def _run_job(self, command, script_path, output_dir, timeout, *extra, cancel=None):
+        job_id = self._next_job_id()
+        out_file = os.path.join(output_dir, f".r_stdout_{job_id}.txt")
+        err_file = os.path.join(output_dir, f".r_stderr_{job_id}.txt")
+        self.jobs_run += 1
+
+        try:
+            self._send(command, job_id, script_path, out_file, err_file, output_dir, *extra)
+        except (BrokenPipeError, OSError) as e:
+            self.kill()
+            raise RWorkerError(f"R worker is not accepting jobs: {e}")
+
+        reply = self._wait_reply(timeout, job_id, cancel, watch_memory=True)
+        if reply is _CANCELLED or reply is _OVER_MEMORY:
+            self.kill()
+            message = CANCELLED_MESSAGE if reply is _CANCELLED else memory_limit_message(self.memory_limit)
+            return False, _read_text(out_file), (
+                _read_text(err_file) + "\n" + message
+            ).lstrip(), None
+        if reply is None and not self._eof:
+            self.kill()
+            stderr = _read_text(err_file)
+            return False, _read_text(out_file), (
+                stderr + f"\nR execution timed out after {timeout} seconds"
+            ).lstrip(), None
+
+        stdout = _read_text(out_file)
+        stderr = _read_text(err_file)
+        for path in (out_file, err_file):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+        if reply is None:
+            # The worker exited mid-job (e.g. the code called quit())
+            returncode = self.proc.wait()
+            if returncode == 0:
+                return True, stdout, stderr, None
+            return False, stdout, (
+                stderr + f"\nR worker exited unexpectedly (exit code {returncode})\n"
+                + "\n".join(self._stderr_tail)
+            ).strip(), None
+
+        if command == "RUN" and len(reply) > 3:
+            self.dataset = reply[3] or None
+        return reply[0] == "DONE" and reply[2:3] == ["ok"], stdout, stderr, reply
+
+    def close(self):
+        if self.is_alive():
+            try:
+                self._send("QUIT", "0")
+                self.proc.wait(timeout=5)
+            except (BrokenPipeError, OSError, subprocess.TimeoutExpired):
+                pass
+        self.kill()
+
+    def kill(self):
+        _kill_process_tree(self.proc)
+
+
+class RWorkerPool:
+    """Fixed-size pool of warm R workers with health checks and recycling.
+
+    Workers are recycled after ``max_jobs`` jobs, after a crash or timeout, and
+    whenever they fail the health check performed before each job.
+    ``memory_limit`` (resident bytes, checked while jobs run) and
+    ``cpu_limit`` (CPU seconds per job) cap every worker the pool starts.
+
+    ``prelude`` is R code run once per worker after the libraries are
+    attached (helpers visible to every job).
+    """
+
+    def __init__(self, r_exec, conda_bin_dir, size=2, max_jobs=50,
+                 startup_timeout=120, libraries=None, work_dir=None,
+                 memory_limit=None, cpu_limit=None, prelude=""):
+        self.r_exec = r_exec
+        self.memory_limit = memory_limit
+        self.cpu_limit = cpu_limit
+        self.size = max(1, size)
+        self.max_jobs = max_jobs
+        self.startup_timeout = startup_timeout
+        self.work_dir = work_dir or os.path.join(
+            os.path.expanduser("~"), ".cache", "ask_your_csv", "r_pool"
+        )
+        os.makedirs(self.work_dir, exist_ok=True)
+
+        self.bootstrap_path = os.path.join(self.work_dir, f"worker_{os.getpid()}.R")
+        write_worker_bootstrap(self.bootstrap_path, conda_bin_dir, libraries, prelude)
+
+        self._idle = []
+        self._total = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self.stats = {"jobs": 0, "spawned": 0, "recycled": 0, "crashed": 0}
+
+    def spawn_worker(self):
+        """Start a worker outside the pool (e.g. one pinned to an R session)."""
+        return RWorker(
+            self.r_exec, self.bootstrap_path, self.startup_timeout,
+            self.memory_limit, self.cpu_limit,
+        )
+
+    def _spawn(self):
+        worker = self.spawn_worker()
+        with self._cond:
+            self.stats["spawned"] += 1
+        return worker
+
+    def _discard(self, worker, crashed=False):
+        if crashed:
+            worker.kill()
+        else:
+            worker.close()
+        with self._cond:
+            self._total -= 1
+            self.stats["crashed" if crashed else "recycled"] += 1
+            self._cond.notify()
+
+    def warm(self, count=None):
+        """Start workers in the background so the first job finds one ready."""
+        def _warm_one():
+            with self._cond:
+                if self._closed or self._total >= self.size:
+                    return
+                self._total += 1
+            try:
+                worker = self._spawn()
+            except (RWorkerError, OSError):
+                with self._cond:
+                    self._total -= 1
+                    self._cond.notify()
+                return
+            self.release(worker)
+
+        for _ in range(count or self.size):
+            threading.Thread(target=_warm_one, daemon=True).start()
+
+    def acquire(self, timeout=None, prefer=None):
+        """Return a healthy worker, spawning one if the pool has room.
+
+        Among idle workers, the most recently used one for which
+        ``prefer(worker)`` is true is taken first.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            with self._cond:
+                if self._closed:
+                    raise RWorkerError("R worker pool is shut down")
+                worker = None
+                spawn = False
+                if self._idle:
+                    index = len(self._idle) - 1
+                    if prefer is not None:
+                        index = next(
+                            (i for i in range(index, -1, -1) if prefer(self._idle[i])), index
+                        )
+                    worker = self._idle.pop(index)
+                elif self._total < self.size:
+                    self._total += 1
+                    spawn = True
+                else:
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        raise RWorkerError("Timed out waiting for a free R worker")
+                    self._cond.wait(remaining)
+                    continue
+
+            if spawn:
+                try:
+                    return self._spawn()
+                except (RWorkerError, OSError):
+                    with self._cond:
+                        self._total -= 1
+                        self._cond.notify()
+                    raise
+
+            if worker.ping():
+                return worker
+            self._discard(worker, crashed=True)
+
+    def release(self, worker):
+        """Return a worker to the pool, recycling it if it is worn out or dead."""
+        if not worker.is_alive():
+            self._discard(worker, crashed=True)
+            return
+        if worker.jobs_run >= self.max_jobs or self._closed:
+            self._discard(worker)
+            return
+        with self._cond:
+            self._idle.append(worker)
+            self._cond.notify()
+
+    def run(self, script_path, output_dir, timeout=120, cancel=None, dataset=None):
+        """Run a script on a pooled worker; returns ``(success, stdout, stderr)``.
+
+        Workers already holding ``dataset`` (a loader path) are preferred.
+        """
+        prefer = (lambda worker: worker.dataset == dataset) if dataset else None
+        worker = self.acquire(timeout=timeout, prefer=prefer)
+        try:
+            result = worker.run(script_path, output_dir, timeout=timeout, cancel=cancel)
+        finally:
+            self.release(worker)
+        with self._cond:
+            self.stats["jobs"] += 1
+        return result
+
+    def preload(self, loader_path, timeout=None):
+        """Load a staged dataset into the workers' memory before jobs need it.
+
+        Starts missing workers, then loads the dataset into each one as it
+        becomes idle (so other sessions' jobs are never held up for long).
+        Returns how many workers hold the dataset.
+        """
+        timeout = timeout or self.startup_timeout
+        loaded = []
+
+        def _load_one():
+            try:
+                worker = self.acquire(
+                    timeout=timeout, prefer=lambda w: w.dataset != loader_path
+                )
+            except (RWorkerError, OSError):
+                return
+            try:
+                if worker.load_dataset(loader_path, timeout=timeout):
+                    loaded.append(worker)
+            finally:
+                self.release(worker)
+
+        threads = [threading.Thread(target=_load_one, daemon=True) for _ in range(self.size)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return len(set(loaded))
+
+    def shutdown(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for worker in idle:
+            self._discard(worker)
+
+
+class RSession:
+    """A conversation's persistent R workspace, pinned to a dedicated worker.
+
+    The workspace is snapshotted to disk after every job, so it survives the
+    worker being recycled, crashing or being released by the session manager.
+    """
+
+    def __init__(self, pool, session_id, snapshot_dir, max_bytes, max_jobs=None):
+        self.pool = pool
+        self.session_id = session_id
+        self.snapshot_path = os.path.join(snapshot_dir, f"{session_id}.RData")
+        self.max_bytes = max_bytes
+        self.max_jobs = max_jobs or pool.max_jobs
+        self.objects = []
+        self.size = 0.0
+        self.last_used = time.time()
+        self._worker = None
+        self._release_pending = False
+        self._lock = threading.Lock()
+
+    def run(self, script_path, output_dir, timeout=120, cancel=None):
+        """Run a script in the session; returns ``(success, stdout, stderr, note)``.
+
+        ``note`` explains session-level events the user should know about, such
+        as the workspace being reset for exceeding the memory cap.
+        """
+        with self._lock:
+            self.last_used = time.time()
+            worker = self._worker
+            if worker is not None and (not worker.is_alive() or worker.jobs_run >= self.max_jobs):
+                worker.close()
+                worker = None
+            if worker is None:
+                worker = self._worker = self.pool.spawn_worker()
+
+            success, stdout, stderr, size, objects = worker.run_in_session(
+                script_path, output_dir, self.session_id, self.snapshot_path,
+                self.max_bytes, timeout=timeout, cancel=cancel,
+            )
+            note = None
+            if size is None:
+                self._worker = None
+                if os.path.exists(self.snapshot_path):
+                    note = "R session restarted; restored the workspace saved after the previous step."
+                else:
+                    note = "R session restarted; previously created objects were lost."
+            elif size > self.max_bytes:
+                worker.drop_session(self.session_id)
+                self._remove_snapshot()
+                self.objects, self.size = [], 0.0
+                note = (
+                    f"R session workspace reached {size / 1024 ** 2:.0f} MB "
+                    f"(limit {self.max_bytes / 1024 ** 2:.0f} MB) and was reset."
+                )
+            else:
+                self.objects, self.size = objects, size
+            if self._release_pending:
+                # Evicted by the session manager while this job ran
+                self._close_worker()
+            self.last_used = time.time()
+            return success, stdout, stderr, note
+
+    def preload(self, loader_path, timeout=120):
+        """Start the session's worker and load a staged dataset into it."""
+        with self._lock:
+            worker = self._worker
+            if worker is None or not worker.is_alive():
+                worker = self._worker = self.pool.spawn_worker()
+            return worker.load_dataset(loader_path, timeout=timeout)
+
+    def reset(self):
+        """Discard the workspace, in memory and on disk."""
+        with self._lock:
+            if self._worker is not None and self._worker.is_alive():
+                self._worker.drop_session(self.session_id)
+            self._remove_snapshot()
+            self.objects, self.size = [], 0.0
+
+    def release_worker(self, wait=True):
+        """Stop the worker but keep the snapshot, to be restored on next use.
+
+        With ``wait=False`` a session that is running a job is not waited for;
+        its worker is released when the job finishes instead.
+        """
+        if not self._lock.acquire(blocking=wait):
+            self._release_pending = True
+            return
+        try:
+            self._close_worker()
+        finally:
+            self._lock.release()
+
+    def _close_worker(self):
+        if self._worker is not None:
+            self._worker.close()
+            self._worker = None
+        self._release_pending = False
+
+    def close(self):
+        self.release_worker()
+        self._remove_snapshot()
+
+    def _remove_snapshot(self):
+        try:
+            os.remove(self.snapshot_path)
+        except OSError:
+            pass
+
+
+class RSessionManager:
+    """Process-wide registry of R sessions with worker and idle limits.
+
+    At most ``max_live`` sessions keep a worker at a time; the least recently
+    used one gives its worker up (keeping its snapshot). Sessions idle for
+    longer than ``idle_timeout`` seconds are closed and their snapshots deleted.
+    """
+
+    def __init__(self, pool, snapshot_dir, max_bytes, max_live=4, idle_timeout=3600):
+        self.pool = pool
+        self.snapshot_dir = snapshot_dir
+        self.max_bytes = max_bytes
+        self.max_live = max_live
+        self.idle_timeout = idle_timeout
+        self._sessions = {}
+        self._lock = threading.Lock()
+        os.makedirs(snapshot_dir, exist_ok=True)
+
+    def get(self, session_id):
+        self.sweep()
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = RSession(self.pool, session_id, self.snapshot_dir, self.max_bytes)
+                self._sessions[session_id] = session
+            session.last_used = time.time()
+            live = sorted(
+                (s for s in self._sessions.values() if s._worker is not None and s is not session),
+                key=lambda s: s.last_used,
+            )
+        for stale in live[:max(0, len(live) - self.max_live + 1)]:
+            stale.release_worker(wait=False)
+        return session
+
+    def reset(self, session_id):
+        with self._lock:
+            session = self._sessions.get(session_id)
+        if session is not None:
+            session.reset()
+
+    def sweep(self):
+        """Close sessions that have been idle for too long."""
+        cutoff = time.time() - self.idle_timeout
+        with self._lock:
+            idle = [s for s in self._sessions.values() if s.last_used < cutoff]
+            for session in idle:
+                del self._sessions[session.session_id]
+        for session in idle:
+            session.close()
@@ -0,0 +1,350 @@
+"""HTML report export for a conversation.
+
+The report is produced as a stream of chunks and written straight to a file,
+so memory stays flat however long the conversation is. Images are either
+inlined as base64 (encoded once per content hash and cached across exports)
+or, for the zip variant, stored once each as separate files next to the
+HTML. Large plots can be downsized and recompressed on the way out.
+"""
+import base64
+import datetime
+import hashlib
+import html
+import os
+import threading
+import zipfile
+from collections import OrderedDict
+from io import BytesIO
+
+from tables import is_table_data, table_data_html
+
+try:
+    from PIL import Image
+    HAS_PIL = True
+except ImportError:
+    HAS_PIL = False
+
+REPORT_CSS = """
+            body {
+                font-family: Arial, sans-serif;
+                margin: 40px;
+                background-color: #f9f9f9;
+            }
+            h1 {
+                color: #333;
+                border-bottom: 3px solid #4CAF50;
+                padding-bottom: 10px;
+            }
+            h2 {
+                color: #666;
+                margin-top: 30px;
+                border-bottom: 1px solid #ddd;
+                padding-bottom: 5px;
+            }
+            .question {
+                background-color: #e3f2fd;
+                padding: 15px;
+                border-radius: 8px;
+                margin: 15px 0;
+                border-left: 4px solid #2196F3;
+            }
+            .answer {
+                background-color: #fff;
+                padding: 15px;
+                margin: 15px 0;
+                border-radius: 8px;
+                border-left: 4px solid #4CAF50;
+                box-shadow: 0 2px 4px rgba(0,0,0,0.1);
+            }
+            .metadata {
+                color: #999;
+                font-size: 14px;
+            }
+            .output-section {
+                background-color: #f5f5f5;
+                padding: 10px;
+                border-radius: 5px;
+                margin: 10px 0;
+            }
+            .output-label {
+                font-weight: bold;
+                color: #555;
+                margin-bottom: 5px;
+            }
+            code {
+                background-color: #f5f5f5;
+                padding: 2px 4px;
+                border-radius: 3px;
+                font-family: 'Courier New', monospace;
+            }
+            pre {
+                background-color: #2d2d2d;
+                color: #f8f8f2;
+                padding: 15px;
+                border-radius: 5px;
+                overflow-x: auto;
+                font-family: 'Courier New', monospace;
+            }
+            pre code {
+                background-color: transparent;
+                color: #f8f8f2;
+            }
+            .plot-image {
+                max-width: 100%;
+                height: auto;
+                margin: 15px 0;
+                border-radius: 5px;
+                box-shadow: 0 2px 8px rgba(0,0,0,0.1);
+            }
+            .table-container {
+                margin: 15px 0;
+                overflow-x: auto;
+            }
+            table {
+                border-collapse: collapse;
+                width: 100%;
+                margin: 10px 0;
+            }
+            .auto-fix-badge {
+                background-color: #ff9800;
+                color: white;
+                padding: 3px 8px;
+                border-radius: 12px;
+                font-size: 12px;
+                margin-left: 10px;
+            }
+"""
+
+
+class ImageEncoder:
+    """Loads report images, optionally downsized, caching results by content hash.
+
+    ``max_width`` (pixels) shrinks wider plots when Pillow is available. The
+    downsized bytes (and their base64 text, once asked for) are cached by the
+    hash of the original file, so an image is only decoded and resized once;
+    the cache is capped at ``max_cache_bytes`` and evicted LRU.
+    """
+
+    def __init__(self, max_width=None, max_cache_bytes=64 * 1024 ** 2):
+        self.max_width = max_width
+        self.max_cache_bytes = max_cache_bytes
+        self._cache = OrderedDict()  # (content hash, max_width) -> [png bytes, base64 text]
+        self._cache_bytes = 0
+        self._lock = threading.Lock()
+
+    def _entry(self, path):
+        """Return ``(cache key, cache entry)`` for an image, or None if unreadable."""
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        digest = hashlib.sha256(data).hexdigest()[:32]
+        key = (digest, self.max_width)
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                self._cache.move_to_end(key)
+                return key, entry
+        entry = [self._shrink(data), None]
+        with self._lock:
+            self._cache[key] = entry
+            self._cache_bytes += len(entry[0])
+            self._evict()
+        return key, entry
+
+    def _evict(self):
+        while self._cache_bytes > self.max_cache_bytes and len(self._cache) > 1:
+            _, (data, encoded) = self._cache.popitem(last=False)
+            self._cache_bytes -= len(data) + len(encoded or "")
+
+    def load(self, path):
+        """Return ``(content_hash, png_bytes)`` for an image, or None if unreadable."""
+        found = self._entry(path)
+        if found is None:
+            return None
+        key, entry = found
+        return key[0], entry[0]
+
+    def _shrink(self, data):
+        if not (HAS_PIL and self.max_width):
+            return data
+        try:
+            with Image.open(BytesIO(data)) as img:
+                if img.width <= self.max_width:
+                    return data
+                height = round(img.height * self.max_width / img.width)
+                resized = img.resize((self.max_width, height), Image.LANCZOS)
+                out = BytesIO()
+                resized.save(out, format="PNG", optimize=True)
+                return out.getvalue() if out.tell() < len(data) else data
+        except Exception:
+            return data
+
+    def base64(self, path):
+        found = self._entry(path)
+        if found is None:
+            return None
+        key, entry = found
+        if entry[1] is None:
+            encoded = base64.b64encode(entry[0]).decode("ascii")
+            with self._lock:
+                # Counted only if the entry was not evicted meanwhile
+                if entry[1] is None and self._cache.get(key) is entry:
+                    entry[1] = encoded
+                    self._cache_bytes += len(encoded)
+                    self._evict()
+            return encoded
+        return entry[1]
+
+
+def iter_report_html(messages, artifacts, df=None, image_src=None):
+    """Yield the report HTML in chunks.
+
+    Tables and plots are read from the ``artifacts`` store. ``image_src(path)``
+    returns the ``src`` attribute for a plot (a data URI or a relative file
+    name), or None to leave the plot out.
+    """
+    yield f"""<!DOCTYPE html>
+    <html>
+    <head>
+        <meta charset="UTF-8">
+        <style>{REPORT_CSS}        </style>
+    </head>
+    <body>
+        <h1>📊 Data Analysis Report (R Edition)</h1>
+        <p class="metadata">Generated on: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</p>
+    """
+
+    if df is not None:
+        yield f"""
+        <h2>📋 Dataset Information</h2>
+        <ul>
+            <li><strong>Total Rows:</strong> {df.shape[0]:,}</li>
+            <li><strong>Total Columns:</strong> {df.shape[1]}</li>
+            <li><strong>Column Names:</strong> {html.escape(', '.join(map(str, df.columns)))}</li>
+        </ul>
+        """
+
+    yield "<h2>💬 Analysis Conversation</h2>"
+
+    for idx, msg in enumerate(messages, 1):
+        if msg["role"] == "user":
+            yield f'<div class="question"><strong>❓ Question {idx//2 + 1}:</strong> {html.escape(msg["content"])}</div>'
+            continue
+
+        # Add auto-fix badge if applicable
+        fix_badge = ""
+        if msg.get("fixed"):
+            fix_badge = f'<span class="auto-fix-badge">✨ Auto-fixed after {msg["retries"]} attempt(s)</span>'
+
+        content = msg["content"].replace("```r", "<pre><code class='language-r'>").replace("```", "</code></pre>")
+        yield f'<div class="answer"><strong>💡 Analysis:</strong>{fix_badge}<br><br>{content}'
+
+        # Add text output if exists (large outputs live in the artifact store)
+        output = msg.get("output")
+        if output is None and msg.get("output_artifact"):
+            output = artifacts.read_text(msg["output_artifact"])
+        if output:
+            yield f'''
+                <div class="output-section">
+                    <div class="output-label">📄 R Console Output:</div>
+                    <pre><code>{html.escape(output)}</code></pre>
+                </div>
+                '''
+
+        # Add executed R code if exists
+        if "code" in msg:
+            code_label = "📝 Executed R Code" if "error" not in msg else "⚠️ Failed R Code"
+            yield f'''
+                <div class="output-section">
+                    <div class="output-label">{code_label}:</div>
+                    <pre><code class="language-r">{html.escape(msg["code"])}</code></pre>
+                </div>
+                '''
+
+            # Show error if exists
+            if "error" in msg:
+                yield f'''
+                    <div class="output-section" style="background-color: #ffebee;">
+                        <div class="output-label" style="color: #c62828;">❌ Error Message:</div>
+                        <pre><code>{html.escape(msg["error"])}</code></pre>
+                    </div>
+                    '''
+
+        # Add HTML tables if exists
+        if msg.get("table_artifacts"):
+            yield '<div class="table-container">'
+            yield '<div class="output-label">📊 Table Results:</div>'
+            for artifact_id in msg["table_artifacts"]:
+                if is_table_data(artifact_id):
+                    data_path = artifacts.path(artifact_id)
+                    yield table_data_html(data_path) if data_path else ""
+                else:
+                    yield artifacts.read_text(artifact_id) or ""
+            yield '</div>'
+
+        # Add plot images if exists
+        if msg.get("plot_artifacts") and image_src is not None:
+            yield '<div class="output-label">📈 Visualizations:</div>'
+            for artifact_id in msg["plot_artifacts"]:
+                img_path = artifacts.path(artifact_id)
+                src = image_src(img_path) if img_path else None
+                if src:
+                    yield f'<img src="{src}" class="plot-image" alt="Plot"/>'
+
+        yield '</div>'
+
+    yield """
+    <hr style="margin-top: 40px;">
+    <p class="metadata" style="text-align: center;">
+        Generated by Ask Your CSV (R Edition) | Powered by R, ggplot2, gtsummary, and flextable
+    </p>
+    </body>
+    </html>
+    """
+
+
+def write_report_html(path, messages, artifacts, df=None, encoder=None):
+    """Write a self-contained report (images inlined) to ``path``."""
+    encoder = encoder or ImageEncoder()
+
+    def inline(img_path):
+        encoded = encoder.base64(img_path)
+        return f"data:image/png;base64,{encoded}" if encoded else None
+
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        for chunk in iter_report_html(messages, artifacts, df, inline):
+            f.write(chunk)
+    os.replace(tmp, path)
+    return path
+
+
+def write_report_zip(path, messages, artifacts, df=None, encoder=None):
+    """Write ``report.html`` plus one file per distinct image into a zip."""
+    encoder = encoder or ImageEncoder()
+    tmp = f"{path}.tmp"
+    assets = OrderedDict()  # archive name -> source path
+
+    def asset(img_path):
+        loaded = encoder.load(img_path)
+        if loaded is None:
+            return None
+        name = f"assets/{loaded[0]}.png"
+        assets.setdefault(name, img_path)
+        return name
+
+    with zipfile.ZipFile(tmp, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        with zf.open("report.html", "w") as report:
+            for chunk in iter_report_html(messages, artifacts, df, asset):
+                report.write(chunk.encode("utf-8"))
+        # Images are added after the HTML (zipfile allows one open entry at a time);
+        # their downsized bytes come from the encoder's cache
+        for name, img_path in assets.items():
+            loaded = encoder.load(img_path)
+            if loaded is not None:
+                # PNG data is already compressed
+                zf.writestr(name, loaded[1], compress_type=zipfile.ZIP_STORED)
+    os.replace(tmp, path)
+    return path
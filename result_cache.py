@@ -0,0 +1,239 @@
+"""Cache of successful R executions.
+
+Running the same code against the same dataset with the same R installation
+gives the same output, so a rerun question, a question re-asked after a page
+refresh or a replayed LLM reply can reuse the first run's stdout and output
+files (tables, plots) instead of starting R. Entries are keyed on the code
+(indentation, blank lines and comment lines ignored), the dataset content
+hash and an environment string (R and package versions); the output files
+live in a directory per entry, indexed in SQLite. Entries expire after a TTL
+and the least recently used ones are dropped past a size cap.
+
+Code whose output depends on more than that (random numbers without
+``set.seed``, the clock, other files, the network) is never cached.
+"""
+import hashlib
+import json
+import os
+import re
+import shutil
+import sqlite3
+import subprocess
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# Calls that make a run's output depend on something besides code and data
+VOLATILE_CALLS = [
+    "Sys.time", "Sys.Date", "date", "proc.time", "system.time", "Sys.getenv", "tempfile",
+    "read.csv", "read.table", "read.delim", "readRDS", "readLines", "scan", "load",
+    "source", "url", "download.file", "system", "system2", "list.files", "file.info",
+]
+RANDOM_CALLS = [
+    "sample", "runif", "rnorm", "rbinom", "rpois", "rexp", "rgamma", "rbeta", "rt",
+    "rchisq", "rmultinom", "slice_sample", "sample_n", "sample_frac", "jitter",
+    "geom_jitter", "position_jitter", "boot", "kmeans",
+]
+
+
+def _call_pattern(names):
+    return re.compile(r"(?<![\w.$@])(?:" + "|".join(map(re.escape, names)) + r")\s*\(")
+
+
+_VOLATILE = _call_pattern(VOLATILE_CALLS)
+_RANDOM = _call_pattern(RANDOM_CALLS)
+_SEED = _call_pattern(["set.seed"])
+
+# Versions of R and of the given packages, one per line
+VERSIONS_SCRIPT = r"""
+cat(R.version.string, "\n", sep = "")
+for (p in commandArgs(trailingOnly = TRUE)) {
+    v <- tryCatch(as.character(packageVersion(p)), error = function(e) "missing")
+    cat(p, " ", v, "\n", sep = "")
+}
+"""
+
+
+def normalize_code(code):
+    """Code without indentation, trailing spaces, blank lines and comment lines."""
+    lines = (line.strip() for line in (code or "").splitlines())
+    return "\n".join(line for line in lines if line and not line.startswith("#"))
+
+
+def is_cacheable(code):
+    """Whether the code's output only depends on the code and the dataset."""
+    if _VOLATILE.search(code):
+        return False
+    return not _RANDOM.search(code) or bool(_SEED.search(code))
+
+
+def read_r_versions(r_exec, packages, timeout=60):
+    """R and package versions as one string, or None when R could not be queried."""
+    try:
+        result = subprocess.run(
+            [r_exec, "-e", VERSIONS_SCRIPT, "--args", *packages],
+            capture_output=True,
+            text=True,
+            timeout=timeout,
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    if result.returncode != 0:
+        return None
+    return result.stdout.strip()
+
+
+class ResultCache:
+    """Outputs of successful R runs on disk, with TTL and LRU size eviction."""
+
+    def __init__(self, root, max_bytes=500 * 1024 ** 2, max_entry_bytes=50 * 1024 ** 2,
+                 ttl=7 * 24 * 3600):
+        self.root = root
+        self.entries_dir = os.path.join(root, "entries")
+        self.db_path = os.path.join(root, "results.sqlite")
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.ttl = ttl
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evicted": 0}
+        self._lock = threading.Lock()
+        os.makedirs(self.entries_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                " key TEXT PRIMARY KEY, stdout TEXT NOT NULL, stderr TEXT NOT NULL,"
+                " files TEXT NOT NULL, created REAL NOT NULL, last_access REAL NOT NULL,"
+                " size INTEGER NOT NULL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS results_last_access ON results(last_access)"
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def make_key(code, dataset_hash, environment):
+        payload = {
+            "code": normalize_code(code),
+            "dataset": dataset_hash,
+            "environment": environment,
+        }
+        raw = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.entries_dir, key)
+
+    def get(self, key, output_dir):
+        """Copy a cached run's files into ``output_dir``; returns ``(stdout, stderr)`` or None."""
+        now = time.time()
+        with self._lock:
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT stdout, stderr, files, created FROM results WHERE key = ?", (key,)
+                ).fetchone()
+                entry_dir = self._entry_dir(key)
+                if row is not None and (now - row[3] > self.ttl or not os.path.isdir(entry_dir)):
+                    self._delete(conn, key)
+                    row = None
+                if row is None:
+                    self.stats["misses"] += 1
+                    return None
+                try:
+                    for name in json.loads(row[2]):
+                        shutil.copy2(os.path.join(entry_dir, name), os.path.join(output_dir, name))
+                except OSError:
+                    self._delete(conn, key)
+                    self.stats["misses"] += 1
+                    return None
+                conn.execute("UPDATE results SET last_access = ? WHERE key = ?", (now, key))
+            self.stats["hits"] += 1
+            return row[0], row[1]
+
+    def put(self, key, stdout, stderr, output_dir, exclude=()):
+        """Store a successful run's output and the files it left in ``output_dir``.
+
+        Hidden files and ``exclude`` are skipped; runs above ``max_entry_bytes``
+        are not stored. Returns whether the run was stored.
+        """
+        names = sorted(
+            name for name in os.listdir(output_dir)
+            if not name.startswith(".") and name not in exclude
+            and os.path.isfile(os.path.join(output_dir, name))
+        )
+        size = len((stdout or "").encode("utf-8")) + len((stderr or "").encode("utf-8"))
+        size += sum(os.path.getsize(os.path.join(output_dir, name)) for name in names)
+        if size > self.max_entry_bytes:
+            return False
+
+        tmp_dir = os.path.join(self.entries_dir, f".{key}.{uuid.uuid4().hex}.tmp")
+        try:
+            os.makedirs(tmp_dir)
+            for name in names:
+                shutil.copy2(os.path.join(output_dir, name), os.path.join(tmp_dir, name))
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return False
+
+        now = time.time()
+        with self._lock:
+            entry_dir = self._entry_dir(key)
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            os.replace(tmp_dir, entry_dir)
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO results"
+                    " (key, stdout, stderr, files, created, last_access, size)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (key, stdout or "", stderr or "", json.dumps(names), now, now, size),
+                )
+                self._evict(conn, now)
+            self.stats["stores"] += 1
+        return True
+
+    def _delete(self, conn, key):
+        conn.execute("DELETE FROM results WHERE key = ?", (key,))
+        shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+
+    def _evict(self, conn, now):
+        stale = [key for (key,) in conn.execute(
+            "SELECT key FROM results WHERE created < ?", (now - self.ttl,)
+        ).fetchall()]
+        total = conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM results WHERE created >= ?", (now - self.ttl,)
+        ).fetchone()[0]
+        if total > self.max_bytes:
+            # Drop least recently used entries until we're back under the cap
+            for key, size in conn.execute(
+                "SELECT key, size FROM results WHERE created >= ? ORDER BY last_access ASC",
+                (now - self.ttl,)
+            ).fetchall():
+                stale.append(key)
+                total -= size
+                if total <= self.max_bytes:
+                    break
+        for key in stale:
+            self._delete(conn, key)
+        self.stats["evicted"] += len(stale)
+
+    def clear(self):
+        with self._lock:
+            with self._connect() as conn:
+                conn.execute("DELETE FROM results")
+            shutil.rmtree(self.entries_dir, ignore_errors=True)
+            os.makedirs(self.entries_dir, exist_ok=True)
+
+    @property
+    def hits(self):
+        return self.stats["hits"]
+
+    @property
+    def misses(self):
+        return self.stats["misses"]
@@ -0,0 +1,134 @@
+"""Process-wide admission control for R executions.
+
+Every R execution (pooled worker, persistent session or one-shot Rscript)
+takes a slot from one ``RScheduler`` shared by all sessions of the server.
+At most ``max_concurrent`` run at once; waiting executions are admitted
+round-robin across owners (conversations), so one session queueing many code
+blocks cannot starve the others. Wait and run times are kept for the UI.
+"""
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+
+class AdmissionError(Exception):
+    """Raised when an execution leaves the queue without getting a slot."""
+
+
+class _Ticket:
+    def __init__(self, owner):
+        self.owner = owner
+        self.enqueued = time.time()
+        self.granted = False
+
+
+def _percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class RScheduler:
+    """Concurrency limit with a fair (round-robin per owner) queue and metrics."""
+
+    def __init__(self, max_concurrent=2, history=500):
+        self.max_concurrent = max(1, max_concurrent)
+        self._queues = OrderedDict()  # owner -> deque of waiting tickets
+        self._running = 0
+        self._cond = threading.Condition()
+        self._waits = deque(maxlen=history)
+        self._runs = deque(maxlen=history)
+        self.stats = {"admitted": 0, "cancelled": 0, "timed_out": 0}
+
+    def _grant(self):
+        # Owners rotate to the back of the order once served
+        while self._running < self.max_concurrent and self._queues:
+            owner, tickets = next(iter(self._queues.items()))
+            ticket = tickets.popleft()
+            del self._queues[owner]
+            if tickets:
+                self._queues[owner] = tickets
+            ticket.granted = True
+            self._running += 1
+        self._cond.notify_all()
+
+    def _remove(self, ticket):
+        tickets = self._queues.get(ticket.owner)
+        if tickets and ticket in tickets:
+            tickets.remove(ticket)
+            if not tickets:
+                del self._queues[ticket.owner]
+
+    def _position(self, ticket):
+        """1-based place of a waiting ticket in the round-robin admission order."""
+        position = 0
+        lanes = [list(tickets) for tickets in self._queues.values()]
+        for depth in range(max((len(lane) for lane in lanes), default=0)):
+            for lane in lanes:
+                if depth < len(lane):
+                    position += 1
+                    if lane[depth] is ticket:
+                        return position
+        return position
+
+    @contextmanager
+    def slot(self, owner, cancel=None, on_wait=None, timeout=None):
+        """Hold an execution slot for the duration of the ``with`` block.
+
+        While queued, ``on_wait(position)`` is called whenever the position
+        changes, and with 0 once a slot is granted after waiting. Raises
+        ``AdmissionError`` if ``cancel`` is set or ``timeout`` seconds pass
+        before a slot is free.
+        """
+        ticket = _Ticket(owner)
+        deadline = None if timeout is None else ticket.enqueued + timeout
+        last_position = None
+        with self._cond:
+            self._queues.setdefault(owner, deque()).append(ticket)
+            self._grant()
+            while not ticket.granted:
+                if cancel is not None and cancel.is_set():
+                    self._remove(ticket)
+                    self.stats["cancelled"] += 1
+                    raise AdmissionError("Execution cancelled by user")
+                if deadline is not None and time.time() >= deadline:
+                    self._remove(ticket)
+                    self.stats["timed_out"] += 1
+                    raise AdmissionError(
+                        f"R is busy: no execution slot became free within {timeout:.0f} seconds"
+                    )
+                position = self._position(ticket)
+                if on_wait is not None and position != last_position:
+                    on_wait(position)
+                last_position = position
+                self._cond.wait(0.25)
+            started = time.time()
+            self._waits.append(started - ticket.enqueued)
+            self.stats["admitted"] += 1
+        if on_wait is not None and last_position is not None:
+            on_wait(0)
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._runs.append(time.time() - started)
+                self._running -= 1
+                self._grant()
+
+    def snapshot(self):
+        """Current load and wait/run time summaries (seconds)."""
+        with self._cond:
+            waits = list(self._waits)
+            runs = list(self._runs)
+            return {
+                "running": self._running,
+                "queued": sum(len(tickets) for tickets in self._queues.values()),
+                "max_concurrent": self.max_concurrent,
+                "wait_avg": sum(waits) / len(waits) if waits else 0.0,
+                "wait_p95": _percentile(waits, 0.95),
+                "run_avg": sum(runs) / len(runs) if runs else 0.0,
+                "run_p95": _percentile(runs, 0.95),
+                **self.stats,
+            }
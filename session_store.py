@@ -0,0 +1,316 @@
+"""Memory-bounded store for the datasets sessions work on.
+
+Sessions hold a reference to a dataset (by content hash) instead of the
+DataFrame itself, so sessions analysing the same file share one copy. The
+store keeps the DataFrames it holds in memory under a byte budget: datasets
+nobody has used for a while, and the least recently used ones whenever the
+budget is exceeded, are spilled to an uncompressed Feather file (a pickle
+without pyarrow) and reloaded memory-mapped on next use. Sessions idle for
+longer than the TTL release their dataset; datasets no session references
+are dropped from memory and disk.
+
+Each session's memory is accounted as the in-memory size of its dataset
+plus the size of its messages, as reported by the app; message bytes count
+against the same budget, so long conversations push idle datasets to disk. ``on_release`` is
+called with the id of every session that is released or expires, so other
+per-session state (e.g. stored outputs) can go with it, and ``on_drop``
+with the hash of every dataset no session references any more.
+"""
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+import pandas as pd
+
+try:
+    import pyarrow.feather as feather
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+# Idle sessions and datasets are swept at most this often
+SWEEP_INTERVAL = 60
+
+
+class _Dataset:
+    def __init__(self, data_hash, df, nbytes, meta):
+        self.data_hash = data_hash
+        self.df = df
+        self.nbytes = nbytes
+        self.meta = meta
+        self.path = None
+        self.last_used = time.time()
+        self.lock = threading.Lock()
+
+
+class _Session:
+    def __init__(self, data_hash):
+        self.data_hash = data_hash
+        self.message_bytes = 0
+        self.last_seen = time.time()
+
+
+class SessionStore:
+    """Shared, spillable DataFrames with per-session accounting (thread-safe)."""
+
+    def __init__(self, root, max_bytes=2 * 1024 ** 3, idle_spill=600, session_ttl=24 * 3600,
+                 on_release=None, on_drop=None):
+        self.max_bytes = max_bytes
+        self.idle_spill = idle_spill
+        self.session_ttl = session_ttl
+        self.on_release = on_release
+        self.on_drop = on_drop
+        # Sessions and datasets to report once the lock is released
+        self._released = []
+        self._dropped = []
+        self.stats = {"spilled": 0, "reloaded": 0, "evicted_sessions": 0}
+        self._datasets = {}  # data_hash -> _Dataset
+        self._sessions = {}  # session_id -> _Session
+        self._lock = threading.Lock()
+        self._last_sweep = 0.0
+        os.makedirs(root, exist_ok=True)
+        # Spill files are private to this process; those left behind by
+        # processes that stopped long ago are removed
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            try:
+                if name.startswith("spill_") and time.time() - os.path.getmtime(path) > session_ttl:
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError:
+                pass
+        self.spill_dir = tempfile.mkdtemp(prefix="spill_", dir=root)
+
+    def put(self, session_id, data_hash, df, meta=None, nbytes=None):
+        """Make ``df`` the session's dataset; ``meta`` is kept alongside it."""
+        if nbytes is None:
+            nbytes = int(df.memory_usage(deep=True).sum())
+        with self._lock:
+            dataset = self._datasets.get(data_hash)
+            if dataset is None:
+                dataset = self._datasets[data_hash] = _Dataset(data_hash, df, nbytes, meta)
+            self._attach(session_id, data_hash)
+        self._notify()
+        self._enforce_budget(keep=data_hash)
+        return dataset.df if dataset.df is not None else df
+
+    def attach(self, session_id, data_hash):
+        """Point the session at a dataset the store already holds; returns its meta or None."""
+        with self._lock:
+            dataset = self._datasets.get(data_hash)
+            if dataset is None:
+                return None
+            self._attach(session_id, data_hash)
+        self._notify()
+        return dataset.meta
+
+    def _attach(self, session_id, data_hash):
+        session = self._sessions.get(session_id)
+        previous = session.data_hash if session is not None else None
+        if session is None:
+            session = self._sessions[session_id] = _Session(data_hash)
+        session.data_hash = data_hash
+        session.last_seen = time.time()
+        if previous is not None and previous != data_hash:
+            self._drop_unreferenced(previous)
+
+    def frame(self, session_id):
+        """The session's DataFrame (reloaded if spilled), or None if it has none."""
+        self.sweep()
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return None
+            session.last_seen = time.time()
+            dataset = self._datasets.get(session.data_hash)
+            if dataset is None:
+                return None
+            dataset.last_used = time.time()
+        with dataset.lock:
+            df = dataset.df
+            if df is None:
+                try:
+                    df = _load(dataset.path)
+                except Exception:
+                    # The spill file is gone: the session has to load the data again
+                    with self._lock:
+                        if self._datasets.get(dataset.data_hash) is dataset:
+                            del self._datasets[dataset.data_hash]
+                    return None
+                with self._lock:
+                    dataset.df = df
+                    self.stats["reloaded"] += 1
+        self._enforce_budget(keep=dataset.data_hash)
+        return df
+
+    def touch(self, session_id, message_bytes=None):
+        """Mark a session active and record the size of its messages."""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return
+            session.last_seen = time.time()
+            if message_bytes is not None:
+                session.message_bytes = message_bytes
+            keep = session.data_hash
+        self._enforce_budget(keep=keep)
+
+    def release(self, session_id):
+        """Forget a session; its dataset goes too unless another session uses it."""
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+            if session is not None:
+                self._drop_unreferenced(session.data_hash)
+            self._released.append(session_id)
+        self._notify()
+
+    def _notify(self):
+        with self._lock:
+            released, self._released = self._released, []
+            dropped, self._dropped = self._dropped, []
+        for callback, values in ((self.on_release, released), (self.on_drop, dropped)):
+            for value in values if callback is not None else ():
+                try:
+                    callback(value)
+                except Exception:
+                    pass
+
+    def _drop_unreferenced(self, data_hash):
+        if any(s.data_hash == data_hash for s in self._sessions.values()):
+            return
+        dataset = self._datasets.pop(data_hash, None)
+        if dataset is not None:
+            self._dropped.append(data_hash)
+            if dataset.path is not None:
+                _remove(dataset.path)
+
+    def _spill(self, dataset):
+        """Write a dataset to disk (once) and drop it from memory."""
+        with dataset.lock:
+            if dataset.df is None:
+                return
+            if dataset.path is None:
+                try:
+                    os.makedirs(self.spill_dir, exist_ok=True)
+                    dataset.path = _dump(dataset.df, os.path.join(self.spill_dir, dataset.data_hash))
+                except Exception:
+                    # Disk full or unwritable: keep it in memory
+                    return
+            with self._lock:
+                dataset.df = None
+                self.stats["spilled"] += 1
+
+    def _enforce_budget(self, keep=None):
+        with self._lock:
+            resident = sorted(
+                (d for d in self._datasets.values() if d.df is not None and d.data_hash != keep),
+                key=lambda d: d.last_used,
+            )
+            total = sum(d.nbytes for d in self._datasets.values() if d.df is not None)
+            total += sum(s.message_bytes for s in self._sessions.values())
+            victims = []
+            for dataset in resident:
+                if total <= self.max_bytes:
+                    break
+                victims.append(dataset)
+                total -= dataset.nbytes
+        for dataset in victims:
+            self._spill(dataset)
+
+    def sweep(self, force=False):
+        """Spill datasets idle for ``idle_spill`` seconds and evict expired sessions."""
+        now = time.time()
+        with self._lock:
+            if not force and now - self._last_sweep < SWEEP_INTERVAL:
+                return
+            self._last_sweep = now
+            expired = [
+                session_id for session_id, s in self._sessions.items()
+                if now - s.last_seen > self.session_ttl
+            ]
+            for session_id in expired:
+                self._drop_unreferenced(self._sessions.pop(session_id).data_hash)
+            self._released.extend(expired)
+            self.stats["evicted_sessions"] += len(expired)
+            idle = [
+                d for d in self._datasets.values()
+                if d.df is not None and now - d.last_used > self.idle_spill
+            ]
+        self._notify()
+        for dataset in idle:
+            self._spill(dataset)
+
+    def start_sweeper(self, interval=SWEEP_INTERVAL):
+        """Sweep from a daemon thread, so idle datasets go even when nobody is active."""
+        def _run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.sweep(force=True)
+                except Exception:
+                    pass
+        threading.Thread(target=_run, daemon=True).start()
+
+    def usage(self, session_id=None):
+        """Memory accounting for the store, or for one session."""
+        with self._lock:
+            if session_id is not None:
+                session = self._sessions.get(session_id)
+                if session is None:
+                    return None
+                dataset = self._datasets.get(session.data_hash)
+                resident = dataset is not None and dataset.df is not None
+                return {
+                    "data_bytes": dataset.nbytes if resident else 0,
+                    "spilled": dataset is not None and not resident,
+                    "message_bytes": session.message_bytes,
+                }
+            return {
+                "resident_bytes": sum(d.nbytes for d in self._datasets.values() if d.df is not None),
+                "spilled_bytes": sum(d.nbytes for d in self._datasets.values() if d.df is None),
+                "message_bytes": sum(s.message_bytes for s in self._sessions.values()),
+                "datasets": len(self._datasets),
+                "sessions": len(self._sessions),
+                "max_bytes": self.max_bytes,
+            }
+
+
+def _dump(df, base_path):
+    """Write ``df`` next to ``base_path`` and return the file's path."""
+    if HAS_PYARROW:
+        try:
+            # Uncompressed so the file can be memory-mapped on reload
+            return _write_atomic(
+                base_path + ".feather",
+                lambda p: df.reset_index(drop=True).to_feather(p, compression="uncompressed"),
+            )
+        except Exception:
+            # e.g. mixed-type object columns Arrow refuses to convert
+            pass
+    return _write_atomic(base_path + ".pkl", df.to_pickle)
+
+
+def _write_atomic(path, write):
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        _remove(tmp_path)
+    return path
+
+
+def _load(path):
+    if path.endswith(".feather"):
+        # Numeric columns without nulls stay backed by the mapped file
+        return feather.read_table(path, memory_map=True).to_pandas(split_blocks=True)
+    return pd.read_pickle(path)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
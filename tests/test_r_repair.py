@@ -0,0 +1,176 @@
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("pandas")
+
+from r_repair import (  # noqa: E402
+    PatchStore,
+    RepairEngine,
+    apply_patch,
+    error_signature,
+    fix_column_names,
+    fix_ggsurvplot_save,
+    fix_missing_library,
+    fix_numeric_text_columns,
+    fix_save_as_html_path,
+    fix_scale_types,
+    fix_windows_paths,
+    make_patch,
+)
+
+
+def context(columns=(), numeric=(), numeric_like=()):
+    return SimpleNamespace(
+        columns=list(columns),
+        numeric_columns=set(numeric),
+        numeric_like_columns=set(numeric_like),
+    )
+
+
+# --- error_signature -----------------------------------------------------------
+
+def test_signature_ignores_call_numbers_and_trailer():
+    a = 'Error in mean(df$x[1:10]) : argument "y" is missing\nCalls: mean\nExecution halted'
+    b = 'Error in sum(df$z) : argument "w" is missing\nExecution halted'
+    assert error_signature(a) == error_signature(b)
+
+
+def test_signature_keeps_name_of_missing_function():
+    a = error_signature('Error in ggsurvplot(fit) : could not find function "ggsurvplot"')
+    b = error_signature('Error in tbl_summary(df) : could not find function "tbl_summary"')
+    assert a != b
+    assert '"ggsurvplot"' in a
+
+
+def test_signature_keeps_name_of_missing_object():
+    assert error_signature("Error: object 'fit' not found") != error_signature("Error: object 'model' not found")
+
+
+def test_signature_masks_other_quoted_names():
+    a = error_signature("Error: Column `age` doesn't exist.")
+    b = error_signature("Error: Column `weight` doesn't exist.")
+    assert a == b
+
+
+# --- make_patch / apply_patch ----------------------------------------------------
+
+def test_patch_round_trip():
+    before = "x <- 1\ny <- x + 1\nprint(y)"
+    after = "x <- 1\ny <- x + 2\nprint(y)\nprint(x)"
+    assert apply_patch(before, make_patch(before, after)) == after
+
+
+def test_patch_replays_on_reindented_code():
+    ops = make_patch("fit <- lm(y ~ x)\nsummary(fit)", "fit <- lm(y ~ x)\nprint(summary(fit))")
+    assert apply_patch("  fit <- lm(y ~ x)\n  summary(fit)", ops) == "  fit <- lm(y ~ x)\nprint(summary(fit))"
+
+
+def test_patch_that_does_not_fit_returns_none():
+    ops = make_patch("a <- 1\nb <- 2", "a <- 1\nb <- 3")
+    assert apply_patch("c <- 4", ops) is None
+
+
+def test_insert_patch_is_not_applied_twice():
+    ops = make_patch("ggsurvplot(fit)", "library(survminer)\nggsurvplot(fit)")
+    once = apply_patch("ggsurvplot(fit)", ops)
+    assert once == "library(survminer)\nggsurvplot(fit)"
+    assert apply_patch(once, ops) is None
+
+
+# --- PatchStore / RepairEngine -----------------------------------------------------
+
+def test_learned_patch_only_matches_its_own_missing_function(tmp_path):
+    store = PatchStore(str(tmp_path / "patches.sqlite"))
+    store.learn(
+        'Error in ggsurvplot(fit) : could not find function "ggsurvplot"',
+        "ggsurvplot(fit)",
+        "library(survminer)\nggsurvplot(fit)",
+    )
+    other = 'Error in tbl_summary(df) : could not find function "tbl_summary"'
+    assert store.lookup(other, "tbl_summary(df)") == (None, None)
+    same = 'Error in ggsurvplot(fit2) : could not find function "ggsurvplot"'
+    fixed, patch_id = store.lookup(same, "fit2 <- 1\nggsurvplot(fit2)")
+    assert fixed == "library(survminer)\nfit2 <- 1\nggsurvplot(fit2)"
+    assert patch_id
+
+
+def test_engine_tries_each_learned_patch_once(tmp_path):
+    error = "Error: something odd happened"
+    store = PatchStore(str(tmp_path / "patches.sqlite"))
+    store.learn(error, "a <- f()", "a <- g()")
+    engine = RepairEngine(rules=[], store=store)
+    tried = set()
+    fixed, source = engine.repair("a <- f()", error, context(), tried=tried)
+    assert fixed == "a <- g()" and source.startswith("learned patch")
+    assert engine.repair("a <- f()", error, context(), tried=tried) == (None, None)
+
+
+def test_engine_survives_broken_rule():
+    def broken(code, error, ctx):
+        raise RuntimeError("boom")
+
+    engine = RepairEngine(rules=[broken, fix_windows_paths])
+    assert engine.repair('read.csv("C:\\Users\\a.csv")', "'\\U' used without hex digits", context()) == (
+        'read.csv("C:/Users/a.csv")', "fix_windows_paths"
+    )
+
+
+# --- Default rules -------------------------------------------------------------------
+
+def test_fix_windows_paths():
+    code = 'ggsave("C:\\Users\\me\\plot.png")'
+    error = "Error: '\\U' used without hex digits in character string starting \"\"C:\\U\""
+    assert fix_windows_paths(code, error, context()) == 'ggsave("C:/Users/me/plot.png")'
+    assert fix_windows_paths(code, "Error: other", context()) is None
+
+
+def test_fix_missing_library():
+    code = "ggsurvplot(fit)"
+    error = 'Error in ggsurvplot(fit) : could not find function "ggsurvplot"'
+    fixed = fix_missing_library(code, error, context())
+    assert fixed == "library(survminer)\nggsurvplot(fit)"
+    assert fix_missing_library(fixed, error, context()) is None
+
+
+def test_fix_save_as_html_path():
+    code = 'save_as_html(ft, "table.html")'
+    error = 'Error in save_as_html(ft, "table.html") : argument "path" is missing, with no default'
+    assert fix_save_as_html_path(code, error, context()) == 'save_as_html(ft, path = "table.html")'
+    assert fix_save_as_html_path('save_as_html(ft, path = "t.html")', error, context()) == (
+        'save_as_html(ft, path = "t.html")'
+    )
+
+
+def test_fix_ggsurvplot_save():
+    code = 'p <- ggsurvplot(fit)\nggsave("km.png", p)'
+    error = "Error: `plot` must be a ggplot"
+    assert fix_ggsurvplot_save(code, error, context()) == 'p <- ggsurvplot(fit)\nggsave("km.png", p$plot)'
+    assert fix_ggsurvplot_save('plot(x)\nggsave("a.png")', error, context()) is None
+
+
+def test_fix_column_names():
+    ctx = context(columns=["Age", "weight_kg"])
+    assert fix_column_names("mean(df$age)", "Error: object 'age' not found", ctx) == "mean(df$Age)"
+    assert fix_column_names("mean(df$wieght_kg)", "Error: object 'wieght_kg' not found", ctx) == "mean(df$weight_kg)"
+    # A variable the code defines is not a misspelled column
+    assert fix_column_names("age <- 1\nprint(age)", "Error: object 'age' not found", ctx) is None
+
+
+def test_fix_scale_types():
+    ctx = context(columns=["stage", "score"], numeric=["stage"], numeric_like=["score"])
+    fixed = fix_scale_types(
+        "ggplot(df, aes(x, fill = stage))", "Error: Continuous value supplied to discrete scale", ctx
+    )
+    assert fixed == "ggplot(df, aes(x, fill = factor(stage)))"
+    fixed = fix_scale_types(
+        "ggplot(df, aes(x = score))", "Error: Discrete value supplied to continuous scale", ctx
+    )
+    assert fixed == "ggplot(df, aes(x = as.numeric(score)))"
+
+
+def test_fix_numeric_text_columns():
+    ctx = context(columns=["dose"], numeric_like=["dose"])
+    fixed = fix_numeric_text_columns("mean(df$dose)", "Error in mean: argument is not numeric or logical", ctx)
+    assert fixed == "mean(as.numeric(df$dose))"
+    assert fix_numeric_text_columns("mean(df$dose)", "Error: other", ctx) is None
@@ -0,0 +1,60 @@
+"""Local token counting for prompt budgets.
+
+Uses tiktoken when it is installed; otherwise falls back to a character-based
+estimate (about four characters per token for English text and code), which
+is close enough for trimming decisions.
+"""
+from functools import lru_cache
+
+try:
+    import tiktoken
+    HAS_TIKTOKEN = True
+except ImportError:
+    HAS_TIKTOKEN = False
+
+CHARS_PER_TOKEN = 4
+# Per-message overhead of the chat format (role, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+@lru_cache(maxsize=8)
+def _encoding(model):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+def count_tokens(text, model="gpt-4.1"):
+    if not text:
+        return 0
+    if HAS_TIKTOKEN:
+        return len(_encoding(model).encode(text, disallowed_special=()))
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def count_message_tokens(messages, model="gpt-4.1"):
+    return sum(
+        count_tokens(m["content"], model) + MESSAGE_OVERHEAD_TOKENS for m in messages
+    )
+
+
+def truncate_tokens(text, max_tokens, model="gpt-4.1", marker="\n... (truncated)", keep="head"):
+    """Cut ``text`` so it (with ``marker``) fits in ``max_tokens``.
+
+    ``keep="tail"`` keeps the end of the text and puts the marker first.
+    """
+    total = count_tokens(text, model)
+    if total <= max_tokens:
+        return text
+    budget = max(max_tokens - count_tokens(marker, model), 0)
+    cut = int(len(text) * budget / total)
+
+    def piece(n):
+        return text[len(text) - n:] if keep == "tail" else text[:n]
+
+    while cut > 0 and count_tokens(piece(cut), model) > budget:
+        cut = int(cut * 0.9)
+    if keep == "tail":
+        return marker.strip("\n") + "\n" + piece(cut)
+    return piece(cut) + marker
@@ -0,0 +1,306 @@
+"""Per-question tracing and process-wide metrics.
+
+A ``Trace`` collects timed spans (prompt build, LLM calls, every R attempt,
+fixes, artifact extraction, rendering) and counters (tokens, retries) for one
+question, from whichever threads work on it. ``Telemetry`` receives finished
+traces: each is appended to a JSONL log and folded into ``Metrics``, which
+renders the Prometheus text format to a file (for a textfile collector) and,
+optionally, on an HTTP ``/metrics`` endpoint.
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Histogram buckets, in seconds
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class Span:
+    """One timed stage; ``set()`` adds attributes while it runs."""
+
+    def __init__(self, name, start, parent=None, attrs=None):
+        self.name = name
+        self.start = start
+        self.end = None
+        self.parent = parent
+        self.attrs = dict(attrs or {})
+        self.status = "ok"
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    @property
+    def duration(self):
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def to_dict(self, origin):
+        return {
+            "name": self.name,
+            "parent": self.parent,
+            "start_ms": round((self.start - origin) * 1000, 1),
+            "duration_ms": round(self.duration * 1000, 1),
+            "status": self.status,
+            **({"attrs": self.attrs} if self.attrs else {}),
+        }
+
+
+class Trace:
+    """Spans and counters for answering one question (thread-safe)."""
+
+    def __init__(self, session_id, question=None):
+        self.id = uuid.uuid4().hex[:16]
+        self.session_id = session_id
+        self.question = question
+        self.started = time.time()
+        self.origin = time.perf_counter()
+        self.spans = []
+        self.counters = {}
+        self.attrs = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def span(self, name, **attrs):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        span = Span(name, time.perf_counter(), stack[-1] if stack else None, attrs)
+        stack.append(name)
+        try:
+            yield span
+        except BaseException as e:
+            span.status = type(e).__name__
+            raise
+        finally:
+            stack.pop()
+            span.end = time.perf_counter()
+            with self._lock:
+                self.spans.append(span)
+
+    def add_span(self, name, start, end, **attrs):
+        """Record a span measured by the caller (``time.perf_counter`` values)."""
+        span = Span(name, start, attrs=attrs)
+        span.end = end
+        with self._lock:
+            self.spans.append(span)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, **attrs):
+        with self._lock:
+            self.attrs.update(attrs)
+
+    def finish(self, status):
+        """The trace as a JSON-serializable record."""
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s.start)
+            return {
+                "trace_id": self.id,
+                "session_id": self.session_id,
+                "time": self.started,
+                "status": status,
+                "duration_ms": round((time.perf_counter() - self.origin) * 1000, 1),
+                "question_chars": len(self.question or ""),
+                "attrs": dict(self.attrs),
+                "counters": dict(self.counters),
+                "spans": [s.to_dict(self.origin) for s in spans],
+            }
+
+
+class _NullSpan:
+    def set(self, **attrs):
+        pass
+
+
+class NullTrace:
+    """Stand-in when a code path runs without a trace."""
+
+    @contextmanager
+    def span(self, name, **attrs):
+        yield _NullSpan()
+
+    def add_span(self, name, start, end, **attrs):
+        pass
+
+    def count(self, name, value=1):
+        pass
+
+    def set(self, **attrs):
+        pass
+
+
+NULL_TRACE = NullTrace()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+class Metrics:
+    """Counters and histograms rendered in the Prometheus text format."""
+
+    def __init__(self, prefix="askcsv"):
+        self.prefix = prefix
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            data = self._histograms.setdefault(key, [0] * len(BUCKETS) + [0.0, 0])
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    data[i] += 1
+            data[-2] += value
+            data[-1] += 1
+
+    def record_trace(self, record):
+        """Fold a finished trace into the metrics."""
+        self.inc("turns_total", status=record["status"])
+        self.observe("turn_duration_seconds", record["duration_ms"] / 1000)
+        for span in record["spans"]:
+            self.observe("stage_duration_seconds", span["duration_ms"] / 1000, stage=span["name"])
+            attrs = span.get("attrs", {})
+            if span["name"] == "r_run":
+                self.inc("r_runs_total", status=attrs.get("exit", "unknown"))
+            elif span["name"] == "llm":
+                self.inc("llm_requests_total", purpose=attrs.get("purpose", "answer"),
+                         cached=str(bool(attrs.get("cached"))).lower())
+                if attrs.get("ttft_ms") is not None:
+                    self.observe("llm_time_to_first_token_seconds", attrs["ttft_ms"] / 1000)
+        counters = record["counters"]
+        for kind in ("prompt", "completion"):
+            if counters.get(f"llm_{kind}_tokens"):
+                self.inc("llm_tokens_total", counters[f"llm_{kind}_tokens"], kind=kind)
+        for source in ("local", "llm", "failed"):
+            if counters.get(f"fix_{source}"):
+                self.inc("fix_attempts_total", counters[f"fix_{source}"], source=source)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+        seen = set()
+        for (name, labels), value in counters:
+            full = f"{self.prefix}_{name}"
+            if full not in seen:
+                seen.add(full)
+                if name in self._help:
+                    lines.append(f"# HELP {full} {self._help[name]}")
+                lines.append(f"# TYPE {full} counter")
+            lines.append(f"{full}{_labels(labels)} {value}")
+        for (name, labels), data in histograms:
+            full = f"{self.prefix}_{name}"
+            if full not in seen:
+                seen.add(full)
+                if name in self._help:
+                    lines.append(f"# HELP {full} {self._help[name]}")
+                lines.append(f"# TYPE {full} histogram")
+            for bound, count in zip(BUCKETS, data):
+                lines.append(f"{full}_bucket{_labels(labels + (('le', bound),))} {count}")
+            lines.append(f"{full}_bucket{_labels(labels + (('le', '+Inf'),))} {data[-1]}")
+            lines.append(f"{full}_sum{_labels(labels)} {data[-2]:.6f}")
+            lines.append(f"{full}_count{_labels(labels)} {data[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+def serve_metrics(metrics, port, host="0.0.0.0"):
+    """Serve ``metrics.render()`` on ``http://host:port/metrics`` from a daemon thread."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class Telemetry:
+    """Where finished traces go: JSONL log, metrics, metrics file, recent list."""
+
+    def __init__(self, log_path, metrics_path=None, max_log_bytes=50 * 1024 ** 2, recent=50):
+        self.log_path = log_path
+        self.metrics_path = metrics_path
+        self.max_log_bytes = max_log_bytes
+        self.metrics = Metrics()
+        self.recent = deque(maxlen=recent)
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(log_path), exist_ok=True)
+        self.metrics.describe("turns_total", "Questions answered, by outcome")
+        self.metrics.describe("turn_duration_seconds", "Wall time to answer a question")
+        self.metrics.describe("stage_duration_seconds", "Wall time per pipeline stage")
+        self.metrics.describe("r_runs_total", "R executions, by exit status")
+        self.metrics.describe("llm_requests_total", "Chat completion requests")
+        self.metrics.describe("llm_time_to_first_token_seconds", "Time to the first streamed token")
+        self.metrics.describe("llm_tokens_total", "Tokens reported by the API")
+        self.metrics.describe("fix_attempts_total", "Auto-fix attempts, by source")
+
+    def record(self, trace, status):
+        """Finish ``trace``, log it and update the metrics; returns the record."""
+        record = trace.finish(status)
+        line = json.dumps(record, default=str) + "\n"
+        with self._lock:
+            try:
+                if os.path.exists(self.log_path) and os.path.getsize(self.log_path) > self.max_log_bytes:
+                    os.replace(self.log_path, self.log_path + ".1")
+                with open(self.log_path, "a", encoding="utf-8") as f:
+                    f.write(line)
+            except OSError:
+                pass
+            self.metrics.record_trace(record)
+            self.recent.append(record)
+            if self.metrics_path:
+                tmp = f"{self.metrics_path}.tmp"
+                try:
+                    with open(tmp, "w", encoding="utf-8") as f:
+                        f.write(self.metrics.render())
+                    os.replace(tmp, self.metrics_path)
+                except OSError:
+                    pass
+        return record
+
+
+def stage_totals(record):
+    """Total milliseconds per top-level stage of a trace record."""
+    totals = {}
+    for span in record["spans"]:
+        if span["parent"] is None:
+            totals[span["name"]] = totals.get(span["name"], 0.0) + span["duration_ms"]
+    return totals